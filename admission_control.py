@@ -0,0 +1,183 @@
+# admission_control.py - Memory-budgeted admission of new documents, with backpressure
+
+import asyncio
+import logging
+import math
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from models import AppSettings
+
+logger = logging.getLogger(__name__)
+
+# A page in flight is held as its base64 string, the data URL built from it, the
+# serialized request body and (briefly) the raw image bytes: about 4x its payload
+PAGE_MEMORY_COPIES = 4
+# Retry-After sent with a rejection
+REJECTED_RETRY_AFTER_SECONDS = 10
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a document cannot be admitted within the queue timeout."""
+
+    def __init__(self, message: str, status_code: int, retry_after: int = REJECTED_RETRY_AFTER_SECONDS):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """
+    One admitted document's share of the budget: a fixed reservation plus the pages it
+    has queued and the estimated bytes of its pages in flight. `close` returns all of
+    it and is safe to call more than once.
+    """
+
+    def __init__(self, controller: "AdmissionController", reserved_bytes: int):
+        self._controller = controller
+        self.reserved_bytes = reserved_bytes
+        self.pages = 0
+        self.closed = False
+
+    def reserve_bytes(self, amount: int) -> None:
+        if not self.closed:
+            self.reserved_bytes += amount
+            self._controller._adjust(amount, 0)
+
+    def release_bytes(self, amount: int) -> None:
+        if not self.closed:
+            amount = min(amount, self.reserved_bytes)
+            self.reserved_bytes -= amount
+            self._controller._adjust(-amount, 0)
+
+    def add_pages(self, count: int) -> None:
+        if not self.closed:
+            self.pages += count
+            self._controller._adjust(0, count)
+
+    def page_done(self) -> None:
+        if not self.closed and self.pages > 0:
+            self.pages -= 1
+            self._controller._adjust(0, -1)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self._controller._adjust(-self.reserved_bytes, -self.pages, documents_delta=-1)
+
+
+class AdmissionController:
+    """
+    Admits new documents only while the estimated memory of documents in flight stays
+    within config.admission_memory_budget_mb and fewer than config.admission_max_queued_pages
+    pages are queued. Otherwise a new document waits up to
+    config.admission_queue_timeout_seconds for capacity and is then rejected: with 503
+    when memory is the limit, 429 when the page queue is. A lone document is always
+    admitted, however large. 0 disables a limit. Must be used from the event loop thread.
+    """
+
+    def __init__(self, config: AppSettings):
+        self.memory_budget_bytes = max(0, config.admission_memory_budget_mb) * 1024 * 1024
+        self.document_reserve_bytes = max(0, config.admission_document_reserve_mb) * 1024 * 1024
+        self.max_queued_pages = max(0, config.admission_max_queued_pages)
+        self.queue_timeout = max(0.0, config.admission_queue_timeout_seconds)
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+        self.queued_pages = 0
+        self.documents = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def _overload(self, estimated_bytes: int) -> Optional[AdmissionRejectedError]:
+        if self.max_queued_pages and self.queued_pages >= self.max_queued_pages:
+            return AdmissionRejectedError(
+                f"Too many pages queued ({self.queued_pages}, limit {self.max_queued_pages}); retry later.", 429
+            )
+        if self.memory_budget_bytes and self.documents and self.in_flight_bytes + estimated_bytes > self.memory_budget_bytes:
+            return AdmissionRejectedError(
+                f"Server memory budget is in use ({self.in_flight_bytes // (1024 * 1024)} of "
+                f"{self.memory_budget_bytes // (1024 * 1024)} MB); retry later.", 503
+            )
+        return None
+
+    async def admit(self, upload_bytes: int = 0, queue_timeout: Optional[float] = None) -> AdmissionTicket:
+        """
+        Waits until a document of `upload_bytes` fits and returns its ticket. `queue_timeout`
+        overrides config.admission_queue_timeout_seconds; math.inf waits until it fits
+        (documents of a batch that was already accepted).
+
+        Raises:
+            AdmissionRejectedError: If it still does not fit after the queue timeout.
+        """
+        estimated_bytes = self.document_reserve_bytes + max(0, upload_bytes)
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + (self.queue_timeout if queue_timeout is None else queue_timeout)
+        self.waiting += 1
+        try:
+            while True:
+                overload = self._overload(estimated_bytes)
+                if overload is None:
+                    break
+                remaining = give_up_at - loop.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    logger.warning(f"Admission rejected ({overload.status_code}): {overload}")
+                    raise overload
+                waiter = loop.create_future()
+                self._waiters.append(waiter)
+                try:
+                    await asyncio.wait([waiter], timeout=None if remaining == math.inf else remaining)
+                finally:
+                    if not waiter.done():
+                        waiter.cancel()
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        ticket = AdmissionTicket(self, estimated_bytes)
+        self._adjust(estimated_bytes, 0, documents_delta=1)
+        return ticket
+
+    def _adjust(self, bytes_delta: int, pages_delta: int, documents_delta: int = 0) -> None:
+        self.in_flight_bytes += bytes_delta
+        self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+        self.queued_pages += pages_delta
+        self.documents += documents_delta
+        if bytes_delta < 0 or pages_delta < 0:
+            # Wake every waiter; each re-checks whether it now fits
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        mb = 1024 * 1024
+        return {
+            "memory_budget_mb": self.memory_budget_bytes // mb,
+            "in_flight_mb": round(self.in_flight_bytes / mb, 1),
+            "peak_in_flight_mb": round(self.peak_in_flight_bytes / mb, 1),
+            "queued_pages": self.queued_pages,
+            "max_queued_pages": self.max_queued_pages,
+            "documents_in_flight": self.documents,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+# --- Process-wide instance ---
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller(config: AppSettings) -> AdmissionController:
+    """Returns the shared admission controller, creating it from config on first use."""
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(config)
+        logger.info(
+            f"Initialized admission control (memory budget {config.admission_memory_budget_mb} MB, "
+            f"max {config.admission_max_queued_pages} queued pages)."
+        )
+    return _controller
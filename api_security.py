@@ -1,10 +1,16 @@
 # api_security.py - API Key validation logic and FastAPI dependency
 
+import asyncio
+import hashlib
 import logging
-from typing import List, Optional
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from fastapi import Security, HTTPException, status
 from fastapi.security import APIKeyHeader, APIKeyQuery
 
+from models import AppSettings
+
 # --- Security Schemes ---
 # Define how clients can provide the API key: either in the query ('api-key') or header ('x-api-key')
 
@@ -93,4 +99,105 @@ async def get_api_key_dependency(
 #             detail="Invalid or missing API Key",
 #             headers={"WWW-Authenticate": "Header"}, # Indicate header auth preferred
 #         )
-#     return dependency_instance
\ No newline at end of file
+#     return dependency_instance
+
+
+# --- ResetData Key Validation Cache ---
+
+def fingerprint_api_key(api_key: str) -> str:
+    """Returns a SHA-256 hex digest of an API key, so raw keys are never used as cache keys."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class KeyValidationUnavailableError(Exception):
+    """Raised by a key validator when upstream could not be asked (timeout, connection error, 5xx)."""
+
+
+class KeyValidationCache:
+    """
+    TTL cache for upstream API key validation results with single-flight coalescing.
+
+    Successful validations are remembered for `positive_ttl` seconds and rejections for
+    the (shorter) `negative_ttl`. A validator that raises (e.g.
+    KeyValidationUnavailableError) caches nothing; the error reaches every caller that
+    shared the call. Concurrent validations of the same key share one
+    upstream call. Entries are keyed by fingerprint_api_key() and bounded by `max_entries`.
+    """
+
+    def __init__(self, positive_ttl: float, negative_ttl: float, max_entries: int = 1024):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max(1, max_entries)
+        # fingerprint -> (expires_at, ok, error_message)
+        self._entries: "OrderedDict[str, Tuple[float, bool, Optional[str]]]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def validate(
+        self,
+        api_key: str,
+        validator: Callable[[str], Awaitable[Tuple[bool, Optional[str]]]]
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Returns the cached (ok, error_message) for `api_key`, calling `validator` on a miss.
+        """
+        fingerprint = fingerprint_api_key(api_key)
+        entry = self._entries.get(fingerprint)
+        if entry is not None:
+            expires_at, ok, err = entry
+            if time.monotonic() < expires_at:
+                self._entries.move_to_end(fingerprint)
+                logger.debug(f"Key validation cache hit for key ...{api_key[-4:]} (valid={ok}).")
+                return ok, err
+            del self._entries[fingerprint]
+
+        pending = self._in_flight.get(fingerprint)
+        if pending is None:
+            pending = asyncio.ensure_future(self._validate_and_store(fingerprint, api_key, validator))
+            self._in_flight[fingerprint] = pending
+        else:
+            logger.debug(f"Joining in-flight validation for key ...{api_key[-4:]}.")
+        # Shield so one cancelled caller does not cancel the shared validation
+        return await asyncio.shield(pending)
+
+    async def _validate_and_store(
+        self,
+        fingerprint: str,
+        api_key: str,
+        validator: Callable[[str], Awaitable[Tuple[bool, Optional[str]]]]
+    ) -> Tuple[bool, Optional[str]]:
+        try:
+            ok, err = await validator(api_key)
+            ttl = self.positive_ttl if ok else self.negative_ttl
+            if ttl > 0:
+                self._entries[fingerprint] = (time.monotonic() + ttl, ok, err)
+                self._entries.move_to_end(fingerprint)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return ok, err
+        finally:
+            self._in_flight.pop(fingerprint, None)
+
+    def invalidate(self, api_key: str) -> bool:
+        """Drops any cached result for `api_key`. Returns True if an entry was removed."""
+        return self._entries.pop(fingerprint_api_key(api_key), None) is not None
+
+
+_key_validation_cache: Optional[KeyValidationCache] = None
+
+
+def get_key_validation_cache(config: AppSettings) -> KeyValidationCache:
+    """Returns the process-wide key validation cache, creating it from config on first use."""
+    global _key_validation_cache
+    if _key_validation_cache is None:
+        _key_validation_cache = KeyValidationCache(
+            positive_ttl=config.key_validation_ttl,
+            negative_ttl=config.key_validation_negative_ttl,
+            max_entries=config.key_validation_cache_size,
+        )
+    return _key_validation_cache
+
+
+def invalidate_cached_api_key(api_key: str) -> None:
+    """Forgets a previously validated key, e.g. after upstream rejects it with 401."""
+    if _key_validation_cache is not None and _key_validation_cache.invalidate(api_key):
+        logger.warning(f"Invalidated cached validation for key ...{api_key[-4:]} after an authentication failure.")
@@ -0,0 +1,316 @@
+# batch_processor.py - Expands /scan/batch uploads (files and ZIP archives) and runs them as one batch
+
+import asyncio
+import hashlib
+import logging
+import math
+import stat
+import time
+import zipfile
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from admission_control import get_admission_controller
+from document_converter import UnsupportedDocumentError, sniff_document_type
+from models import AppSettings, BatchDocumentResult
+from upload_receiver import ReceivedFile, safe_upload_filename
+from workflow_orchestrator import process_document_stateless
+
+logger = logging.getLogger(__name__)
+
+# ZIP entries are copied out (and hashed) in chunks of this size
+ZIP_COPY_CHUNK_BYTES = 1024 * 1024
+# Entries smaller than this are never treated as zip bombs, however well they compress
+ZIP_RATIO_CHECK_MIN_BYTES = 1024 * 1024
+# Archive folders written by desktop tools that hold no documents
+_IGNORED_ZIP_DIRS = ("__MACOSX/",)
+
+BATCH_STATUS_COMPLETED = "completed"
+BATCH_STATUS_ERROR = "error"
+
+BatchDocumentCallback = Callable[[BatchDocumentResult], None]
+
+
+class BatchLimitError(ValueError):
+    """Raised when a batch has too many documents or its ZIP archives expand too far."""
+
+
+class BatchDocument:
+    """One document of a batch, on disk and ready for the pipeline."""
+
+    def __init__(self, index: int, name: str, path: Path, size_bytes: int, sha256: str,
+                 upload_stats: Optional[Dict[str, Any]] = None):
+        self.index = index
+        self.name = name
+        self.path = path
+        self.size_bytes = size_bytes
+        self.sha256 = sha256
+        self.upload_stats = upload_stats or {"size_bytes": size_bytes, "sha256": sha256}
+
+
+def is_zip_archive(file_path: Path) -> bool:
+    """True for a ZIP file that is not itself an office document (OOXML and ODF files are ZIPs too)."""
+    if not zipfile.is_zipfile(file_path):
+        return False
+    try:
+        sniff_document_type(file_path)
+    except UnsupportedDocumentError:
+        return True
+    return False
+
+
+def _skip_reason(info: zipfile.ZipInfo) -> Optional[str]:
+    """Why a ZIP entry is not a document to process, or None if it is one. (Pure Function)"""
+    name = info.filename
+    if info.is_dir():
+        return None # Directories are skipped silently
+    if stat.S_ISLNK(info.external_attr >> 16):
+        return "symbolic link"
+    if info.flag_bits & 0x1:
+        return "encrypted"
+    if name.startswith(_IGNORED_ZIP_DIRS) or Path(name).name.startswith("."):
+        return "hidden or metadata file"
+    return None
+
+
+def _copy_zip_entry(archive: zipfile.ZipFile, info: zipfile.ZipInfo, target: Path) -> Tuple[int, str]:
+    """Copies one entry to `target`, never writing more than its declared size; returns (size, sha256)."""
+    digest = hashlib.sha256()
+    size = 0
+    with archive.open(info) as source, open(target, "wb") as destination:
+        while True:
+            chunk = source.read(ZIP_COPY_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > info.file_size:
+                raise BatchLimitError(f"ZIP entry '{info.filename}' is larger than its header declares.")
+            digest.update(chunk)
+            destination.write(chunk)
+    return size, digest.hexdigest()
+
+
+def expand_zip_archive(
+    archive_path: Path,
+    archive_name: str,
+    target_dir: Path,
+    config: AppSettings,
+    max_entries: Optional[int] = None,
+    max_expanded_bytes: Optional[int] = None,
+) -> Tuple[List[Tuple[str, Path, int, str]], List[Dict[str, str]]]:
+    """
+    Extracts the documents of a ZIP archive into `target_dir` (blocking; run it in a thread).
+
+    Entry names are never used as paths: each entry is written under a sanitized name
+    with a sequence prefix, so '../' or absolute names cannot escape `target_dir`.
+    Directories, symbolic links, encrypted entries and hidden/metadata files are skipped.
+
+    Returns:
+        (documents, skipped): documents as (name, path, size_bytes, sha256) with names
+        like '<archive_name>/<entry name>', and skipped entries as {"name", "reason"}.
+
+    Raises:
+        BatchLimitError: If the archive has more than `max_entries` documents, expands past
+            `max_expanded_bytes` (None = no limit) or has an entry compressed beyond
+            config.batch_max_compression_ratio.
+        zipfile.BadZipFile: If the archive is corrupt.
+    """
+    documents: List[Tuple[str, Path, int, str]] = []
+    skipped: List[Dict[str, str]] = []
+    with zipfile.ZipFile(archive_path) as archive:
+        entries = []
+        for info in archive.infolist():
+            reason = _skip_reason(info)
+            if reason is not None:
+                skipped.append({"name": f"{archive_name}/{info.filename}", "reason": reason})
+            elif not info.is_dir():
+                entries.append(info)
+
+        # Check the declared sizes before writing anything
+        if max_entries is not None and len(entries) > max_entries:
+            raise BatchLimitError(f"ZIP archive '{archive_name}' holds {len(entries)} documents; at most {max_entries} fit in this batch.")
+        declared_total = sum(info.file_size for info in entries)
+        if max_expanded_bytes is not None and declared_total > max_expanded_bytes:
+            raise BatchLimitError(
+                f"ZIP archive '{archive_name}' expands to {declared_total} bytes; at most {max_expanded_bytes} bytes are allowed."
+            )
+        max_ratio = config.batch_max_compression_ratio
+        for info in entries:
+            if max_ratio and info.file_size >= ZIP_RATIO_CHECK_MIN_BYTES and info.file_size > max_ratio * max(1, info.compress_size):
+                raise BatchLimitError(
+                    f"ZIP entry '{info.filename}' in '{archive_name}' is compressed more than {max_ratio}:1; refusing to expand it."
+                )
+
+        target_dir.mkdir(parents=True, exist_ok=True)
+        for position, info in enumerate(entries, start=1):
+            target = target_dir / f"{position:05d}_{safe_upload_filename(Path(info.filename).name)}"
+            size, sha256 = _copy_zip_entry(archive, info, target)
+            documents.append((f"{archive_name}/{info.filename}", target, size, sha256))
+    return documents, skipped
+
+
+async def expand_batch_uploads(
+    files: List[ReceivedFile],
+    batch_dir: Path,
+    config: AppSettings,
+) -> Tuple[List[BatchDocument], List[Dict[str, str]]]:
+    """
+    Turns the uploaded files of a batch into its documents, expanding ZIP archives
+    (which are deleted once expanded). Documents are numbered in upload order.
+
+    Returns:
+        (documents, skipped ZIP entries).
+
+    Raises:
+        BatchLimitError: If the batch exceeds config.batch_max_documents or
+            config.batch_max_expanded_mb, or an archive looks like a zip bomb.
+        zipfile.BadZipFile: If an archive is corrupt.
+    """
+    max_documents = config.batch_max_documents or None
+    expanded_budget = config.batch_max_expanded_mb * 1024 * 1024 or None
+    documents: List[BatchDocument] = []
+    skipped: List[Dict[str, str]] = []
+    for received in files:
+        if not await asyncio.to_thread(is_zip_archive, received.path):
+            documents.append(BatchDocument(len(documents), received.filename, received.path,
+                                           received.size_bytes, received.sha256, received.stats()))
+        else:
+            remaining_entries = max_documents - len(documents) if max_documents is not None else None
+            entries, archive_skipped = await asyncio.to_thread(
+                expand_zip_archive, received.path, received.filename,
+                batch_dir / "expanded" / received.path.name, config,
+                remaining_entries, expanded_budget,
+            )
+            await asyncio.to_thread(received.path.unlink)
+            skipped.extend(archive_skipped)
+            for name, path, size_bytes, sha256 in entries:
+                documents.append(BatchDocument(len(documents), name, path, size_bytes, sha256))
+            if expanded_budget is not None:
+                expanded_budget -= sum(size_bytes for _, _, size_bytes, _ in entries)
+            logger.info(f"Expanded ZIP archive '{received.filename}' into {len(entries)} document(s); skipped {len(archive_skipped)} entries.")
+        if max_documents is not None and len(documents) > max_documents:
+            raise BatchLimitError(f"A batch may hold at most {config.batch_max_documents} documents.")
+    return documents, skipped
+
+
+async def run_batch(
+    documents: List[BatchDocument],
+    options: Dict[str, Any],
+    config: AppSettings,
+    llm_api_key: str,
+    batch_id: str,
+    batch_dir: Path,
+    on_document: Optional[BatchDocumentCallback] = None,
+) -> List[BatchDocumentResult]:
+    """
+    Runs every document of a batch through process_document_stateless, at most
+    config.batch_max_concurrent_documents at a time. All pages of the batch wait in one
+    page scheduler queue (`batch_id`), so the batch gets one fair share of MAX_WORKERS
+    next to other requests. Each document is admitted by admission control on its own,
+    waiting as long as needed. Identical documents (same SHA-256) are processed once.
+
+    `options` are the validated form fields (see main_api._document_options); the
+    deadline applies to each document from the moment it starts. A failing document
+    becomes an error result and does not stop the others. `on_document` is called with
+    each result as soon as it is ready (completion order). If the batch is cancelled, its
+    unfinished documents are cancelled too.
+
+    Returns:
+        The document results in batch order.
+    """
+    semaphore = asyncio.Semaphore(max(1, config.batch_max_concurrent_documents))
+    admission = get_admission_controller(config)
+    deadline = options["deadline"]
+    first_by_sha: Dict[str, asyncio.Task] = {}
+    results: List[BatchDocumentResult] = []
+
+    def deliver(result: BatchDocumentResult) -> BatchDocumentResult:
+        results.append(result)
+        if on_document is not None:
+            on_document(result)
+        return result
+
+    async def run_document(document: BatchDocument) -> BatchDocumentResult:
+        outcome = BatchDocumentResult(index=document.index, document_name=document.name,
+                                      status=BATCH_STATUS_ERROR, sha256=document.sha256)
+        async with semaphore:
+            try:
+                ticket = await admission.admit(document.size_bytes, queue_timeout=math.inf)
+                outcome.result = await process_document_stateless(
+                    input_file_path=document.path,
+                    user_prompt=options["user_prompt"],
+                    output_format=options["output_format"],
+                    use_meta_intelligence=options["use_meta_intelligence"],
+                    config=config,
+                    llm_api_key=llm_api_key,
+                    job_dir=batch_dir / f"doc_{document.index:05d}",
+                    job_id=f"{batch_id}_{document.index}",
+                    document_name=document.name,
+                    render_profile=options["render_profile"],
+                    page_timeout=options["page_timeout"],
+                    deadline=deadline if deadline is not None else config.request_deadline_seconds,
+                    admission_ticket=ticket,
+                    upload_stats=document.upload_stats,
+                    scheduler_owner=batch_id,
+                    prompts=options["prompts"],
+                )
+                outcome.status = BATCH_STATUS_COMPLETED
+            except (ValueError, RuntimeError) as e:
+                logger.warning(f"Batch {batch_id}: document '{document.name}' failed: {e}")
+                outcome.error = str(e)
+            except Exception as e:
+                logger.error(f"Batch {batch_id}: document '{document.name}' failed unexpectedly: {e}", exc_info=True)
+                outcome.error = str(e)
+        return deliver(outcome)
+
+    async def reuse_result(document: BatchDocument, original: asyncio.Task) -> BatchDocumentResult:
+        first = await original
+        return deliver(first.model_copy(update={
+            "index": document.index, "document_name": document.name, "duplicate_of": first.index,
+        }))
+
+    start_time = time.monotonic()
+    tasks: List[asyncio.Task] = []
+    for document in documents:
+        original = first_by_sha.get(document.sha256)
+        if original is None:
+            task = first_by_sha[document.sha256] = asyncio.create_task(run_document(document))
+        else:
+            await asyncio.to_thread(document.path.unlink, missing_ok=True) # Only the first copy is processed
+            task = asyncio.create_task(reuse_result(document, original))
+        tasks.append(task)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info(f"Batch {batch_id}: {len(documents)} document(s) finished in {time.monotonic() - start_time:.2f}s.")
+    return sorted(results, key=lambda result: result.index)
+
+
+def summarize_batch(
+    batch_id: str,
+    results: List[BatchDocumentResult],
+    skipped: List[Dict[str, str]],
+    start_timestamp: float,
+    upload_stats: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Batch-level counts and timing for BatchResult.summary and the final stream event. (Pure Function)"""
+    completed = [r for r in results if r.status == BATCH_STATUS_COMPLETED]
+    return {
+        "batch_id": batch_id,
+        "documents_count": len(results),
+        "completed_count": len(completed),
+        "failed_count": len(results) - len(completed),
+        "duplicates_count": sum(1 for r in results if r.duplicate_of is not None),
+        "page_results_count": sum(  # One per page, or per page and prompt with named prompts
+            len(r.result.pages) + sum(len(pages) for pages in (r.result.prompt_results or {}).values())
+            for r in completed if r.result is not None
+        ),
+        "skipped_entries": skipped,
+        "processing_time_seconds": round(time.time() - start_timestamp, 3),
+        "upload": upload_stats,
+    }
+
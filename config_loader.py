@@ -20,12 +20,75 @@ def load_app_config() -> AppSettings:
             # REMOVED fixed_processing_prompt_template loading
             # Use getint helper for integer conversion with default
             max_workers=int(os.environ.get('MAX_WORKERS', '5')),
+            page_timeout_seconds=int(os.environ.get('PAGE_TIMEOUT_SECONDS', '180')),
+            request_deadline_seconds=int(os.environ.get('REQUEST_DEADLINE_SECONDS', '600')),
+            max_upload_mb=int(os.environ.get('MAX_UPLOAD_MB', '200')),
+            max_prompts_per_request=int(os.environ.get('MAX_PROMPTS_PER_REQUEST', '8')),
+            llm_pages_per_request=int(os.environ.get('LLM_PAGES_PER_REQUEST', '1')),
+            batch_max_documents=int(os.environ.get('BATCH_MAX_DOCUMENTS', '1000')),
+            batch_max_concurrent_documents=int(os.environ.get('BATCH_MAX_CONCURRENT_DOCUMENTS', '8')),
+            batch_max_expanded_mb=int(os.environ.get('BATCH_MAX_EXPANDED_MB', '1024')),
+            batch_max_compression_ratio=int(os.environ.get('BATCH_MAX_COMPRESSION_RATIO', '100')),
+            admission_memory_budget_mb=int(os.environ.get('ADMISSION_MEMORY_BUDGET_MB', '2048')),
+            admission_document_reserve_mb=int(os.environ.get('ADMISSION_DOCUMENT_RESERVE_MB', '16')),
+            admission_max_queued_pages=int(os.environ.get('ADMISSION_MAX_QUEUED_PAGES', '5000')),
+            admission_queue_timeout_seconds=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', '10')),
             process_timeout=int(os.environ.get('PROCESS_TIMEOUT', '90')),
+            libreoffice_max_concurrent=int(os.environ.get('LIBREOFFICE_MAX_CONCURRENT', '2')),
+            pdfinfo_max_concurrent=int(os.environ.get('PDFINFO_MAX_CONCURRENT', '8')),
+            subprocess_sandbox=os.environ.get('SUBPROCESS_SANDBOX', 'false').lower() == 'true',
+            subprocess_sandbox_cgroups=os.environ.get('SUBPROCESS_SANDBOX_CGROUPS', 'true').lower() == 'true',
+            libreoffice_memory_limit_mb=int(os.environ.get('LIBREOFFICE_MEMORY_LIMIT_MB', '2048')),
+            libreoffice_cpu_limit_seconds=int(os.environ.get('LIBREOFFICE_CPU_LIMIT_SECONDS', '300')),
+            libreoffice_nice=int(os.environ.get('LIBREOFFICE_NICE', '5')),
+            poppler_memory_limit_mb=int(os.environ.get('POPPLER_MEMORY_LIMIT_MB', '1024')),
+            poppler_cpu_limit_seconds=int(os.environ.get('POPPLER_CPU_LIMIT_SECONDS', '120')),
+            poppler_nice=int(os.environ.get('POPPLER_NICE', '5')),
             temp_dir_base=os.environ.get('TEMP_DIR_BASE', '/tmp/everypage_pure'),
             libreoffice_command=os.environ.get('LIBREOFFICE_COMMAND', 'libreoffice'),
             pdftoppm_command=os.environ.get('PDFTOPPM_COMMAND', 'pdftoppm'),
             pdfinfo_command=os.environ.get('PDFINFO_COMMAND', 'pdfinfo'),
-            log_level=os.environ.get('LOG_LEVEL', 'INFO').upper()
+            log_level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+            render_window_pages=int(os.environ.get('RENDER_WINDOW_PAGES', '4')),
+            render_concurrency=int(os.environ.get('RENDER_CONCURRENCY', '0')),
+            render_timeout_per_page=int(os.environ.get('RENDER_TIMEOUT_PER_PAGE', '60')),
+            render_shard_retries=int(os.environ.get('RENDER_SHARD_RETRIES', '1')),
+            render_profile=os.environ.get('RENDER_PROFILE', 'longest_side:2048'),
+            page_image_format=os.environ.get('PAGE_IMAGE_FORMAT', 'png'),
+            page_image_quality=int(os.environ.get('PAGE_IMAGE_QUALITY', '85')),
+            libreoffice_pool_size=int(os.environ.get('LIBREOFFICE_POOL_SIZE', '2')),
+            libreoffice_recycle_after=int(os.environ.get('LIBREOFFICE_RECYCLE_AFTER', '50')),
+            libreoffice_pool_base_port=int(os.environ.get('LIBREOFFICE_POOL_BASE_PORT', '2002')),
+            libreoffice_uno_python=os.environ.get('LIBREOFFICE_UNO_PYTHON', '/usr/bin/python3'),
+            libreoffice_startup_timeout=int(os.environ.get('LIBREOFFICE_STARTUP_TIMEOUT', '30')),
+            llm_max_connections=int(os.environ.get('LLM_MAX_CONNECTIONS', '20')),
+            llm_max_keepalive_connections=int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', '10')),
+            llm_keepalive_expiry=float(os.environ.get('LLM_KEEPALIVE_EXPIRY', '60')),
+            llm_http2=os.environ.get('LLM_HTTP2', 'true').lower() == 'true',
+            llm_client_cache_size=int(os.environ.get('LLM_CLIENT_CACHE_SIZE', '32')),
+            llm_client_idle_ttl=int(os.environ.get('LLM_CLIENT_IDLE_TTL', '600')),
+            llm_request_timeout=float(os.environ.get('LLM_REQUEST_TIMEOUT', '120')),
+            llm_initial_concurrency_per_key=int(os.environ.get('LLM_INITIAL_CONCURRENCY_PER_KEY', '4')),
+            llm_max_concurrency_per_key=int(os.environ.get('LLM_MAX_CONCURRENCY_PER_KEY', '32')),
+            llm_latency_tolerance=float(os.environ.get('LLM_LATENCY_TOLERANCE', '2.0')),
+            llm_rpm_limit=int(os.environ.get('LLM_RPM_LIMIT', '0')),
+            llm_tpm_limit=int(os.environ.get('LLM_TPM_LIMIT', '0')),
+            llm_max_attempts=int(os.environ.get('LLM_MAX_ATTEMPTS', '3')),
+            llm_retry_base_delay=float(os.environ.get('LLM_RETRY_BASE_DELAY', '1.0')),
+            llm_retry_max_delay=float(os.environ.get('LLM_RETRY_MAX_DELAY', '20')),
+            llm_retry_budget_ratio=float(os.environ.get('LLM_RETRY_BUDGET_RATIO', '0.2')),
+            llm_retry_budget_min=int(os.environ.get('LLM_RETRY_BUDGET_MIN', '5')),
+            llm_breaker_error_rate=float(os.environ.get('LLM_BREAKER_ERROR_RATE', '0.5')),
+            llm_breaker_min_calls=int(os.environ.get('LLM_BREAKER_MIN_CALLS', '10')),
+            llm_breaker_window_seconds=float(os.environ.get('LLM_BREAKER_WINDOW_SECONDS', '60')),
+            llm_breaker_open_seconds=float(os.environ.get('LLM_BREAKER_OPEN_SECONDS', '30')),
+            key_validation_ttl=int(os.environ.get('KEY_VALIDATION_TTL', '300')),
+            key_validation_negative_ttl=int(os.environ.get('KEY_VALIDATION_NEGATIVE_TTL', '30')),
+            key_validation_cache_size=int(os.environ.get('KEY_VALIDATION_CACHE_SIZE', '1024')),
+            job_retention_seconds=int(os.environ.get('JOB_RETENTION_SECONDS', '3600')),
+            page_cache_memory_bytes=int(os.environ.get('PAGE_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024))),
+            page_cache_disk_bytes=int(os.environ.get('PAGE_CACHE_DISK_BYTES', '0')),
+            page_cache_dir=os.environ.get('PAGE_CACHE_DIR', ''),
         )
 
         # Basic logging after loading
@@ -36,6 +99,7 @@ def load_app_config() -> AppSettings:
         # REMOVED logging for fixed prompt template
         logger.info(f"Max workers: {settings.max_workers}, Process timeout: {settings.process_timeout}s")
         logger.info(f"Temporary directory base: {settings.temp_dir_base}")
+        logger.info(f"LLM connection pool: {settings.llm_max_connections} max / {settings.llm_max_keepalive_connections} keep-alive per client, HTTP/2 requested: {settings.llm_http2}")
 
         return settings
 
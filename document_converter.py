@@ -1,14 +1,150 @@
 # document_converter.py - Handles document conversion to PDF using LibreOffice
 
 import logging
+import zipfile
 from pathlib import Path
 from typing import Tuple, Optional
 
 from models import AppSettings # For accessing config like command path
-from external_commands import run_subprocess_async # To run the actual command
+from external_commands import (
+    run_subprocess_async, RETURN_CODE_TIMEOUT, RETURN_CODE_RESOURCE_LIMIT, ResourceLimitExceededError # To run the actual command
+)
+from libreoffice_pool import get_libreoffice_pool, POOL_MODE_LISTENER
+from image_processor import is_bmp_header
 
 logger = logging.getLogger(__name__)
 
+# --- Input Type Detection ---
+
+# Document kinds returned by sniff_document_type()
+DOCUMENT_KIND_PDF = "pdf"       # Already a PDF: goes straight to pdfinfo/pdftoppm
+DOCUMENT_KIND_IMAGE = "image"   # Sent to the model as-is
+DOCUMENT_KIND_OFFICE = "office" # Needs LibreOffice conversion (OOXML, ODF, legacy OLE, RTF, TIFF)
+DOCUMENT_KIND_TEXT = "text"     # Plain text / CSV / HTML (UTF-8, UTF-16 or a legacy 8-bit encoding); also converted by LibreOffice
+
+SNIFF_BYTES = 8192
+# A PDF header may follow a binary preamble (readers accept it within the first 1 KB)
+PDF_HEADER_SEARCH_BYTES = 1024
+# Legacy 8-bit text (e.g. cp1252 CSV) may contain at most this share of control bytes
+TEXT_MAX_CONTROL_BYTE_RATIO = 0.01
+
+_IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+_TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*")
+_TEXT_BOMS = [
+    (b"\xef\xbb\xbf", "utf-8"),
+    (b"\xff\xfe", "utf-16-le"),
+    (b"\xfe\xff", "utf-16-be"),
+]
+# Control bytes that do not occur in text (tab, LF, FF, CR and ESC/SUB are allowed)
+_CONTROL_BYTES = bytes(b for b in range(32) if b not in (9, 10, 12, 13, 26, 27))
+
+
+class UnsupportedDocumentError(ValueError):
+    """Raised when an upload's content is not a format the pipeline can process."""
+
+
+def _is_text(data: bytes) -> bool:
+    """
+    True if `data` (the start of a file) decodes as UTF-8 or BOM-marked UTF-16, or is
+    8-bit text in a legacy encoding (no NUL and almost no other control bytes).
+    """
+    for bom, encoding in _TEXT_BOMS:
+        if data.startswith(bom):
+            body = data[len(bom):]
+            if encoding.startswith("utf-16"):
+                body = body[:len(body) - len(body) % 2]
+            try:
+                body.decode(encoding)
+                return True
+            except UnicodeDecodeError as e:
+                # A character cut off at the sniff boundary is still text
+                return e.start >= len(body) - 4
+    if b"\x00" in data:
+        return False
+    try:
+        data.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        if e.start >= len(data) - 4:
+            return True
+    control_bytes = len(data) - len(data.translate(None, _CONTROL_BYTES))
+    return control_bytes <= len(data) * TEXT_MAX_CONTROL_BYTE_RATIO
+
+
+def _has_pdf_header(head: bytes) -> bool:
+    """
+    True if "%PDF-" starts the file, after optional whitespace or a UTF-8 BOM, or
+    follows a binary (non-text) preamble within the first KB. Text that merely
+    mentions "%PDF-" is not a PDF.
+    """
+    if head.startswith(b"\xef\xbb\xbf"):
+        head = head[3:]
+    if head.lstrip(b" \t\r\n\f").startswith(b"%PDF-"):
+        return True
+    offset = head.find(b"%PDF-", 0, PDF_HEADER_SEARCH_BYTES)
+    return offset > 0 and not _is_text(head[:offset])
+
+
+def sniff_document_type(file_path: Path) -> Tuple[str, str]:
+    """
+    Detects what an uploaded file is from its leading bytes rather than its suffix.
+
+    Args:
+        file_path: Path to the uploaded file.
+
+    Returns:
+        A tuple (kind, mime_type) where kind is one of the DOCUMENT_KIND_* constants.
+
+    Raises:
+        UnsupportedDocumentError: If the content is empty or of an unsupported format.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError as e:
+        raise UnsupportedDocumentError(f"Could not read uploaded file '{file_path.name}': {e}") from e
+
+    if not head:
+        raise UnsupportedDocumentError(f"Uploaded file '{file_path.name}' is empty.")
+    if _has_pdf_header(head):
+        return DOCUMENT_KIND_PDF, "application/pdf"
+    for signature, mime_type in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return DOCUMENT_KIND_IMAGE, mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return DOCUMENT_KIND_IMAGE, "image/webp"
+    if is_bmp_header(head, file_path.stat().st_size):
+        return DOCUMENT_KIND_IMAGE, "image/bmp"
+    if head[:4] in _TIFF_SIGNATURES:
+        return DOCUMENT_KIND_OFFICE, "image/tiff" # The model is not sent TIFF; LibreOffice turns it into a PDF
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        return DOCUMENT_KIND_OFFICE, "application/x-ole-storage" # .doc/.xls/.ppt
+    if head.startswith(b"{\\rtf"):
+        return DOCUMENT_KIND_OFFICE, "application/rtf"
+    if head.startswith(b"PK\x03\x04"):
+        # OOXML has [Content_Types].xml, ODF has a 'mimetype' entry; other ZIPs are not documents
+        try:
+            with zipfile.ZipFile(file_path) as archive:
+                names = set(archive.namelist())
+        except (zipfile.BadZipFile, OSError) as e:
+            raise UnsupportedDocumentError(f"Uploaded file '{file_path.name}' looks like a ZIP archive but could not be read: {e}") from e
+        if "[Content_Types].xml" in names:
+            return DOCUMENT_KIND_OFFICE, "application/vnd.openxmlformats-officedocument"
+        if "mimetype" in names:
+            return DOCUMENT_KIND_OFFICE, "application/vnd.oasis.opendocument"
+        raise UnsupportedDocumentError(f"Uploaded file '{file_path.name}' is a ZIP archive, not an office document.")
+    if _is_text(head):
+        return DOCUMENT_KIND_TEXT, "text/plain"
+    raise UnsupportedDocumentError(f"Unsupported file format for '{file_path.name}'. Upload a PDF, an office document, plain text or an image.")
+
+
+# --- LibreOffice Conversion ---
+
 async def convert_to_pdf_libreoffice(
     input_path: Path,
     output_dir: Path,
@@ -27,6 +163,9 @@ async def convert_to_pdf_libreoffice(
             - success (bool): True if conversion was successful, False otherwise.
             - output_pdf_path (Optional[Path]): Path to the created PDF file if successful, None otherwise.
             - error_message (str): An error message if conversion failed, empty string otherwise.
+
+    Raises:
+        ResourceLimitExceededError: If LibreOffice was stopped by its sandbox limits.
     """
     if not input_path.exists():
         error_msg = f"Input file not found for conversion: {input_path}"
@@ -45,22 +184,46 @@ async def convert_to_pdf_libreoffice(
         logger.error(error_msg)
         return False, None, error_msg
 
-    # Construct the command
-    # Using --norestore to prevent issues with recovery dialogs
-    # Using --nolockcheck to prevent issues with stale lock files (use cautiously)
-    # Using --invisible as an alternative to --headless, sometimes more reliable
-    cmd = [
-        config.libreoffice_command,
-        "--invisible", # or "--headless"
-        "--norestore",
-        "--nolockcheck", # Consider potential risks if multiple processes access same files
-        "--convert-to", "pdf:writer_pdf_Export", # Specify PDF export filter
-        "--outdir", str(output_dir),
-        str(input_path)
-    ]
-
-    logger.info(f"Attempting conversion: {' '.join(cmd)}")
-    returncode, stdout, stderr = await run_subprocess_async(cmd, description)
+    pool = get_libreoffice_pool(config)
+    if pool is None:
+        # Unpooled: every conversion shares the default user profile
+        # Using --norestore to prevent issues with recovery dialogs
+        # Using --nolockcheck to prevent issues with stale lock files (use cautiously)
+        # Using --invisible as an alternative to --headless, sometimes more reliable
+        cmd = [
+            config.libreoffice_command,
+            "--invisible", # or "--headless"
+            "--norestore",
+            "--nolockcheck", # Consider potential risks if multiple processes access same files
+            "--convert-to", "pdf:writer_pdf_Export", # Specify PDF export filter
+            "--outdir", str(output_dir),
+            str(input_path)
+        ]
+        logger.info(f"Attempting conversion: {' '.join(cmd)}")
+        returncode, stdout, stderr = await run_subprocess_async(cmd, description)
+    else:
+        async with pool.acquire() as instance:
+            if pool.mode == POOL_MODE_LISTENER and instance.listener_alive:
+                returncode, stdout, stderr = await pool.convert_via_listener(instance, input_path, output_pdf_path)
+            else:
+                # Isolated profile per instance: no lock contention, so no --nolockcheck
+                cmd = [
+                    config.libreoffice_command,
+                    "--headless",
+                    "--norestore",
+                    f"-env:UserInstallation={instance.profile_url}",
+                    "--convert-to", "pdf:writer_pdf_Export",
+                    "--outdir", str(output_dir),
+                    str(input_path)
+                ]
+                logger.info(f"Attempting conversion on pool instance {instance.index}: {' '.join(cmd)}")
+                returncode, stdout, stderr = await run_subprocess_async(cmd, description)
+                if returncode in (RETURN_CODE_TIMEOUT, RETURN_CODE_RESOURCE_LIMIT):
+                    instance.needs_recycle = True # A killed run may leave the profile locked or half-written
+
+    if returncode == RETURN_CODE_RESOURCE_LIMIT:
+        output_pdf_path.unlink(missing_ok=True)
+        raise ResourceLimitExceededError(f"Conversion of '{input_path.name}' aborted: {stderr}")
 
     if returncode == 0 and output_pdf_path.exists():
         logger.info(f"Successfully converted '{input_path.name}' to '{output_pdf_path.name}'.")
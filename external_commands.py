@@ -2,21 +2,148 @@
 
 import asyncio
 import logging
+import os
+import resource
 import shutil
-from typing import List, Tuple, Optional
+import signal
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Tuple, Optional
+
+from process_sandbox import ProcessSandbox, create_sandbox
 
 logger = logging.getLogger(__name__)
 
+# Return code reported when a command is killed for exceeding its timeout
+RETURN_CODE_TIMEOUT = -3
+# Return code reported when a command is stopped by its sandbox limits (see process_sandbox)
+RETURN_CODE_RESOURCE_LIMIT = -4
+
+
+class ResourceLimitExceededError(RuntimeError):
+    """Raised when a document cannot be processed because a command hit its sandbox limits."""
+
+# --- Process limits (set once at startup by configure_subprocess_limits) ---
+
+_default_timeout: Optional[float] = None
+_tool_limits: Dict[str, int] = {}
+_tool_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+# Threads blocked in os.wait4, one per running command (kept off the default executor)
+_wait_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="subprocess-wait")
+
+# Per-request collector of subprocess timings (see subprocess_timing_scope)
+_timings: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("subprocess_timings", default=None)
+
+
+def configure_subprocess_limits(default_timeout: Optional[float], tool_limits: Dict[str, int]) -> None:
+    """
+    Sets the timeout applied to commands run without an explicit one and the maximum
+    number of concurrent processes per executable (keyed by command[0], e.g. 'pdftoppm').
+    Limits of 0 or less mean unlimited.
+    """
+    global _default_timeout, _tool_limits
+    _default_timeout = default_timeout
+    _tool_limits = {tool: limit for tool, limit in tool_limits.items() if limit > 0}
+    _tool_semaphores.clear()
+    logger.info(f"Subprocess limits: default timeout {default_timeout}s, concurrency {_tool_limits or 'unlimited'}.")
+
+
+def _tool_semaphore(tool: str) -> Optional[asyncio.Semaphore]:
+    limit = _tool_limits.get(tool)
+    if limit is None:
+        return None
+    semaphore = _tool_semaphores.get(tool)
+    if semaphore is None:
+        semaphore = _tool_semaphores[tool] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+@contextmanager
+def subprocess_timing_scope() -> Iterator[List[Dict[str, Any]]]:
+    """
+    Collects a record for every command run in this context (including tasks it creates):
+    tool, description, queue_wait_seconds, run_seconds, return_code, cpu_user_seconds,
+    cpu_system_seconds and max_rss_kb.
+    """
+    records: List[Dict[str, Any]] = []
+    token = _timings.set(records)
+    try:
+        yield records
+    finally:
+        _timings.reset(token)
+
+
+def summarize_subprocess_timings(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Totals timing records per tool: runs, timeouts, resource-limit kills, queue-wait/run/CPU seconds and peak RSS. (Pure Function)"""
+    summary: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        tool = summary.setdefault(record["tool"], {
+            "runs": 0, "timeouts": 0, "resource_limit_kills": 0, "queue_wait_seconds": 0.0, "max_queue_wait_seconds": 0.0,
+            "run_seconds": 0.0, "cpu_user_seconds": 0.0, "cpu_system_seconds": 0.0, "max_rss_kb": 0
+        })
+        tool["runs"] += 1
+        tool["timeouts"] += 1 if record["return_code"] == RETURN_CODE_TIMEOUT else 0
+        tool["resource_limit_kills"] += 1 if record["return_code"] == RETURN_CODE_RESOURCE_LIMIT else 0
+        tool["queue_wait_seconds"] = round(tool["queue_wait_seconds"] + record["queue_wait_seconds"], 3)
+        tool["max_queue_wait_seconds"] = round(max(tool["max_queue_wait_seconds"], record["queue_wait_seconds"]), 3)
+        tool["run_seconds"] = round(tool["run_seconds"] + record["run_seconds"], 3)
+        for field in _USAGE_FIELDS:
+            tool[field] = round(tool[field] + record.get(field, 0.0), 3)
+        tool["max_rss_kb"] = max(tool["max_rss_kb"], record.get("max_rss_kb") or 0)
+    return summary
+
+
+def _kill_process_group(process: subprocess.Popen) -> None:
+    """Kills the command and everything it spawned (it runs in its own session)."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+
+def _wait_with_rusage(process: subprocess.Popen, inherited_rss_kb: int) -> Tuple[int, Dict[str, Any]]:
+    """Blocks until the child exits (run in _wait_executor) and returns (return_code, resource usage)."""
+    _, wait_status, rusage = os.wait4(process.pid, 0)
+    return_code = os.waitstatus_to_exitcode(wait_status)
+    process.returncode = return_code # Reaped here; keep Popen from waiting again
+    # ru_maxrss is the largest RSS of the child or any descendant it reaped (KiB on Linux).
+    # Linux carries the forking parent's high-water mark across exec, so a peak no higher
+    # than this process's own peak cannot be told apart from it and is reported as None.
+    max_rss_kb = rusage.ru_maxrss if rusage.ru_maxrss > inherited_rss_kb else None
+    return return_code, {
+        "cpu_user_seconds": round(rusage.ru_utime, 3),
+        "cpu_system_seconds": round(rusage.ru_stime, 3),
+        "max_rss_kb": max_rss_kb,
+    }
+
+
 async def run_subprocess_async(
     command: List[str],
-    description: str = "External command"
+    description: str = "External command",
+    timeout: Optional[float] = None
 ) -> Tuple[int, str, str]:
     """
     Runs an external command asynchronously and returns its exit code, stdout, and stderr.
 
+    The command first waits for a slot of its tool's concurrency limit, then runs in
+    its own process group; if it exceeds its timeout the whole group is killed. When
+    resource limits are configured for the tool (see process_sandbox) it runs under
+    them, and a run stopped by a limit returns RETURN_CODE_RESOURCE_LIMIT.
+    Wall time, CPU time and peak RSS of the run are added to the process-wide totals
+    and, inside a subprocess_timing_scope, to the request's records.
+
     Args:
         command: A list containing the command and its arguments.
         description: A brief description of the command for logging purposes.
+        timeout: Seconds after which the process group is killed and RETURN_CODE_TIMEOUT
+                 is returned. Defaults to the configured PROCESS_TIMEOUT.
 
     Returns:
         A tuple containing:
@@ -25,28 +152,107 @@ async def run_subprocess_async(
             - stderr (str): The standard error, decoded as UTF-8.
     """
     cmd_str = ' '.join(command)
-    logger.info(f"Running {description}: {cmd_str}")
-    start_time = asyncio.get_event_loop().time()
+    timeout = timeout if timeout is not None else _default_timeout
+    tool = os.path.basename(command[0])
+    semaphore = _tool_semaphore(tool)
+    loop = asyncio.get_running_loop()
+
+    queue_start = loop.time()
+    if semaphore is not None:
+        await semaphore.acquire()
+    try:
+        start_time = loop.time()
+        queue_wait = start_time - queue_start
+        if queue_wait > 0.5:
+            logger.info(f"{description} waited {queue_wait:.2f}s for a free {tool} slot.")
+        logger.info(f"Running {description}: {cmd_str}")
+        return_code, stdout, stderr, usage = await _run_process(command, description, cmd_str, timeout, create_sandbox(tool))
+        wall_seconds = loop.time() - start_time
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    record = {
+        "tool": tool,
+        "description": description,
+        "queue_wait_seconds": round(queue_wait, 3),
+        "run_seconds": round(wall_seconds, 3),
+        "return_code": return_code,
+        **usage,
+    }
+    _add_to_process_totals(record)
+    records = _timings.get()
+    if records is not None:
+        records.append(record)
+    return return_code, stdout, stderr
+
+
+async def _run_process(
+    command: List[str], description: str, cmd_str: str, timeout: Optional[float], sandbox: Optional[ProcessSandbox]
+) -> Tuple[int, str, str, Dict[str, Any]]:
+    try:
+        return await _run_and_reap(command, description, cmd_str, timeout, sandbox)
+    finally:
+        if sandbox is not None:
+            await asyncio.get_running_loop().run_in_executor(_wait_executor, sandbox.cleanup)
+
+
+async def _run_and_reap(
+    command: List[str], description: str, cmd_str: str, timeout: Optional[float], sandbox: Optional[ProcessSandbox]
+) -> Tuple[int, str, str, Dict[str, Any]]:
+    # Popen + os.wait4 instead of asyncio subprocesses: asyncio reaps its children itself,
+    # which discards the child's resource usage. Output goes to temp files so the child
+    # can never block on a full pipe while we wait.
+    start_time = asyncio.get_running_loop().time()
+    no_usage: Dict[str, Any] = {}
 
     try:
-        process = await asyncio.create_subprocess_exec(
-            command[0],  # The command executable
-            *command[1:], # The arguments
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout_file,
+                stderr=stderr_file,
+                start_new_session=True, # Own process group, so a timeout kills its children too
+                preexec_fn=sandbox.preexec if sandbox is not None else None
+            )
+            inherited_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            waiter = asyncio.get_running_loop().run_in_executor(_wait_executor, _wait_with_rusage, process, inherited_rss_kb)
+            try:
+                return_code, usage = await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+            except asyncio.TimeoutError:
+                _kill_process_group(process)
+                _, usage = await waiter
+                logger.error(f"{description} timed out after {timeout} seconds; its process group was killed. Command: {cmd_str}")
+                return RETURN_CODE_TIMEOUT, "", f"Timed out after {timeout} seconds.", usage
+            except asyncio.CancelledError:
+                # Do not leave the child running when the caller gives up
+                _kill_process_group(process)
+                await waiter
+                raise
 
-        stdout_bytes, stderr_bytes = await process.communicate()
-        return_code = process.returncode
+            stdout_file.seek(0)
+            stderr_file.seek(0)
+            stdout_bytes = stdout_file.read()
+            stderr_bytes = stderr_file.read()
 
-        end_time = asyncio.get_event_loop().time()
+        end_time = asyncio.get_running_loop().time()
         duration = end_time - start_time
 
         stdout = stdout_bytes.decode('utf-8', errors='ignore').strip() if stdout_bytes else ""
         stderr = stderr_bytes.decode('utf-8', errors='ignore').strip() if stderr_bytes else ""
 
+        limit_reason = None
+        if sandbox is not None and return_code != 0:
+            limit_reason = sandbox.limit_exceeded(return_code, stderr, usage["cpu_user_seconds"] + usage["cpu_system_seconds"])
+        if limit_reason:
+            error_msg = f"{os.path.basename(command[0])} {limit_reason}."
+            logger.error(f"{description} {limit_reason} after {duration:.2f} seconds. Command: {cmd_str}")
+            return RETURN_CODE_RESOURCE_LIMIT, stdout, error_msg, usage
+
         if return_code == 0:
-            logger.info(f"{description} completed successfully in {duration:.2f} seconds.")
+            peak_rss = f"{usage['max_rss_kb'] // 1024} MiB" if usage["max_rss_kb"] is not None else "n/a"
+            logger.info(f"{description} completed successfully in {duration:.2f} seconds (CPU {usage['cpu_user_seconds'] + usage['cpu_system_seconds']:.2f}s, peak RSS {peak_rss}).")
             # Log snippet of stdout if needed for debugging, but can be noisy
             # if stdout: logger.debug(f"{description} stdout (first 100 chars): {stdout[:100]}...")
         else:
@@ -60,14 +266,46 @@ async def run_subprocess_async(
                 logger.error(f"Stdout: {stdout}")
 
 
-        return return_code, stdout, stderr
+        return return_code, stdout, stderr, usage
 
     except FileNotFoundError:
         logger.error(f"{description} failed: Command not found: '{command[0]}'. Ensure it's installed and in the system PATH.")
-        return -1, "", f"Command not found: {command[0]}" # Use a specific code or raise? Returning for now.
+        return -1, "", f"Command not found: {command[0]}", no_usage # Use a specific code or raise? Returning for now.
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         logger.error(f"An unexpected error occurred while running {description} ('{cmd_str}'): {e}", exc_info=True)
-        return -2, "", f"Unexpected error running command: {e}"
+        return -2, "", f"Unexpected error running command: {e}", no_usage
+
+
+# --- Process-wide resource totals (for /metrics) ---
+
+_USAGE_FIELDS = ("cpu_user_seconds", "cpu_system_seconds")
+_process_totals: Dict[str, Dict[str, Any]] = {}
+
+
+def _add_to_process_totals(record: Dict[str, Any]) -> None:
+    totals = _process_totals.setdefault(record["tool"], {
+        "runs": 0, "failures": 0, "timeouts": 0, "resource_limit_kills": 0, "queue_wait_seconds": 0.0, "wall_seconds": 0.0,
+        "cpu_user_seconds": 0.0, "cpu_system_seconds": 0.0, "max_rss_kb": 0,
+    })
+    totals["runs"] += 1
+    totals["failures"] += 1 if record["return_code"] != 0 else 0
+    totals["timeouts"] += 1 if record["return_code"] == RETURN_CODE_TIMEOUT else 0
+    totals["resource_limit_kills"] += 1 if record["return_code"] == RETURN_CODE_RESOURCE_LIMIT else 0
+    totals["queue_wait_seconds"] += record["queue_wait_seconds"]
+    totals["wall_seconds"] += record["run_seconds"]
+    for field in _USAGE_FIELDS:
+        totals[field] += record.get(field, 0.0)
+    totals["max_rss_kb"] = max(totals["max_rss_kb"], record.get("max_rss_kb") or 0)
+
+
+def get_subprocess_totals() -> Dict[str, Dict[str, Any]]:
+    """Returns cumulative per-tool counters since startup (runs, failures, timeouts, limit kills, seconds, peak RSS)."""
+    return {
+        tool: {name: round(value, 3) if isinstance(value, float) else value for name, value in totals.items()}
+        for tool, totals in _process_totals.items()
+    }
 
 
 def check_command_availability(command_name: str) -> bool:
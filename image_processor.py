@@ -1,13 +1,51 @@
 # image_processor.py - Handles image-related operations like encoding
 
 import base64
+import importlib.util
 import logging
+import struct
 from pathlib import Path
 from typing import Tuple, Optional
 
 logger = logging.getLogger(__name__)
 
-def encode_image_to_base64(image_path: Path) -> Tuple[Optional[str], Optional[str]]:
+# WebP page encoding needs the optional Pillow package (pdftoppm cannot write WebP)
+WEBP_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+DEFAULT_IMAGE_MIME_TYPE = "image/png"
+
+# Sizes of the DIB headers that follow the 14-byte BMP file header (CORE, INFO, V2-V5)
+BMP_DIB_HEADER_SIZES = (12, 40, 52, 56, 108, 124)
+
+
+def is_bmp_header(head: bytes, file_size: int) -> bool:
+    """
+    True if `head` starts a BMP file of `file_size` bytes: "BM", the same file size at
+    bytes 2-6 and a known DIB header size at offset 14. "BM" alone also starts text.
+    """
+    if len(head) < 18 or not head.startswith(b"BM"):
+        return False
+    declared_size, = struct.unpack_from("<I", head, 2)
+    dib_header_size, = struct.unpack_from("<I", head, 14)
+    return declared_size == file_size and dib_header_size in BMP_DIB_HEADER_SIZES
+
+
+def detect_image_mime_type(image_bytes: bytes) -> Optional[str]:
+    """Returns the MIME type of PNG, JPEG, GIF, WebP or BMP data from its magic bytes, else None."""
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if is_bmp_header(image_bytes, len(image_bytes)):
+        return "image/bmp"
+    return None
+
+
+def encode_image_to_base64(image_path: Path) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """
     Reads an image file and returns its base64 encoded representation.
 
@@ -18,6 +56,8 @@ def encode_image_to_base64(image_path: Path) -> Tuple[Optional[str], Optional[st
         A tuple containing:
             - base64_encoded_string (Optional[str]): The base64 encoded image data (UTF-8 string),
                                                       or None if an error occurred.
+            - mime_type (Optional[str]): The image's MIME type detected from its content
+                                         (image/png if unrecognised), None if an error occurred.
             - error_message (Optional[str]): An error message if reading or encoding failed,
                                              None otherwise.
     """
@@ -27,6 +67,10 @@ def encode_image_to_base64(image_path: Path) -> Tuple[Optional[str], Optional[st
     try:
         # Read the image file as bytes
         image_bytes = image_path.read_bytes()
+        mime_type = detect_image_mime_type(image_bytes)
+        if mime_type is None:
+            logger.warning(f"Could not detect the image type of '{image_path.name}'; sending it as {DEFAULT_IMAGE_MIME_TYPE}.")
+            mime_type = DEFAULT_IMAGE_MIME_TYPE
 
         # Encode the bytes using base64
         base64_bytes = base64.b64encode(image_bytes)
@@ -34,23 +78,80 @@ def encode_image_to_base64(image_path: Path) -> Tuple[Optional[str], Optional[st
         # Decode the base64 bytes into a UTF-8 string
         base64_string = base64_bytes.decode('utf-8')
 
-        logger.debug(f"{description} successful.")
-        return base64_string, None
+        logger.debug(f"{description} successful ({mime_type}).")
+        return base64_string, mime_type, None
 
     except FileNotFoundError:
         error_msg = f"Image file not found for encoding: {image_path}"
         logger.error(error_msg)
-        return None, error_msg
+        return None, None, error_msg
     except OSError as e:
         # Catch other potential file system errors (permissions, etc.)
         error_msg = f"OS error reading image file '{image_path}': {e}"
         logger.error(error_msg, exc_info=True) # Include stack trace for OS errors
-        return None, error_msg
+        return None, None, error_msg
     except Exception as e:
         # Catch any other unexpected errors
         error_msg = f"Unexpected error during image encoding for '{image_path}': {e}"
         logger.error(error_msg, exc_info=True)
+        return None, None, error_msg
+
+
+def convert_image_to_webp(image_path: Path, quality: int) -> Tuple[Optional[Path], Optional[str]]:
+    """
+    Re-encodes an image as lossy WebP next to the original (which is deleted on success).
+    Requires Pillow; CPU bound, so call it from a worker thread.
+
+    Returns:
+        (webp_path, None) on success, or (None, error_message) on failure.
+    """
+    if not WEBP_AVAILABLE:
+        return None, "WebP encoding requires the Pillow package."
+    from PIL import Image # Optional dependency, imported only when WebP is used
+
+    webp_path = image_path.with_suffix(".webp")
+    try:
+        with Image.open(image_path) as img:
+            img.save(webp_path, format="WEBP", quality=quality)
+    except Exception as e:
+        webp_path.unlink(missing_ok=True)
+        error_msg = f"WebP encoding failed for '{image_path.name}': {e}"
+        logger.error(error_msg)
         return None, error_msg
+    image_path.unlink(missing_ok=True)
+    return webp_path, None
+
+def read_image_dimensions(image_path: Path) -> Optional[Tuple[int, int]]:
+    """
+    Reads (width, height) in pixels from a PNG, JPEG or GIF header without decoding the image.
+    Returns None for other formats or unreadable files.
+    """
+    try:
+        with open(image_path, "rb") as f:
+            head = f.read(32)
+            if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+                return struct.unpack(">II", head[16:24])
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                return struct.unpack("<HH", head[6:10])
+            if head.startswith(b"\xff\xd8"):
+                # Walk the JPEG segments up to the first start-of-frame marker
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return None
+                    length_bytes = f.read(2)
+                    if len(length_bytes) < 2:
+                        return None
+                    (length,) = struct.unpack(">H", length_bytes)
+                    if marker[1] in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                        height, width = struct.unpack(">xHH", f.read(5))
+                        return width, height
+                    f.seek(length - 2, 1)
+    except (OSError, struct.error) as e:
+        logger.debug(f"Could not read image dimensions of '{image_path}': {e}")
+    return None
+
 
 # Example Usage (optional)
 if __name__ == "__main__":
@@ -78,10 +179,10 @@ if __name__ == "__main__":
     print(f"Created dummy image: {dummy_image_path}")
 
     print("\nTesting image encoding...")
-    encoded_data, error = encode_image_to_base64(dummy_image_path)
+    encoded_data, mime_type, error = encode_image_to_base64(dummy_image_path)
 
     if encoded_data:
-        print(f"Encoding successful!")
+        print(f"Encoding successful! MIME type: {mime_type}")
         print(f"Base64 Data (first 60 chars): {encoded_data[:60]}...")
         print(f"Expected start: iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAACklEQVR4nGMAAQAABQABDQ...") # Check against known good encoding
         # Verify decoding (optional)
@@ -95,7 +196,7 @@ if __name__ == "__main__":
 
     print("\nTesting with non-existent file:")
     non_existent_path = temp_dir / "not_real.png"
-    encoded_data, error = encode_image_to_base64(non_existent_path)
+    encoded_data, _, error = encode_image_to_base64(non_existent_path)
     if error:
         print(f"Encoding failed as expected: {error}")
     else:
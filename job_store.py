@@ -2,12 +2,13 @@
 
 import logging
 import threading
+from datetime import datetime, timedelta
 from abc import ABC, abstractmethod
 from typing import Dict, Optional, List, Tuple
 from pathlib import Path
 
 # Import necessary models
-from models import Job, JobStatus, AggregatedResult, JobError, ActiveJobSummary
+from models import Job, JobStatus, AggregatedResult, JobError, ActiveJobSummary, NamedPrompt
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +22,7 @@ class BaseJobStore(ABC):
 
     @abstractmethod
     # Add use_meta_intelligence parameter
-    def create_job(self, document_name: str, input_file_path: Path, job_dir: Path, user_prompt: str, output_format: str, use_meta_intelligence: bool, llm_api_key: str) -> Job:
+    def create_job(self, document_name: str, input_file_path: Path, job_dir: Path, user_prompt: str, output_format: str, use_meta_intelligence: bool, llm_api_key: str, render_profile: Optional[str] = None, page_timeout: Optional[float] = None, deadline: Optional[float] = None, prompts: Optional[List[NamedPrompt]] = None) -> Job:
         """Creates a new job record and returns the initial Job object."""
         pass
 
@@ -46,8 +47,8 @@ class BaseJobStore(ABC):
         pass
 
     @abstractmethod
-    def get_active_jobs(self, limit: int = 50) -> List[ActiveJobSummary]:
-        """Retrieves a summary list of recent or active jobs."""
+    def get_active_jobs(self, limit: int = 50, llm_api_key: Optional[str] = None) -> List[ActiveJobSummary]:
+        """Retrieves a summary list of recent or active jobs, optionally only those submitted with llm_api_key."""
         pass
 
     @abstractmethod
@@ -55,6 +56,11 @@ class BaseJobStore(ABC):
         """Returns the count of jobs not in a final state (Completed/Error)."""
         pass
 
+    @abstractmethod
+    def prune_finished_jobs(self, max_age_seconds: int) -> int:
+        """Removes jobs in a final state that completed more than max_age_seconds ago. Returns the count removed."""
+        pass
+
     @abstractmethod
     def cleanup_job_data(self, job_id: str):
         """Perform any necessary cleanup for a job's stored data (optional)."""
@@ -77,7 +83,7 @@ class InMemoryJobStore(BaseJobStore):
         logger.info("Initialized InMemoryJobStore.")
 
     # Add use_meta_intelligence parameter
-    def create_job(self, document_name: str, input_file_path: Path, job_dir: Path, user_prompt: str, output_format: str, use_meta_intelligence: bool, llm_api_key: str) -> Job:
+    def create_job(self, document_name: str, input_file_path: Path, job_dir: Path, user_prompt: str, output_format: str, use_meta_intelligence: bool, llm_api_key: str, render_profile: Optional[str] = None, page_timeout: Optional[float] = None, deadline: Optional[float] = None, prompts: Optional[List[NamedPrompt]] = None) -> Job:
         """Creates a new job record in the in-memory dictionary."""
         import uuid # Import uuid here as it's only needed for job creation
         job_id = str(uuid.uuid4())
@@ -90,6 +96,10 @@ class InMemoryJobStore(BaseJobStore):
             input_file_path=str(input_file_path),
             job_dir=str(job_dir),
             llm_api_key=llm_api_key,
+            render_profile=render_profile,
+            page_timeout=page_timeout,
+            deadline=deadline,
+            prompts=prompts,
             status=JobStatus.CREATED
         )
         with self._lock:
@@ -147,7 +157,7 @@ class InMemoryJobStore(BaseJobStore):
                 logger.error(f"Failed to set results for non-existent job {job_id}.")
                 return False
 
-    def get_active_jobs(self, limit: int = 50) -> List[ActiveJobSummary]:
+    def get_active_jobs(self, limit: int = 50, llm_api_key: Optional[str] = None) -> List[ActiveJobSummary]:
         """Retrieves a summary list of recent/active jobs from memory."""
         summaries = []
         with self._lock:
@@ -157,6 +167,8 @@ class InMemoryJobStore(BaseJobStore):
             for job in sorted_jobs:
                 if count >= limit:
                     break
+                if llm_api_key is not None and job.llm_api_key != llm_api_key:
+                    continue # Only list jobs submitted with the caller's key
                 # Create the summary object
                 summary = ActiveJobSummary(
                     job_id=job.job_id,
@@ -182,6 +194,21 @@ class InMemoryJobStore(BaseJobStore):
         logger.debug(f"Counted {count} active (non-final state) jobs.")
         return count
 
+    def prune_finished_jobs(self, max_age_seconds: int) -> int:
+        """Removes finished jobs older than max_age_seconds so memory does not grow without bound."""
+        cutoff = (datetime.now() - timedelta(seconds=max_age_seconds)).isoformat()
+        final_states = {JobStatus.COMPLETED, JobStatus.ERROR, JobStatus.CANCELLED}
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.status in final_states and (job.completed_at or job.updated_at or job.created_at) < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        if expired:
+            logger.info(f"Pruned {len(expired)} finished job(s) older than {max_age_seconds}s from memory.")
+        return len(expired)
+
     def cleanup_job_data(self, job_id: str):
         """Removes a job entry from the in-memory store."""
         # In a real scenario, you might implement TTL or periodic cleanup.
@@ -0,0 +1,323 @@
+# libreoffice_pool.py - Pool of warm LibreOffice instances with isolated user profiles
+
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from models import AppSettings
+from external_commands import run_subprocess_async, RETURN_CODE_RESOURCE_LIMIT
+from process_sandbox import ProcessSandbox, create_sandbox
+
+logger = logging.getLogger(__name__)
+
+# Pool modes
+POOL_MODE_LISTENER = "listener" # Pre-started soffice listeners driven over a UNO socket
+POOL_MODE_CLI = "cli"           # One --convert-to process per document, but with a warm per-instance profile
+
+# Exit codes of the UNO client script
+UNO_EXIT_CONNECT_FAILED = 2
+UNO_EXIT_LOAD_FAILED = 3
+
+# Small UNO client run with the interpreter that ships python3-uno (usually the
+# system python, not the one running this app). Usage:
+#   <python> -c SCRIPT <port> --probe
+#   <python> -c SCRIPT <port> <input_path> <output_pdf_path>
+_UNO_CLIENT_SCRIPT = r'''
+import sys
+import uno
+from com.sun.star.beans import PropertyValue
+from com.sun.star.connection import NoConnectException
+
+def prop(name, value):
+    p = PropertyValue()
+    p.Name = name
+    p.Value = value
+    return p
+
+port = sys.argv[1]
+local = uno.getComponentContext()
+resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+try:
+    ctx = resolver.resolve("uno:socket,host=127.0.0.1,port=%s;urp;StarOffice.ComponentContext" % port)
+except NoConnectException as e:
+    sys.stderr.write("Could not connect to LibreOffice listener: %s" % e)
+    sys.exit(2)
+if sys.argv[2] == "--probe":
+    sys.exit(0)
+
+src, dst = sys.argv[2], sys.argv[3]
+desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(src), "_blank", 0, (prop("Hidden", True), prop("ReadOnly", True)))
+if doc is None:
+    sys.stderr.write("Error: source file could not be loaded")
+    sys.exit(3)
+try:
+    if doc.supportsService("com.sun.star.sheet.SpreadsheetDocument"):
+        export_filter = "calc_pdf_Export"
+    elif doc.supportsService("com.sun.star.presentation.PresentationDocument"):
+        export_filter = "impress_pdf_Export"
+    elif doc.supportsService("com.sun.star.drawing.DrawingDocument"):
+        export_filter = "draw_pdf_Export"
+    else:
+        export_filter = "writer_pdf_Export"
+    doc.storeToURL(uno.systemPathToFileUrl(dst), (prop("FilterName", export_filter),))
+finally:
+    doc.close(True)
+'''
+
+
+class OfficeInstance:
+    """One pool slot: a dedicated LibreOffice user profile and, in listener mode, a running soffice."""
+
+    def __init__(self, index: int, profile_dir: Path, port: int):
+        self.index = index
+        self.profile_dir = profile_dir
+        self.port = port
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.sandbox: Optional[ProcessSandbox] = None # Resource limits of the running listener
+        self.conversions = 0
+        self.busy = False
+        self.needs_recycle = False
+
+    @property
+    def profile_url(self) -> str:
+        return self.profile_dir.resolve().as_uri()
+
+    @property
+    def listener_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+
+class LibreOfficePool:
+    """
+    Fixed-size pool of LibreOffice instances, each with its own -env:UserInstallation
+    profile so concurrent conversions never contend for the default profile lock.
+
+    In listener mode every instance is a pre-started headless soffice accepting
+    conversion requests on a local UNO socket, which avoids the office startup cost
+    per document. If no UNO-capable Python is available the pool falls back to CLI
+    mode: one `--convert-to` process per document, still with a warm, isolated profile.
+    Instances are recycled after `recycle_after` conversions or when they crash.
+    """
+
+    def __init__(self, config: AppSettings):
+        self.config = config
+        self.size = max(1, config.libreoffice_pool_size)
+        self.recycle_after = max(1, config.libreoffice_recycle_after)
+        self.mode = POOL_MODE_CLI
+        self._base_dir = Path(config.temp_dir_base) / "libreoffice_profiles"
+        self._instances: List[OfficeInstance] = [
+            OfficeInstance(i, self._base_dir / f"instance_{i}", config.libreoffice_pool_base_port + i)
+            for i in range(self.size)
+        ]
+        self._idle: "asyncio.Queue[OfficeInstance]" = asyncio.Queue()
+        self._started = False
+        self.total_conversions = 0
+        self.total_recycles = 0
+
+    # --- Lifecycle ---
+
+    async def start(self) -> None:
+        """Prepares profiles and, when UNO is available, starts the listeners."""
+        if self._started:
+            return
+        self._started = True
+        if await self._uno_available():
+            self.mode = POOL_MODE_LISTENER
+        logger.info(f"Starting LibreOffice pool: {self.size} instance(s), mode={self.mode}, recycle after {self.recycle_after} conversion(s).")
+        for instance in self._instances:
+            instance.profile_dir.mkdir(parents=True, exist_ok=True)
+            if self.mode == POOL_MODE_LISTENER:
+                await self._start_listener(instance)
+            self._idle.put_nowait(instance)
+
+    async def stop(self) -> None:
+        """Terminates all listeners. Profiles are left on disk for the next start."""
+        for instance in self._instances:
+            await self._stop_listener(instance)
+        logger.info("LibreOffice pool stopped.")
+
+    async def _uno_available(self) -> bool:
+        if not shutil.which(self.config.libreoffice_uno_python):
+            logger.info(f"LibreOffice pool: '{self.config.libreoffice_uno_python}' not found; using CLI mode.")
+            return False
+        returncode = await self._probe([self.config.libreoffice_uno_python, "-c", "import uno"])
+        if returncode != 0:
+            logger.info(f"LibreOffice pool: '{self.config.libreoffice_uno_python}' cannot import uno (python3-uno); using CLI mode.")
+        return returncode == 0
+
+    @staticmethod
+    async def _probe(cmd: List[str]) -> int:
+        """Runs a short check command quietly (failures are expected) and returns its exit code."""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+            )
+            return await process.wait()
+        except OSError:
+            return -1
+
+    async def _start_listener(self, instance: OfficeInstance) -> None:
+        cmd = [
+            self.config.libreoffice_command,
+            "--headless", "--invisible", "--norestore", "--nologo", "--nodefault",
+            f"-env:UserInstallation={instance.profile_url}",
+            f"--accept=socket,host=127.0.0.1,port={instance.port};urp;StarOffice.ComponentContext",
+        ]
+        # Memory limit and priority only: a CPU-time limit would accumulate over the listener's lifetime
+        instance.sandbox = create_sandbox(os.path.basename(self.config.libreoffice_command), long_lived=True)
+        try:
+            instance.process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+                start_new_session=True, # Own process group so soffice.bin children die with it
+                preexec_fn=instance.sandbox.preexec if instance.sandbox is not None else None
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f"LibreOffice pool: failed to start instance {instance.index}: {e}")
+            instance.process = None
+            await self._release_sandbox(instance)
+            return
+
+        deadline = time.monotonic() + self.config.libreoffice_startup_timeout
+        while time.monotonic() < deadline:
+            if not instance.listener_alive:
+                break
+            returncode = await self._probe(
+                [self.config.libreoffice_uno_python, "-c", _UNO_CLIENT_SCRIPT, str(instance.port), "--probe"]
+            )
+            if returncode == 0:
+                logger.info(f"LibreOffice pool: instance {instance.index} listening on port {instance.port}.")
+                return
+            await asyncio.sleep(0.5)
+        logger.error(f"LibreOffice pool: instance {instance.index} did not become ready; it will be restarted on next use.")
+        await self._stop_listener(instance)
+
+    async def _stop_listener(self, instance: OfficeInstance) -> None:
+        process = instance.process
+        instance.process = None
+        try:
+            await self._stop_process(process)
+        finally:
+            await self._release_sandbox(instance)
+
+    @staticmethod
+    async def _release_sandbox(instance: OfficeInstance) -> None:
+        sandbox, instance.sandbox = instance.sandbox, None
+        if sandbox is not None:
+            await asyncio.to_thread(sandbox.cleanup)
+
+    @staticmethod
+    async def _stop_process(process: Optional[asyncio.subprocess.Process]) -> None:
+        if process is None or process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            await asyncio.wait_for(process.wait(), timeout=10)
+        except (ProcessLookupError, PermissionError):
+            pass
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    async def _recycle(self, instance: OfficeInstance) -> None:
+        """Restarts an instance with a fresh profile."""
+        self.total_recycles += 1
+        logger.info(f"LibreOffice pool: recycling instance {instance.index} after {instance.conversions} conversion(s).")
+        await self._stop_listener(instance)
+        shutil.rmtree(instance.profile_dir, ignore_errors=True)
+        instance.profile_dir.mkdir(parents=True, exist_ok=True)
+        instance.conversions = 0
+        instance.needs_recycle = False
+        if self.mode == POOL_MODE_LISTENER:
+            await self._start_listener(instance)
+
+    # --- Usage ---
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[OfficeInstance]:
+        """
+        Waits for an idle instance and yields it; it is recycled on release if needed,
+        always when the caller was cancelled or raised while holding it.
+        """
+        if not self._started:
+            await self.start()
+        instance = await self._idle.get()
+        instance.busy = True
+        try:
+            if self.mode == POOL_MODE_LISTENER and not instance.listener_alive:
+                logger.warning(f"LibreOffice pool: instance {instance.index} is not running; restarting it.")
+                await self._recycle(instance)
+            yield instance
+        except BaseException:
+            # Cancelled or failed mid-conversion: the listener may still be busy with the
+            # document or in an unknown state, so restart it before anyone else gets it
+            instance.needs_recycle = True
+            raise
+        finally:
+            instance.conversions += 1
+            self.total_conversions += 1
+            try:
+                if instance.needs_recycle or instance.conversions >= self.recycle_after:
+                    await self._recycle(instance)
+            finally:
+                instance.busy = False
+                self._idle.put_nowait(instance)
+
+    async def convert_via_listener(self, instance: OfficeInstance, input_path: Path, output_pdf_path: Path):
+        """
+        Converts a document through an instance's listener.
+
+        Returns:
+            (returncode, stdout, stderr) of the UNO client, as from run_subprocess_async.
+        """
+        returncode, stdout, stderr = await run_subprocess_async(
+            [self.config.libreoffice_uno_python, "-c", _UNO_CLIENT_SCRIPT,
+             str(instance.port), str(input_path.resolve()), str(output_pdf_path.resolve())],
+            f"LibreOffice pooled conversion for '{input_path.name}' (instance {instance.index})"
+        )
+        if returncode not in (0, UNO_EXIT_LOAD_FAILED):
+            # Connection lost or office crashed mid-conversion: restart this instance
+            instance.needs_recycle = True
+            if instance.sandbox is not None:
+                listener_returncode = instance.process.returncode if instance.process is not None else None
+                limit_reason = instance.sandbox.limit_exceeded(listener_returncode or 0)
+                if limit_reason:
+                    logger.error(f"LibreOffice pool: instance {instance.index} {limit_reason} while converting '{input_path.name}'.")
+                    return RETURN_CODE_RESOURCE_LIMIT, stdout, f"{os.path.basename(self.config.libreoffice_command)} {limit_reason}."
+        return returncode, stdout, stderr
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot for /health."""
+        return {
+            "mode": self.mode,
+            "size": self.size,
+            "busy": sum(1 for i in self._instances if i.busy),
+            "listeners_alive": sum(1 for i in self._instances if i.listener_alive) if self.mode == POOL_MODE_LISTENER else None,
+            "total_conversions": self.total_conversions,
+            "total_recycles": self.total_recycles,
+        }
+
+
+# --- Process-wide instance ---
+
+_pool: Optional[LibreOfficePool] = None
+
+
+def get_libreoffice_pool(config: AppSettings) -> Optional[LibreOfficePool]:
+    """Returns the shared pool, or None when pooling is disabled (LIBREOFFICE_POOL_SIZE=0)."""
+    global _pool
+    if config.libreoffice_pool_size <= 0:
+        return None
+    if _pool is None:
+        _pool = LibreOfficePool(config)
+    return _pool
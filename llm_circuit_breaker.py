@@ -0,0 +1,144 @@
+# llm_circuit_breaker.py - Circuit breaker per LLM base URL (closed / open / half-open)
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from models import AppSettings
+
+logger = logging.getLogger(__name__)
+
+BREAKER_CLOSED = "closed"       # Calls flow; outcomes are tracked over a rolling window
+BREAKER_OPEN = "open"           # Calls fail fast until the open period has passed
+BREAKER_HALF_OPEN = "half_open" # A single probe call decides whether to close or re-open
+
+
+class CircuitBreaker:
+    """
+    Trips when the share of failed calls (timeouts, connection errors, 5xx) within the
+    last `llm_breaker_window_seconds` reaches `llm_breaker_error_rate`, once at least
+    `llm_breaker_min_calls` calls were made in that window. While open, calls are
+    refused at once. After `llm_breaker_open_seconds` one probe call is let through:
+    its success closes the breaker, its failure re-opens it for another period. Calls
+    arriving while the probe is in flight wait for its outcome instead of failing.
+    An error rate of 0 disables the breaker. Must be used from the event loop thread.
+    """
+
+    def __init__(self, name: str, config: AppSettings):
+        self.name = name
+        self.error_rate_threshold = config.llm_breaker_error_rate
+        self.min_calls = max(1, config.llm_breaker_min_calls)
+        self.window_seconds = config.llm_breaker_window_seconds
+        self.open_seconds = config.llm_breaker_open_seconds
+        self._outcomes: Deque[Tuple[float, bool]] = deque() # (monotonic time, failed)
+        self._state = BREAKER_CLOSED
+        self._opened_at = 0.0
+        self._probe_done: Optional[asyncio.Event] = None # Exists while a half-open probe is in flight
+        self.times_opened = 0
+        self.fast_failures = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == BREAKER_OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = BREAKER_HALF_OPEN
+            logger.info(f"Circuit breaker for {self.name} is half-open; probing with one request.")
+        return self._state
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker will admit a probe (0 unless it is open)."""
+        if self.state != BREAKER_OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    async def allow(self) -> Tuple[bool, bool]:
+        """
+        Asks to make one call. Returns (allowed, is_probe); pass is_probe back to
+        `record` or, if the call was abandoned, to `abandon`.
+        """
+        if self.error_rate_threshold <= 0:
+            return True, False
+        while self.state == BREAKER_HALF_OPEN and self._probe_done is not None:
+            await self._probe_done.wait()
+        state = self.state
+        if state == BREAKER_CLOSED:
+            return True, False
+        if state == BREAKER_HALF_OPEN:
+            self._probe_done = asyncio.Event()
+            return True, True
+        self.fast_failures += 1
+        return False, False
+
+    def record(self, failed: bool, is_probe: bool = False) -> None:
+        """Records the outcome of an allowed call."""
+        now = time.monotonic()
+        if is_probe:
+            self._end_probe()
+            if failed:
+                self._open(now, "probe request failed")
+            else:
+                self._state = BREAKER_CLOSED
+                self._outcomes.clear()
+                logger.info(f"Circuit breaker for {self.name} closed; probe request succeeded.")
+            return
+        if self._state != BREAKER_CLOSED:
+            return # Calls started before the breaker opened say nothing about recovery
+        self._outcomes.append((now, failed))
+        self._trim(now)
+        if len(self._outcomes) >= self.min_calls and self.error_rate() >= self.error_rate_threshold > 0:
+            self._open(now, f"error rate {self.error_rate():.0%} over {len(self._outcomes)} calls")
+
+    def abandon(self, is_probe: bool) -> None:
+        """Releases an allowed call that was cancelled before it had an outcome."""
+        if is_probe:
+            self._end_probe() # Another waiting call becomes the probe
+
+    def _end_probe(self) -> None:
+        if self._probe_done is not None:
+            self._probe_done.set()
+            self._probe_done = None
+
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, failed in self._outcomes if failed) / len(self._outcomes)
+
+    def _trim(self, now: float) -> None:
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
+
+    def _open(self, now: float, reason: str) -> None:
+        self._state = BREAKER_OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self.times_opened += 1
+        logger.warning(f"Circuit breaker for {self.name} opened ({reason}); failing calls fast for {self.open_seconds:g}s.")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "calls_in_window": len(self._outcomes),
+            "retry_after_seconds": round(self.retry_after(), 1),
+            "times_opened": self.times_opened,
+            "fast_failures": self.fast_failures,
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(config: AppSettings) -> CircuitBreaker:
+    """Returns the shared breaker for config.resetdata_base_url."""
+    base_url = str(config.resetdata_base_url)
+    breaker = _breakers.get(base_url)
+    if breaker is None:
+        breaker = _breakers[base_url] = CircuitBreaker(base_url, config)
+    return breaker
+
+
+def get_circuit_breaker_stats() -> Dict[str, Dict[str, Any]]:
+    """Breaker state per base URL (for /health)."""
+    return {base_url: breaker.stats() for base_url, breaker in _breakers.items()}
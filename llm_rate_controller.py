@@ -0,0 +1,239 @@
+# llm_rate_controller.py - Adaptive (AIMD) per-API-key concurrency and rate control for LLM calls
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+from models import AppSettings
+from api_security import fingerprint_api_key
+
+logger = logging.getLogger(__name__)
+
+# Multiplicative decrease applied to the limit on a 429/503
+THROTTLE_DECREASE_FACTOR = 0.5
+# Gentler decrease applied when latency rises well above its baseline
+LATENCY_DECREASE_FACTOR = 0.9
+# Back-off used when a 429/503 carries no Retry-After header
+DEFAULT_RETRY_AFTER_SECONDS = 2.0
+# Token buckets allow bursts of this many seconds' worth of their per-minute rate
+BUCKET_BURST_SECONDS = 10.0
+# Initial guess of tokens per call, until real usage has been observed
+INITIAL_TOKENS_PER_CALL = 2000.0
+
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """
+    Returns the back-off requested by a response's 'retry-after-ms' or 'retry-after'
+    header (seconds or an HTTP date), or None if there is none. (Pure Function)
+    """
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class _TokenBucket:
+    """Per-minute rate ceiling; amounts larger than the burst are admitted when the bucket is full."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * BUCKET_BURST_SECONDS)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay_for(self, amount: float) -> float:
+        """Seconds until `amount` can be taken (0 if it can be taken now)."""
+        self._refill()
+        needed = min(amount, self.capacity)
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount # May go negative; later callers wait for the refill
+
+    def give_back(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class CallPermit:
+    """Handed out by KeyRateController.slot for one call; pass it back to on_success/on_throttled."""
+
+    def __init__(self, queue_wait_seconds: float, reserved_tokens: float):
+        self.queue_wait_seconds = queue_wait_seconds
+        self.reserved_tokens = reserved_tokens
+        self.started = time.monotonic()
+
+
+class KeyRateController:
+    """
+    Adaptive limit on concurrent LLM calls for one API key.
+
+    The limit grows additively (about +1 per round of successful calls) while call
+    latency stays within `latency_tolerance` times its observed baseline, shrinks by
+    LATENCY_DECREASE_FACTOR when latency degrades and by THROTTLE_DECREASE_FACTOR on a
+    429/503, at most once per round trip. After a 429/503 no new call starts until its
+    Retry-After has passed. Optional requests-per-minute and tokens-per-minute ceilings
+    are enforced with token buckets. All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, config: AppSettings):
+        self.max_limit = max(1, config.llm_max_concurrency_per_key)
+        self.limit = float(min(max(1, config.llm_initial_concurrency_per_key), self.max_limit))
+        self.latency_tolerance = max(1.0, config.llm_latency_tolerance)
+        self.in_flight = 0
+        self._rpm = _TokenBucket(config.llm_rpm_limit) if config.llm_rpm_limit > 0 else None
+        self._tpm = _TokenBucket(config.llm_tpm_limit) if config.llm_tpm_limit > 0 else None
+        self._tokens_per_call = INITIAL_TOKENS_PER_CALL
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._baseline_latency: Optional[float] = None
+        self._last_latency = 0.0
+        self._changed = asyncio.Condition()
+        self.last_used = time.monotonic()
+        self.calls = 0
+        self.throttled = 0
+
+    def _admission_delay(self) -> Optional[float]:
+        """0 if a call may start now, seconds to wait for a back-off/bucket, or None to wait for a free slot."""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        delays = [bucket.delay_for(amount) for bucket, amount in
+                  ((self._rpm, 1.0), (self._tpm, self._tokens_per_call)) if bucket is not None]
+        return max(delays, default=0.0)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[CallPermit]:
+        """Waits until a call may start under the current limit and yields its CallPermit."""
+        wait_start = time.monotonic()
+        async with self._changed:
+            while True:
+                delay = self._admission_delay()
+                if delay == 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+            reserved_tokens = self._tokens_per_call
+            if self._rpm is not None:
+                self._rpm.take(1.0)
+            if self._tpm is not None:
+                self._tpm.take(reserved_tokens)
+        self.calls += 1
+        self.last_used = time.monotonic()
+        try:
+            yield CallPermit(self.last_used - wait_start, reserved_tokens)
+        finally:
+            self.in_flight -= 1
+            async with self._changed:
+                self._changed.notify_all()
+
+    def on_success(self, permit: CallPermit, total_tokens: Optional[int] = None) -> None:
+        """Records a successful call: adjusts the limit from its latency and the TPM estimate from its usage."""
+        latency = time.monotonic() - permit.started
+        self._last_latency = latency
+        if total_tokens:
+            if self._tpm is not None:
+                self._tpm.take(total_tokens - permit.reserved_tokens) # Correct the reservation made at admission
+            self._tokens_per_call = 0.8 * self._tokens_per_call + 0.2 * total_tokens
+        baseline = self._baseline_latency
+        # Baseline tracks the fastest recent calls, drifting up slowly so it can follow the upstream
+        self._baseline_latency = latency if baseline is None else min(baseline * 1.02, max(latency, baseline * 0.5))
+        if baseline is not None and latency > baseline * self.latency_tolerance:
+            self._decrease(LATENCY_DECREASE_FACTOR, f"latency {latency:.1f}s vs baseline {baseline:.1f}s")
+        elif self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    def on_throttled(self, permit: CallPermit, status_code: int, retry_after: Optional[float]) -> float:
+        """Records a 429/503: halves the limit and pauses new calls. Returns the back-off in seconds."""
+        self.throttled += 1
+        if self._tpm is not None:
+            self._tpm.give_back(permit.reserved_tokens) # Rejected calls consume no tokens
+        backoff = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER_SECONDS
+        self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+        self._decrease(THROTTLE_DECREASE_FACTOR, f"HTTP {status_code}, retry after {backoff:.1f}s")
+        return backoff
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        now = time.monotonic()
+        # Calls that were already in flight report the same congestion; react once per round trip
+        if now - self._last_decrease < max(self._last_latency, 1.0):
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(1.0, self.limit * factor)
+        logger.info(f"LLM concurrency limit lowered from {previous:.1f} to {self.limit:.1f} ({reason}).")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "backoff_remaining_seconds": round(max(0.0, self._blocked_until - time.monotonic()), 1),
+            "baseline_latency_seconds": round(self._baseline_latency, 2) if self._baseline_latency is not None else None,
+        }
+
+
+class RateControllerRegistry:
+    """One KeyRateController per API key, kept while the key is in use (idle ones expire with the client TTL)."""
+
+    def __init__(self):
+        self._controllers: Dict[str, KeyRateController] = {}
+
+    def get(self, llm_api_key: str, config: AppSettings) -> KeyRateController:
+        key_hash = fingerprint_api_key(llm_api_key)
+        controller = self._controllers.get(key_hash)
+        if controller is None:
+            self._evict_idle(config)
+            controller = self._controllers[key_hash] = KeyRateController(config)
+        return controller
+
+    def _evict_idle(self, config: AppSettings) -> None:
+        now = time.monotonic()
+        for key_hash, controller in list(self._controllers.items()):
+            if controller.in_flight == 0 and now - controller.last_used > config.llm_client_idle_ttl:
+                del self._controllers[key_hash]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-key snapshot for /health, keyed by a short prefix of the key's fingerprint."""
+        return {key_hash[:12]: controller.stats() for key_hash, controller in self._controllers.items()}
+
+
+_registry = RateControllerRegistry()
+
+
+def get_rate_controller(llm_api_key: str, config: AppSettings) -> KeyRateController:
+    """Returns the shared controller for this API key."""
+    return _registry.get(llm_api_key, config)
+
+
+def get_rate_controller_stats() -> Dict[str, Dict[str, Any]]:
+    return _registry.stats()
@@ -0,0 +1,97 @@
+# llm_retry.py - Error classification, jittered backoff and per-document retry budgets for LLM calls
+
+import asyncio
+import logging
+import random
+from typing import Optional, Tuple
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AuthenticationError, PermissionDeniedError
+
+from models import AppSettings
+
+logger = logging.getLogger(__name__)
+
+# Causes recorded as PageProcessingResult.final_error_cause
+CAUSE_TIMEOUT = "timeout"                   # The HTTP call exceeded llm_request_timeout
+CAUSE_CONNECTION = "connection_error"       # Connection refused/reset, DNS or TLS failure
+CAUSE_THROTTLED = "throttled"               # HTTP 429
+CAUSE_SERVER_ERROR = "server_error"         # HTTP 5xx, including 503
+CAUSE_EMPTY_CONTENT = "empty_content"       # HTTP 200 without any message content
+CAUSE_AUTHENTICATION = "authentication"     # HTTP 401/403
+CAUSE_CLIENT_ERROR = "client_error"         # Other HTTP 4xx: the request itself is wrong
+CAUSE_UNKNOWN = "unknown"
+CAUSE_CIRCUIT_OPEN = "circuit_open"         # Not called: the endpoint's circuit breaker is open
+CAUSE_PAGE_TIMEOUT = "page_timeout"         # The page exceeded its page timeout
+CAUSE_REQUEST_DEADLINE = "request_deadline" # The request deadline was reached first
+
+# Statuses retried besides 5xx: request timeout and conflict are transient by definition
+_RETRYABLE_CLIENT_STATUS_CODES = (408, 409)
+
+
+def classify_llm_error(error: BaseException) -> Tuple[str, bool]:
+    """
+    Maps an exception raised by an LLM call to (cause, retryable). (Pure Function)
+    Only failures that another attempt can plausibly fix are retryable.
+    """
+    if isinstance(error, APITimeoutError): # Subclass of APIConnectionError, so checked first
+        return CAUSE_TIMEOUT, True
+    if isinstance(error, APIConnectionError):
+        return CAUSE_CONNECTION, True
+    if isinstance(error, (AuthenticationError, PermissionDeniedError)):
+        return CAUSE_AUTHENTICATION, False
+    if isinstance(error, APIStatusError):
+        if error.status_code == 429:
+            return CAUSE_THROTTLED, True
+        if error.status_code >= 500:
+            return CAUSE_SERVER_ERROR, True
+        return CAUSE_CLIENT_ERROR, error.status_code in _RETRYABLE_CLIENT_STATUS_CODES
+    return CAUSE_UNKNOWN, False
+
+
+# Causes that say the endpoint itself is unhealthy (counted by the circuit breaker)
+ENDPOINT_FAILURE_CAUSES = (CAUSE_TIMEOUT, CAUSE_CONNECTION, CAUSE_SERVER_ERROR)
+
+
+def backoff_delay(retry_number: int, base_delay: float, max_delay: float) -> float:
+    """
+    "Full jitter" exponential backoff: a uniform delay between 0 and
+    min(max_delay, base_delay * 2^(retry_number - 1)), so that pages failing
+    together do not retry in lockstep.
+    """
+    ceiling = min(max_delay, base_delay * (2 ** max(0, retry_number - 1)))
+    return random.uniform(0, max(0.0, ceiling))
+
+
+class RetryBudget:
+    """
+    Caps the retries spent on one document: at most `max_retries` in total across its
+    pages, and none whose backoff would end after the request deadline (`deadline_at`,
+    event loop time). This keeps a failing upstream from multiplying the load a
+    document generates. Must be used from the event loop thread.
+    """
+
+    def __init__(self, max_retries: int, deadline_at: Optional[float] = None):
+        self.max_retries = max(0, max_retries)
+        self.deadline_at = deadline_at
+        self.used = 0
+        self.denied = 0
+
+    @classmethod
+    def for_document(cls, config: AppSettings, page_count: int, deadline_at: Optional[float] = None) -> "RetryBudget":
+        """Budget of llm_retry_budget_ratio retries per page, but at least llm_retry_budget_min."""
+        max_retries = max(config.llm_retry_budget_min, int(config.llm_retry_budget_ratio * max(0, page_count)))
+        return cls(max_retries, deadline_at)
+
+    def try_spend(self, delay: float) -> bool:
+        """Takes one retry from the budget if one is left and waiting `delay` seconds still meets the deadline."""
+        if self.used >= self.max_retries:
+            self.denied += 1
+            return False
+        if self.deadline_at is not None and asyncio.get_running_loop().time() + delay >= self.deadline_at:
+            self.denied += 1
+            return False
+        self.used += 1
+        return True
+
+    def stats(self) -> dict:
+        return {"max_retries": self.max_retries, "retries_used": self.used, "retries_denied": self.denied}
@@ -1,27 +1,51 @@
 # main_api.py - FastAPI application entry point for EveryPage Pure
 
+import asyncio
+import json
 import logging
+import math
 import os
 import time # <-- ADDED IMPORT
 import shutil
+import zipfile
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator
 
 from fastapi import (
-    FastAPI, File, UploadFile, Depends, HTTPException, status, BackgroundTasks, Request, Form
+    FastAPI, Depends, HTTPException, status, BackgroundTasks, Request, Query
 )
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect
 
 # Import modules created in previous steps
 from config_loader import load_app_config
 from models import (
-    AppSettings, HealthCheckResponse, AggregatedResult
+    AppSettings, HealthCheckResponse, AggregatedResult,
+    ScanResponse, JobStatusResponse, ActiveJobSummary, JobStatus, PageProcessingResult, RenderProfile,
+    BatchResult, NamedPrompt
 )
-from workflow_orchestrator import process_document_stateless
-from external_commands import check_command_availability
-from resetdata_ai_adapter import validate_resetdata_api_key
+from pydantic import TypeAdapter, ValidationError
+from workflow_orchestrator import process_document_stateless, process_document_workflow, get_cancellation_stats
+from job_store import InMemoryJobStore
+from document_converter import sniff_document_type, UnsupportedDocumentError
+from libreoffice_pool import get_libreoffice_pool
+from external_commands import (
+    check_command_availability, configure_subprocess_limits, get_subprocess_totals, ResourceLimitExceededError
+)
+from pdf_processor import get_render_concurrency
+from process_sandbox import ResourceLimits, configure_sandbox
+from resetdata_ai_adapter import validate_resetdata_api_key, close_resetdata_clients
+from api_security import get_key_validation_cache, KeyValidationUnavailableError
+from llm_rate_controller import get_rate_controller_stats
+from llm_circuit_breaker import get_circuit_breaker, get_circuit_breaker_stats, BREAKER_OPEN
+from admission_control import get_admission_controller, AdmissionRejectedError, AdmissionTicket
+from upload_receiver import (
+    receive_multipart_upload, receive_multipart_files, declared_body_size, get_upload_totals,
+    ReceivedUpload, UploadError, UploadTooLargeError
+)
+from batch_processor import expand_batch_uploads, run_batch, summarize_batch, BatchDocumentCallback, BatchLimitError
 
 # --- Configuration Loading & Basic Setup ---
 
@@ -51,7 +75,8 @@ logger.info(f"Logging configured at level: {log_level}")
 
 
 # --- Global Objects ---
-# Stateless API: no job store
+# /scan is stateless; the job store only backs the asynchronous /jobs endpoints
+job_store = InMemoryJobStore()
 
 # Create the FastAPI app instance
 app = FastAPI(
@@ -73,16 +98,35 @@ app.add_middleware(
 
 # --- ResetData Key Validation Dependency ---
 async def require_resetdata_key(request: Request) -> str:
-    """Extracts and validates the user's ResetData API key by calling ResetData once."""
+    """Extracts and validates the user's ResetData API key (cached per key for a short TTL)."""
     key = request.headers.get("x-resetdata-key") or request.query_params.get("resetdata_key")
     if not key:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing ResetData API key. Provide in header 'x-resetdata-key' or query 'resetdata_key'.")
-    ok, err = await validate_resetdata_api_key(key, config)
+    try:
+        ok, err = await get_key_validation_cache(config).validate(
+            key, lambda k: validate_resetdata_api_key(k, config)
+        )
+    except KeyValidationUnavailableError as e:
+        # Upstream trouble says nothing about the key; not cached, so the next request asks again
+        logger.warning(f"Key validation unavailable for key ...{key[-4:]}: {e}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
     if not ok:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=err or "Invalid ResetData API key.")
     return key
 
 
+async def require_llm_available() -> None:
+    """Refuses new documents with 503 while the ResetData circuit breaker is open."""
+    breaker = get_circuit_breaker(config)
+    if breaker.state == BREAKER_OPEN:
+        retry_after = max(1, int(breaker.retry_after() + 0.5))
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"ResetData is currently failing; new documents are not accepted. Retry in {retry_after}s.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
 # --- Static Files Mounting (for Web UI) ---
 # This will be done *after* API routes are defined below to avoid conflicts
 
@@ -106,9 +150,48 @@ async def startup_event():
     check_command_availability(config.pdftoppm_command)
     check_command_availability(config.pdfinfo_command)
 
+    # Enforce PROCESS_TIMEOUT and cap concurrent processes per tool
+    configure_subprocess_limits(
+        default_timeout=config.process_timeout,
+        tool_limits={
+            os.path.basename(config.libreoffice_command): config.libreoffice_max_concurrent,
+            os.path.basename(config.pdftoppm_command): get_render_concurrency(config),
+            os.path.basename(config.pdfinfo_command): config.pdfinfo_max_concurrent,
+        },
+    )
+
+    # Contain heavy conversions/renders so they cannot starve the rest of the pod
+    if config.subprocess_sandbox:
+        libreoffice_limits = ResourceLimits(config.libreoffice_memory_limit_mb, config.libreoffice_cpu_limit_seconds, config.libreoffice_nice)
+        poppler_limits = ResourceLimits(config.poppler_memory_limit_mb, config.poppler_cpu_limit_seconds, config.poppler_nice)
+        configure_sandbox(
+            {
+                os.path.basename(config.libreoffice_command): libreoffice_limits,
+                os.path.basename(config.pdftoppm_command): poppler_limits,
+                os.path.basename(config.pdfinfo_command): poppler_limits,
+            },
+            use_cgroups=config.subprocess_sandbox_cgroups,
+        )
+
+    # Pre-start warm LibreOffice instances so the first conversion does not pay startup
+    libreoffice_pool = get_libreoffice_pool(config)
+    if libreoffice_pool is not None and check_command_availability(config.libreoffice_command):
+        await libreoffice_pool.start()
+
     logger.info("Application startup complete.")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Tasks to perform when the application shuts down."""
+    logger.info("Application shutdown initiated.")
+    await close_resetdata_clients()
+    libreoffice_pool = get_libreoffice_pool(config)
+    if libreoffice_pool is not None:
+        await libreoffice_pool.stop()
+    logger.info("Application shutdown complete.")
+
+
 # --- API Endpoints ---
 
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
@@ -140,79 +223,579 @@ async def health_check(resetdata_key: str = Depends(require_resetdata_key)):
 
     # Using per-request API key for ResetData; report mode accordingly
     llm_status = "per_request"
-    active_jobs = 0
+    active_jobs = job_store.count_active_jobs()
+
+    libreoffice_pool = get_libreoffice_pool(config)
 
     return HealthCheckResponse(
         status=overall_status,
         active_jobs_count=active_jobs,
         dependencies=dependencies_status,
-        llm_status=llm_status
+        llm_status=llm_status,
+        libreoffice_pool=libreoffice_pool.stats() if libreoffice_pool is not None else None,
+        subprocesses=get_subprocess_totals(),
+        cancellations=get_cancellation_stats(),
+        llm_rate_limits=get_rate_controller_stats(),
+        llm_circuit_breakers=get_circuit_breaker_stats(),
+        admission=get_admission_controller(config).stats(),
+        uploads=get_upload_totals()
     )
 
-@app.post("/scan", response_model=AggregatedResult, tags=["Processing"])
-async def scan_document(
-    file: UploadFile = File(..., description="The document file to process (e.g., PDF, DOCX, ODT)."),
-    user_prompt: str = Form(..., description="The user-defined prompt to use for processing."),
-    output_format: str = Form("json", description="Desired output format ('json' or 'text')."),
-    use_meta_intelligence: str = Form("false", description="Whether to enable two-pass meta intelligence ('true' or 'false')."),
-    resetdata_key: str = Depends(require_resetdata_key)
-):
+def _validate_render_profile(render_profile: Optional[str]) -> Optional[str]:
+    """Normalizes an optional per-request render profile, raising HTTPException(400) if invalid."""
+    if not render_profile:
+        return None
+    try:
+        return RenderProfile.parse(render_profile).spec
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _validate_time_limits(page_timeout: Optional[float], deadline: Optional[float]) -> None:
+    """Rejects negative per-request page timeouts or deadlines with HTTPException(400)."""
+    for name, value in (("page_timeout", page_timeout), ("deadline", deadline)):
+        if value is not None and value < 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{name} must be 0 (disabled) or a positive number of seconds.")
+
+
+async def _admit_document(upload_bytes: int) -> AdmissionTicket:
     """
-    Accepts a document file and returns the final aggregated results synchronously (stateless).
+    Waits for admission control to accept a new document, raising HTTPException(503/429)
+    with a Retry-After header if the server stays over its memory budget or page queue limit.
     """
-    logger.info(f"Scan request received for file '{file.filename}' (Size: {file.size}, Type: {file.content_type}). ResetData Key: ...{resetdata_key[-4:]}. Prompt: '{user_prompt[:100]}...'")
+    try:
+        return await get_admission_controller(config).admit(upload_bytes)
+    except AdmissionRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
-    # Create a request-scoped directory within the base temp directory
-    req_id = f"req_{int(time.time() * 1000)}_{os.urandom(4).hex()}"
+
+def _create_request_dir(prefix: str = "req") -> Path:
+    """Creates a request-scoped directory (with an 'upload' subdirectory) under temp_dir_base, raising HTTPException(500) on failure."""
+    req_id = f"{prefix}_{int(time.time() * 1000)}_{os.urandom(4).hex()}"
     job_dir = Path(config.temp_dir_base) / req_id
-    upload_dir = job_dir / "upload"
     try:
-        upload_dir.mkdir(parents=True, exist_ok=True)
+        (job_dir / "upload").mkdir(parents=True, exist_ok=True)
         logger.debug(f"Created job directory: {job_dir}")
     except OSError as e:
         logger.error(f"Failed to create job directory '{job_dir}': {e}")
         raise HTTPException(status_code=500, detail="Failed to create temporary directory for processing.")
+    return job_dir
 
-    # Sanitize filename (optional, but good practice)
-    # Simple sanitization: replace spaces, remove unsafe chars. Improve as needed.
-    safe_filename = "".join(c if c.isalnum() or c in ['.', '-', '_'] else '_' for c in file.filename)
-    if not safe_filename: safe_filename = "uploaded_file" # Fallback
-    input_file_path = upload_dir / safe_filename
 
-    # Save the uploaded file
+async def _receive_upload(request: Request) -> Tuple[Path, Path, ReceivedUpload]:
+    """
+    Streams a multipart upload into a new request-scoped directory under temp_dir_base
+    (written once, hashed on the way, limited to config.max_upload_mb).
+
+    Returns:
+        (job_dir, input_file_path, upload). Raises HTTPException (400, 413, 415 or 500)
+        if the upload is malformed, too large, unsupported or cannot be saved.
+    """
+    job_dir = _create_request_dir()
+    upload_dir = job_dir / "upload"
     try:
-        with open(input_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logger.info(f"Saved uploaded file to: {input_file_path}")
+        upload = await receive_multipart_upload(request, upload_dir, max_bytes=config.max_upload_mb * 1024 * 1024)
+        logger.info(f"Saved uploaded file to: {upload.path}")
+    except UploadTooLargeError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except UploadError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ClientDisconnect:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(status_code=STATUS_CLIENT_CLOSED_REQUEST, detail="Client disconnected during upload.")
     except Exception as e:
-        logger.error(f"Failed to save uploaded file '{input_file_path}': {e}", exc_info=True)
+        logger.error(f"Failed to save upload into '{upload_dir}': {e}", exc_info=True)
         # Clean up job directory if save fails
         shutil.rmtree(job_dir, ignore_errors=True)
         raise HTTPException(status_code=500, detail=f"Could not save uploaded file: {e}")
+
+    # Reject unsupported content before any conversion/render process is spawned
+    try:
+        sniff_document_type(upload.path)
+    except UnsupportedDocumentError as e:
+        logger.warning(f"Rejected upload '{upload.filename}': {e}")
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e))
+
+    return job_dir, upload.path, upload
+
+
+def _form_number(fields: Dict[str, str], name: str) -> Optional[float]:
+    """An optional numeric form field (empty means unset), raising HTTPException(422) if it is not a finite number."""
+    value = (fields.get(name) or "").strip()
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number): # float() also accepts "nan" and "inf"
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Form field '{name}' must be a number.")
+    return number
+
+
+_NAMED_PROMPTS = TypeAdapter(List[NamedPrompt])
+
+
+def _named_prompts(fields: Dict[str, str]) -> Optional[List[NamedPrompt]]:
+    """
+    Parses the optional 'prompts' form field, a JSON array of {"name", "prompt", "output_format"}
+    objects, raising HTTPException(422) if it is invalid, empty, too long or repeats a name.
+    """
+    raw = (fields.get("prompts") or "").strip()
+    if not raw:
+        return None
+    try:
+        prompts = _NAMED_PROMPTS.validate_json(raw)
+    except ValidationError as e:
+        error = e.errors()[0]
+        location = ".".join(str(part) for part in error["loc"])
+        reason = f"{location}: {error['msg']}" if location else error["msg"]
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Form field 'prompts' must be a JSON array of {{\"name\", \"prompt\", \"output_format\"}} objects ({reason}).",
+        )
+    if not prompts or len(prompts) > config.max_prompts_per_request:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Form field 'prompts' must hold 1 to {config.max_prompts_per_request} prompts.")
+    names = [named.name for named in prompts]
+    if len(set(names)) != len(names):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Prompt names in 'prompts' must be unique.")
+    return prompts
+
+
+def _document_options(fields: Dict[str, str]) -> Dict[str, Any]:
+    """Validates the form fields shared by /scan, /scan/stream and /jobs (HTTPException 400/422 if invalid)."""
+    user_prompt = fields.get("user_prompt")
+    prompts = _named_prompts(fields)
+    if prompts is not None and user_prompt:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Give either 'user_prompt' or 'prompts', not both.")
+    if prompts is None and user_prompt is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Form field 'user_prompt' (or 'prompts') is required.")
+    page_timeout = _form_number(fields, "page_timeout")
+    deadline = _form_number(fields, "deadline")
+    _validate_time_limits(page_timeout, deadline)
+    return {
+        "user_prompt": user_prompt or "",
+        "prompts": prompts,
+        "output_format": fields.get("output_format") or "json",
+        "use_meta_intelligence": (fields.get("use_meta_intelligence") or "false").lower() == 'true',
+        "render_profile": _validate_render_profile(fields.get("render_profile")),
+        "page_timeout": page_timeout,
+        "deadline": deadline,
+    }
+
+
+def _discard_document(job_dir: Path, admission_ticket: AdmissionTicket) -> None:
+    shutil.rmtree(job_dir, ignore_errors=True)
+    admission_ticket.close()
+
+
+async def _accept_document(request: Request) -> Tuple[AdmissionTicket, Path, Path, ReceivedUpload, Dict[str, Any]]:
+    """
+    Admits, receives and validates an uploaded document.
+
+    Returns:
+        (admission_ticket, job_dir, input_file_path, upload, options). On any error the
+        ticket is closed and the job directory removed before the HTTPException propagates.
+    """
+    admission_ticket = await _admit_document(declared_body_size(request) or 0)
+    try:
+        job_dir, input_file_path, upload = await _receive_upload(request)
+    except BaseException:
+        admission_ticket.close()
+        raise
+    try:
+        options = _document_options(upload.fields)
+    except HTTPException:
+        _discard_document(job_dir, admission_ticket)
+        raise
+    return admission_ticket, job_dir, input_file_path, upload, options
+
+
+# Form fields of /scan, /scan/stream and /jobs: name -> (OpenAPI schema, description).
+# The body is parsed by hand (see _receive_upload), so it is documented through openapi_extra.
+_DOCUMENT_FORM_FIELDS: Dict[str, Tuple[Dict[str, Any], str]] = {
+    "file": ({"type": "string", "format": "binary"}, "The document file to process (e.g., PDF, DOCX, ODT)."),
+    "user_prompt": ({"type": "string"}, "The user-defined prompt to use for processing. Required unless 'prompts' is given."),
+    "prompts": ({"type": "string"}, 'Instead of user_prompt: a JSON array of named prompts, e.g. [{"name": "summary", "prompt": "...", "output_format": "text"}, {"name": "line_items", "prompt": "..."}]. Each page is rendered once and sent once per prompt; results are returned per name in prompt_results. At most MAX_PROMPTS_PER_REQUEST prompts.'),
+    "output_format": ({"type": "string", "default": "json"}, "Desired output format ('json' or 'text')."),
+    "use_meta_intelligence": ({"type": "string", "default": "false"}, "Whether to enable two-pass meta intelligence ('true' or 'false')."),
+    "render_profile": ({"type": "string"}, "Page render size: 'dpi:<n>', 'longest_side:<pixels>' or 'max_megapixels:<n>'. Defaults to the server's RENDER_PROFILE."),
+    "page_timeout": ({"type": "number"}, "Seconds one page may take once it is being worked on (render and LLM call). Defaults to the server's PAGE_TIMEOUT_SECONDS; 0 disables it."),
+    "deadline": ({"type": "number"}, "Seconds after which unfinished pages are cancelled and returned as 'error_timeout'. Defaults to the server's REQUEST_DEADLINE_SECONDS; 0 disables it."),
+}
+
+
+def _multipart_openapi(file_field: str = "file", **overrides: Tuple[Dict[str, Any], str]) -> Dict[str, Any]:
+    """
+    openapi_extra describing the multipart body of an upload endpoint; keyword arguments
+    add or replace fields. A `file_field` other than 'file' replaces the 'file' field.
+    """
+    fields = {**_DOCUMENT_FORM_FIELDS, **overrides}
+    if file_field != "file":
+        fields.pop("file")
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "required": [file_field],
+        "properties": {name: {**schema, "description": description} for name, (schema, description) in fields.items()},
+    }}}}}
+
+
+# How often a synchronous /scan checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 1.0
+# nginx's non-standard "client closed request"; the client never sees it, but access logs do
+STATUS_CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnectedError(Exception):
+    """Raised when the client of a synchronous request went away before its result was ready."""
+
+
+async def _run_while_connected(request: Request, coro: Any) -> Any:
+    """
+    Runs `coro` as a task and returns its result, polling the client connection meanwhile.
+    If the client disconnects first the task is cancelled (which stops its page tasks and
+    kills its commands) and ClientDisconnectedError is raised.
+    """
+    task = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnectedError()
     finally:
-        # Ensure the file pointer is closed
-        await file.close()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
 
 
+@app.post("/scan", response_model=AggregatedResult, tags=["Processing"], dependencies=[Depends(require_llm_available)],
+          openapi_extra=_multipart_openapi())
+async def scan_document(
+    request: Request,
+    resetdata_key: str = Depends(require_resetdata_key)
+):
+    """
+    Accepts a document file and returns the final aggregated results synchronously (stateless).
+    The multipart body is streamed straight into the request directory.
+    If the client disconnects before the result is ready, processing is cancelled.
+    """
+    logger.info(f"Scan request received (Content-Length: {declared_body_size(request)}). ResetData Key: ...{resetdata_key[-4:]}.")
+    admission_ticket, job_dir, input_file_path, upload, options = await _accept_document(request)
+    logger.info(f"Scanning '{upload.filename}' (Size: {upload.size_bytes}, Type: {upload.content_type}). Prompt: '{options['user_prompt'][:100]}...'")
+    deadline = options["deadline"]
+
     # Process synchronously (stateless) and return final result
     try:
-        result = await process_document_stateless(
+        result = await _run_while_connected(request, process_document_stateless(
             input_file_path=input_file_path,
-            user_prompt=user_prompt,
-            output_format=output_format,
-            use_meta_intelligence=(use_meta_intelligence.lower() == 'true'),
+            user_prompt=options["user_prompt"],
+            output_format=options["output_format"],
+            use_meta_intelligence=options["use_meta_intelligence"],
             config=config,
             llm_api_key=resetdata_key,
             job_dir=job_dir,
-        )
+            document_name=upload.filename,
+            render_profile=options["render_profile"],
+            page_timeout=options["page_timeout"],
+            deadline=deadline if deadline is not None else config.request_deadline_seconds,
+            admission_ticket=admission_ticket,
+            upload_stats=upload.stats(),
+            prompts=options["prompts"],
+        ))
         return result
+    except ClientDisconnectedError:
+        logger.warning(f"Client disconnected during scan of '{upload.filename}'; processing was cancelled.")
+        shutil.rmtree(job_dir, ignore_errors=True) # Normally already removed by the pipeline
+        return Response(status_code=STATUS_CLIENT_CLOSED_REQUEST)
+    except ResourceLimitExceededError as e:
+        logger.error(f"Stateless processing stopped by resource limits: {e}")
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
     except Exception as e:
         logger.error(f"Stateless processing failed: {e}", exc_info=True)
         shutil.rmtree(job_dir, ignore_errors=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        admission_ticket.close() # Normally already closed by the pipeline
+
+
+# --- Streaming Scan Endpoint ---
+
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+
+def _format_stream_event(event: str, data: Dict[str, Any], stream_format: str) -> str:
+    """Serializes one stream event as an NDJSON line or a Server-Sent Event."""
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, "data": data}) + "\n"
+
+
+@app.post("/scan/stream", tags=["Processing"], dependencies=[Depends(require_llm_available)],
+          openapi_extra=_multipart_openapi(
+              stream_format=({"type": "string", "default": "ndjson"}, "Stream encoding: 'ndjson' or 'sse' (Server-Sent Events)."),
+              ordered=({"type": "string", "default": "false"}, "If 'true', buffer pages so they are emitted in page order."),
+          ))
+async def scan_document_stream(
+    request: Request,
+    resetdata_key: str = Depends(require_resetdata_key)
+):
+    """
+    Like /scan, but streams a 'page' event for each PageProcessingResult as soon as it
+    completes, followed by a final 'summary' event carrying the processing_summary
+    (or an 'error' event if the document failed).
+    """
+    admission_ticket, job_dir, input_file_path, upload, options = await _accept_document(request)
+    stream_format = (upload.fields.get("stream_format") or "ndjson").lower()
+    if stream_format not in STREAM_MEDIA_TYPES:
+        _discard_document(job_dir, admission_ticket)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="stream_format must be 'ndjson' or 'sse'.")
+    keep_order = (upload.fields.get("ordered") or "false").lower() == 'true'
+    deadline = options["deadline"]
+    logger.info(f"Streaming scan request received for file '{upload.filename}' ({stream_format}, ordered={keep_order}). ResetData Key: ...{resetdata_key[-4:]}.")
+    events: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+
+    async def run_pipeline() -> None:
+        try:
+            result = await process_document_stateless(
+                input_file_path=input_file_path,
+                user_prompt=options["user_prompt"],
+                output_format=options["output_format"],
+                use_meta_intelligence=options["use_meta_intelligence"],
+                config=config,
+                llm_api_key=resetdata_key,
+                job_dir=job_dir,
+                document_name=upload.filename,
+                render_profile=options["render_profile"],
+                page_timeout=options["page_timeout"],
+                deadline=deadline if deadline is not None else config.request_deadline_seconds,
+                page_callback=lambda page: events.put_nowait(("page", page)),
+                admission_ticket=admission_ticket,
+                upload_stats=upload.stats(),
+                prompts=options["prompts"],
+            )
+            events.put_nowait(("summary", result))
+        except Exception as e:
+            logger.error(f"Streaming processing failed: {e}", exc_info=True)
+            events.put_nowait(("error", str(e)))
+
+    pipeline_task = asyncio.create_task(run_pipeline())
+
+    # With named prompts each page yields one result per prompt, ordered by page, then prompt
+    prompt_order = {named.name: position for position, named in enumerate(options["prompts"] or [])}
+    results_per_page = max(1, len(prompt_order))
+
+    async def event_stream() -> AsyncIterator[str]:
+        pending: Dict[Tuple[int, int], PageProcessingResult] = {} # Out-of-order pages held back when keep_order
+        next_key = (1, 0)
+        try:
+            while True:
+                kind, payload = await events.get()
+                if kind == "page":
+                    if not keep_order:
+                        yield _format_stream_event("page", payload.model_dump(), stream_format)
+                        continue
+                    pending[(payload.page_number, prompt_order.get(payload.prompt_name, 0))] = payload
+                    while next_key in pending:
+                        yield _format_stream_event("page", pending.pop(next_key).model_dump(), stream_format)
+                        page_number, position = next_key
+                        next_key = (page_number + 1, 0) if position + 1 == results_per_page else (page_number, position + 1)
+                elif kind == "summary":
+                    for key in sorted(pending):
+                        yield _format_stream_event("page", pending[key].model_dump(), stream_format)
+                    yield _format_stream_event("summary", {"job_id": payload.job_id, "processing_summary": payload.processing_summary}, stream_format)
+                    return
+                else:
+                    yield _format_stream_event("error", {"detail": payload}, stream_format)
+                    return
+        finally:
+            # Client went away (or we are done): stop any remaining page work
+            if not pipeline_task.done():
+                logger.warning(f"Stream for '{job_dir.name}' closed before completion; cancelling processing.")
+                pipeline_task.cancel()
+            admission_ticket.close()
+
+    return StreamingResponse(event_stream(), media_type=STREAM_MEDIA_TYPES[stream_format])
+
+
+# --- Batch Scan Endpoint ---
+
+BATCH_RESPONSE_FORMATS = ("json", "ndjson")
+
+
+@app.post("/scan/batch", response_model=BatchResult, tags=["Processing"], dependencies=[Depends(require_llm_available)],
+          openapi_extra=_multipart_openapi(
+              file_field="files",
+              files=({"type": "array", "items": {"type": "string", "format": "binary"}}, "The documents to process: any number of files, ZIP archives of documents, or both."),
+              response_format=({"type": "string", "default": "json"}, "'json' returns one BatchResult; 'ndjson' streams a 'document' event per document as soon as it finishes, then a 'summary' event."),
+              deadline=({"type": "number"}, "Seconds each document may take from when it starts, after which its unfinished pages are cancelled. Defaults to the server's REQUEST_DEADLINE_SECONDS; 0 disables it."),
+          ))
+async def scan_batch(
+    request: Request,
+    resetdata_key: str = Depends(require_resetdata_key)
+):
+    """
+    Accepts many documents in one request (several 'files' parts and/or ZIP archives,
+    which are expanded) and processes them with the same options under one shared page
+    scheduler queue, BATCH_MAX_CONCURRENT_DOCUMENTS documents at a time. Returns a
+    BatchDocumentResult per document, with its AggregatedResult, either combined or
+    streamed as NDJSON. If the client disconnects, the whole batch is cancelled.
+    """
+    start_timestamp = time.time()
+    logger.info(f"Batch request received (Content-Length: {declared_body_size(request)}). ResetData Key: ...{resetdata_key[-4:]}.")
+    # The body is charged while it is received and expanded; each document is then admitted on its own
+    admission_ticket = await _admit_document(declared_body_size(request) or 0)
+    batch_dir = _create_request_dir("batch")
+    batch_id = batch_dir.name
+    try:
+        fields, files = await receive_multipart_files(
+            request, batch_dir / "upload",
+            max_files=config.batch_max_documents, max_bytes=config.max_upload_mb * 1024 * 1024,
+        )
+        options = _document_options(fields)
+        response_format = (fields.get("response_format") or "json").lower()
+        if response_format not in BATCH_RESPONSE_FORMATS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="response_format must be 'json' or 'ndjson'.")
+        documents, skipped = await expand_batch_uploads(files, batch_dir, config)
+    except HTTPException:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise
+    except (UploadTooLargeError, BatchLimitError) as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except (UploadError, zipfile.BadZipFile) as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ClientDisconnect:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise HTTPException(status_code=STATUS_CLIENT_CLOSED_REQUEST, detail="Client disconnected during upload.")
+    except Exception as e:
+        logger.error(f"Failed to receive batch into '{batch_dir}': {e}", exc_info=True)
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise HTTPException(status_code=500, detail=f"Could not save uploaded files: {e}")
+    finally:
+        admission_ticket.close()
+    upload_stats = {"files": len(files), "size_bytes": sum(received.size_bytes for received in files)}
+    logger.info(f"Batch {batch_id}: {len(documents)} document(s) from {len(files)} file(s), {len(skipped)} ZIP entries skipped ({response_format}).")
+
+    def batch_coroutine(on_document: Optional[BatchDocumentCallback] = None) -> Any:
+        return run_batch(documents, options, config, resetdata_key, batch_id, batch_dir, on_document)
+
+    if response_format == "json":
+        try:
+            results = await _run_while_connected(request, batch_coroutine())
+        except ClientDisconnectedError:
+            logger.warning(f"Client disconnected during batch {batch_id}; processing was cancelled.")
+            return Response(status_code=STATUS_CLIENT_CLOSED_REQUEST)
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        return BatchResult(batch_id=batch_id, summary=summarize_batch(batch_id, results, skipped, start_timestamp, upload_stats), documents=results)
+
+    events: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+
+    async def run_pipeline() -> None:
+        try:
+            results = await batch_coroutine(lambda result: events.put_nowait(("document", result)))
+            events.put_nowait(("summary", summarize_batch(batch_id, results, skipped, start_timestamp, upload_stats)))
+        except Exception as e:
+            logger.error(f"Batch {batch_id} failed: {e}", exc_info=True)
+            events.put_nowait(("error", str(e)))
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    pipeline_task = asyncio.create_task(run_pipeline())
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            while True:
+                kind, payload = await events.get()
+                if kind == "document":
+                    yield _format_stream_event("document", payload.model_dump(), "ndjson")
+                elif kind == "summary":
+                    yield _format_stream_event("summary", payload, "ndjson")
+                    return
+                else:
+                    yield _format_stream_event("error", {"detail": payload}, "ndjson")
+                    return
+        finally:
+            if not pipeline_task.done():
+                logger.warning(f"Stream for batch {batch_id} closed before completion; cancelling processing.")
+                pipeline_task.cancel()
+
+    return StreamingResponse(event_stream(), media_type=STREAM_MEDIA_TYPES["ndjson"])
+
+
+# --- Asynchronous Job Endpoints ---
+
+@app.post("/jobs", response_model=ScanResponse, status_code=status.HTTP_202_ACCEPTED, tags=["Jobs"], dependencies=[Depends(require_llm_available)],
+          openapi_extra=_multipart_openapi(
+              deadline=({"type": "number"}, "Seconds after processing starts at which unfinished pages are cancelled and returned as 'error_timeout'. No deadline unless given."),
+          ))
+async def create_scan_job(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    resetdata_key: str = Depends(require_resetdata_key)
+):
+    """
+    Accepts a document and returns a job id immediately; processing runs in the background.
+    Poll GET /jobs/{job_id} for progress and the final results.
+    """
+    logger.info(f"Job request received (Content-Length: {declared_body_size(request)}). ResetData Key: ...{resetdata_key[-4:]}.")
+    job_store.prune_finished_jobs(config.job_retention_seconds)
+
+    admission_ticket, job_dir, input_file_path, upload, options = await _accept_document(request)
+    job = job_store.create_job(
+        document_name=upload.filename or input_file_path.name,
+        input_file_path=input_file_path,
+        job_dir=job_dir,
+        user_prompt=options["user_prompt"],
+        output_format=options["output_format"],
+        use_meta_intelligence=options["use_meta_intelligence"],
+        llm_api_key=resetdata_key,
+        render_profile=options["render_profile"],
+        page_timeout=options["page_timeout"],
+        deadline=options["deadline"] or None,
+        prompts=options["prompts"],
+    )
+    job_store.update_job_status(job.job_id, JobStatus.QUEUED)
+    background_tasks.add_task(process_document_workflow, job.job_id, config, job_store, admission_ticket, upload.stats())
+    return ScanResponse(job_id=job.job_id, message="Document scan job queued.")
+
+
+@app.get("/jobs/active", response_model=List[ActiveJobSummary], tags=["Jobs"])
+async def list_active_jobs(
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of jobs to return (most recent first)."),
+    resetdata_key: str = Depends(require_resetdata_key)
+):
+    """Lists recent jobs submitted with the caller's ResetData key."""
+    return job_store.get_active_jobs(limit=limit, llm_api_key=resetdata_key)
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse, tags=["Jobs"])
+async def get_job_status(job_id: str, resetdata_key: str = Depends(require_resetdata_key)):
+    """Returns status, progress and (once completed) the aggregated results of a job."""
+    job = job_store.get_job(job_id)
+    # Jobs are only visible to the key that submitted them; report others as missing
+    if job is None or job.llm_api_key != resetdata_key:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' not found.")
+    return JobStatusResponse(
+        job_id=job.job_id,
+        status=job.status.value,
+        document_name=job.document_name,
+        progress=job.progress,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+        completed_at=job.completed_at,
+        results=job.results,
+        errors=job.errors or None,
+    )
 
 
-# Removed /jobs/* endpoints for stateless design
 
 
 # --- Mount Static Files (AFTER API routes) ---
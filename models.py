@@ -6,6 +6,55 @@ from enum import Enum
 from datetime import datetime
 import json
 
+# --- Render Profiles ---
+
+class RenderMode(str, Enum):
+    """How a PDF page's pixel size is chosen when it is rendered for the model."""
+    DPI = "dpi"                       # Fixed resolution, e.g. 'dpi:300'
+    LONGEST_SIDE = "longest_side"     # Scale so the longest side is N pixels, e.g. 'longest_side:2048'
+    MAX_MEGAPIXELS = "max_megapixels" # Scale so width x height is about N megapixels, e.g. 'max_megapixels:4'
+
+
+class RenderProfile(BaseModel):
+    """A parsed render profile spec of the form '<mode>:<value>'."""
+    mode: RenderMode
+    value: float
+
+    @classmethod
+    def parse(cls, spec: str) -> "RenderProfile":
+        """Parses 'dpi:300', 'longest_side:2048' or 'max_megapixels:4'; raises ValueError if invalid."""
+        mode_str, sep, value_str = (spec or "").strip().lower().partition(":")
+        try:
+            mode = RenderMode(mode_str)
+            value = float(value_str)
+        except ValueError:
+            raise ValueError(f"Invalid render profile '{spec}'. Use 'dpi:<n>', 'longest_side:<pixels>' or 'max_megapixels:<n>'.")
+        if not sep or value <= 0:
+            raise ValueError(f"Invalid render profile '{spec}': the value must be a positive number.")
+        return cls(mode=mode, value=value)
+
+    @property
+    def spec(self) -> str:
+        return f"{self.mode.value}:{self.value:g}"
+
+
+# --- Named Prompts ---
+
+class NamedPrompt(BaseModel):
+    """One of several prompts run over the same rendered pages (the 'prompts' form field)."""
+    name: str = Field(min_length=1, max_length=64)
+    prompt: str = Field(min_length=1)
+    output_format: str = "json" # 'json' or 'text'
+
+    @field_validator("output_format")
+    @classmethod
+    def _validate_output_format(cls, value: str) -> str:
+        value = value.strip().lower()
+        if value not in ("json", "text"):
+            raise ValueError(f"output_format must be 'json' or 'text', not '{value}'.")
+        return value
+
+
 # --- Configuration Model ---
 
 class AppSettings(BaseModel):
@@ -14,12 +63,105 @@ class AppSettings(BaseModel):
     resetdata_base_url: HttpUrl = Field(default="https://models.au-syd.resetdata.ai/v1")
     resetdata_model: str = Field(default="meta-llama/Llama-4-Maverick-17B-128E-Instruct:shared")
     max_workers: int = 5
-    process_timeout: int = 90 # seconds
+    page_timeout_seconds: int = 180 # Max time per page once it has a scheduler slot (render, encode, LLM call)
+    request_deadline_seconds: int = 600 # Default deadline of /scan and /scan/stream (0 = none); /jobs only use one when given
+    max_upload_mb: int = 200 # Largest accepted upload (0 = no limit); checked against Content-Length and while streaming
+    max_prompts_per_request: int = 8 # Named prompts one request may fan out over each page
+    llm_pages_per_request: int = 1 # Pages packed into one LLM call (1 = one call per page)
+    # Batches (/scan/batch)
+    batch_max_documents: int = 1000 # Documents per batch, after ZIP expansion (0 = no limit)
+    batch_max_concurrent_documents: int = 8 # Documents of one batch being processed at once
+    batch_max_expanded_mb: int = 1024 # Total uncompressed size of the ZIP entries of one batch (0 = no limit)
+    batch_max_compression_ratio: int = 100 # ZIP entries compressed more than this are rejected as zip bombs (0 = no check)
+    # Admission control of new documents (/scan, /scan/stream, /jobs)
+    admission_memory_budget_mb: int = 2048 # Estimated memory of documents in flight (0 = no limit)
+    admission_document_reserve_mb: int = 16 # Charged per admitted document on top of its upload size and pages in flight
+    admission_max_queued_pages: int = 5000 # Pages created but not finished, across all documents (0 = no limit)
+    admission_queue_timeout_seconds: float = 10.0 # How long a new document waits for capacity before 503/429
+    process_timeout: int = 90 # seconds; default timeout of external commands (whole process group is killed)
+    libreoffice_max_concurrent: int = 2 # Concurrent libreoffice processes (0 = unlimited)
+    pdfinfo_max_concurrent: int = 8 # Concurrent pdfinfo processes (0 = unlimited)
+    subprocess_sandbox: bool = False # Run libreoffice/pdftoppm/pdfinfo under the resource limits below
+    subprocess_sandbox_cgroups: bool = True # Enforce memory limits with a cgroup v2 sub-group per command when writable (else RLIMIT_AS)
+    libreoffice_memory_limit_mb: int = 2048 # 0 = no limit
+    libreoffice_cpu_limit_seconds: int = 300 # RLIMIT_CPU per conversion process (0 = no limit)
+    libreoffice_nice: int = 5
+    poppler_memory_limit_mb: int = 1024 # pdftoppm and pdfinfo; 0 = no limit
+    poppler_cpu_limit_seconds: int = 120 # 0 = no limit
+    poppler_nice: int = 5
     temp_dir_base: str = "/tmp/everypage_pure"
     libreoffice_command: str = "libreoffice"
     pdftoppm_command: str = "pdftoppm"
     pdfinfo_command: str = "pdfinfo"
     log_level: str = "INFO"
+    render_window_pages: int = 4 # Pages rendered per pdftoppm -f/-l run when rendering on demand
+    render_concurrency: int = 0 # Max pdftoppm processes at once across the process; 0 = one per CPU core
+    render_timeout_per_page: int = 60 # seconds; a shard of N pages is killed after N times this
+    render_shard_retries: int = 1 # Times missing pages of a shard are retried one page per process
+    render_profile: str = "longest_side:2048" # Default page render size; see RenderProfile.parse
+    page_image_format: str = "png" # Encoding of rendered pages sent to the model: png, jpeg or webp
+    page_image_quality: int = 85 # JPEG/WebP quality (1-100)
+    # Warm LibreOffice pool (0 disables pooling)
+    libreoffice_pool_size: int = 2
+    libreoffice_recycle_after: int = 50 # Conversions before an instance is restarted with a fresh profile
+    libreoffice_pool_base_port: int = 2002 # Instance i listens on base_port + i
+    libreoffice_uno_python: str = "/usr/bin/python3" # Interpreter that can 'import uno' (python3-uno)
+    libreoffice_startup_timeout: int = 30 # seconds to wait for a listener to accept connections
+    # Pooled async ResetData clients (one per API key + base URL)
+    llm_max_connections: int = 20 # Per client connection pool size
+    llm_max_keepalive_connections: int = 10
+    llm_keepalive_expiry: float = 60.0 # seconds an idle connection is kept open
+    llm_http2: bool = True # Used only when the 'h2' package is installed
+    llm_client_cache_size: int = 32 # Max pooled clients before LRU eviction of idle ones
+    llm_client_idle_ttl: int = 600 # seconds before an unused client is closed
+    llm_request_timeout: float = 120.0 # seconds; HTTP timeout of one LLM call (the SDK default is 10 minutes)
+    # Adaptive per-key concurrency (AIMD) and optional rate ceilings for LLM calls
+    llm_initial_concurrency_per_key: int = 4 # Starting limit of concurrent calls per API key
+    llm_max_concurrency_per_key: int = 32 # The limit never grows beyond this
+    llm_latency_tolerance: float = 2.0 # Lower the limit when latency exceeds this multiple of its baseline
+    llm_rpm_limit: int = 0 # Requests per minute per key (0 = no ceiling)
+    llm_tpm_limit: int = 0 # Tokens per minute per key (0 = no ceiling)
+    # Retries of transient LLM failures (timeouts, connection errors, 5xx, 429/503, empty content)
+    llm_max_attempts: int = 3 # Attempts per page, including the first (1 disables retries)
+    llm_retry_base_delay: float = 1.0 # seconds; backoff before retry n is uniform in [0, base * 2^(n-1)]
+    llm_retry_max_delay: float = 20.0 # seconds; cap on that backoff
+    llm_retry_budget_ratio: float = 0.2 # Retries per document, as a fraction of its pages...
+    llm_retry_budget_min: int = 5 # ...but at least this many
+    # Circuit breaker per LLM base URL
+    llm_breaker_error_rate: float = 0.5 # Open when this share of calls fail (timeouts, connection errors, 5xx); 0 disables
+    llm_breaker_min_calls: int = 10 # ...out of at least this many calls...
+    llm_breaker_window_seconds: float = 60.0 # ...within this rolling window
+    llm_breaker_open_seconds: float = 30.0 # Fail fast this long before probing with one request
+    # ResetData key validation cache
+    key_validation_ttl: int = 300 # seconds a successful validation is reused
+    key_validation_negative_ttl: int = 30 # seconds a failed validation is reused
+    key_validation_cache_size: int = 1024
+    # Async job mode (/jobs)
+    job_retention_seconds: int = 3600 # Finished jobs are kept this long for status polling
+    # Content-addressed page result cache (a size of 0 disables that tier)
+    page_cache_memory_bytes: int = 64 * 1024 * 1024
+    page_cache_disk_bytes: int = 0 # Opt-in: results then outlive the request on disk
+    page_cache_dir: str = "" # Defaults to <temp_dir_base>/page_cache
+
+    @field_validator("render_profile")
+    @classmethod
+    def _validate_render_profile(cls, value: str) -> str:
+        return RenderProfile.parse(value).spec
+
+    @field_validator("page_image_format")
+    @classmethod
+    def _validate_page_image_format(cls, value: str) -> str:
+        value = value.strip().lower()
+        if value == "jpg":
+            value = "jpeg"
+        if value not in ("png", "jpeg", "webp"):
+            raise ValueError(f"page_image_format must be 'png', 'jpeg' or 'webp', not '{value}'.")
+        return value
+
+    @field_validator("page_image_quality")
+    @classmethod
+    def _validate_page_image_quality(cls, value: int) -> int:
+        return max(1, min(100, value))
 
 
 # --- Job Status and Error Models ---
@@ -80,6 +222,18 @@ class PageProcessingResult(BaseModel):
     data: Optional[Union[Dict[str, Any], str]] = None # Holds the result data (dict or raw string) if successful
     error_message: Optional[str] = None
     raw_response: Optional[str] = None # Store raw response on failure for debugging
+    queue_wait_seconds: Optional[float] = None # Time spent waiting for a page scheduler slot
+    image_width_px: Optional[int] = None # Size of the page image sent to the model
+    image_height_px: Optional[int] = None
+    image_mime_type: Optional[str] = None
+    image_payload_bytes: Optional[int] = None # Base64 bytes uploaded for this page
+    image_encode_seconds: Optional[float] = None # Time to (re-)encode and base64 the page image
+    cache_hit: Optional[bool] = None # True if served from the page cache, False on a miss, None if not looked up
+    attempts: Optional[int] = None # LLM calls made for this page, including retries (0 when served from the cache)
+    final_error_cause: Optional[str] = None # Why the page failed, e.g. "timeout", "server_error", "empty_content", "page_timeout"
+    prompt_name: Optional[str] = None # The named prompt this result answers (multi-prompt requests only)
+    pack_size: Optional[int] = None # Pages answered by the same packed LLM call (packing only)
+    pack_fallback: Optional[bool] = None # True if the packed answer could not be split for this page and it was sent alone
     processed_at: str = Field(default_factory=lambda: datetime.now().isoformat())
 
 
@@ -89,7 +243,26 @@ class AggregatedResult(BaseModel):
     """Structure for the final aggregated results."""
     job_id: str
     processing_summary: Dict[str, Any] # Contains metadata like page counts, timing, prompt etc.
-    pages: List[PageProcessingResult] # List of results for each page
+    pages: List[PageProcessingResult] # List of results for each page (empty when named prompts were used)
+    prompt_results: Optional[Dict[str, List[PageProcessingResult]]] = None # Page results per prompt name, in request order
+
+
+class BatchDocumentResult(BaseModel):
+    """Outcome of one document of a /scan/batch request."""
+    index: int # Position in the batch (upload order, ZIP entries in archive order)
+    document_name: str # Uploaded filename, or "<archive>/<entry>" for ZIP entries
+    status: str # "completed" or "error"
+    sha256: Optional[str] = None
+    duplicate_of: Optional[int] = None # Index of the identical document whose result was reused
+    error: Optional[str] = None
+    result: Optional[AggregatedResult] = None
+
+
+class BatchResult(BaseModel):
+    """Combined response of /scan/batch."""
+    batch_id: str
+    summary: Dict[str, Any] # Document counts, skipped ZIP entries and timing
+    documents: List[BatchDocumentResult] # In batch order
 
 
 # --- Core Job Tracking Model ---
@@ -101,7 +274,11 @@ class Job(BaseModel):
     document_name: str
     user_prompt: Optional[str] = None
     output_format: str = "json" # Store the requested output format
+    prompts: Optional[List[NamedPrompt]] = None # Named prompts run instead of user_prompt
     use_meta_intelligence: bool = False # Flag for the new feature
+    render_profile: Optional[str] = None # Per-job override of AppSettings.render_profile
+    page_timeout: Optional[float] = None # Per-job override of AppSettings.page_timeout_seconds
+    deadline: Optional[float] = None # Seconds the job's pages may take in total; None = no deadline
     input_file_path: Optional[str] = None # Path where the uploaded file is temporarily stored
     job_dir: Optional[str] = None # Path to the job-specific temporary directory
     # Per-request LLM API key (ResetData). Required for processing.
@@ -176,4 +353,11 @@ class HealthCheckResponse(BaseModel):
     version: str = "1.0.0" # Consider making this dynamic later
     active_jobs_count: int
     dependencies: Dict[str, str] # e.g., {"libreoffice": "available", "pdftoppm": "missing"}
-    llm_status: str # e.g., "per_request"
\ No newline at end of file
+    llm_status: str # e.g., "per_request"
+    libreoffice_pool: Optional[Dict[str, Any]] = None # Pool mode, size and busy count when pooling is enabled
+    subprocesses: Optional[Dict[str, Dict[str, Any]]] = None # Per-tool runs, wall/CPU seconds and peak RSS since startup
+    cancellations: Optional[Dict[str, int]] = None # Requests abandoned by their client and page tasks cancelled with them
+    llm_rate_limits: Optional[Dict[str, Dict[str, Any]]] = None # Current adaptive concurrency limit per API key (by fingerprint prefix)
+    llm_circuit_breakers: Optional[Dict[str, Dict[str, Any]]] = None # Breaker state and error rate per LLM base URL
+    admission: Optional[Dict[str, Any]] = None # Memory budget and page queue usage of admission control
+    uploads: Optional[Dict[str, Any]] = None # Uploads received since startup: count, bytes, throughput, rejections
\ No newline at end of file
@@ -0,0 +1,243 @@
+# page_cache.py - Content-addressed cache of per-page LLM results
+
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from models import AppSettings, PageProcessingResult, PageProcessingStatus
+from api_security import fingerprint_api_key
+
+logger = logging.getLogger(__name__)
+
+
+def _sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_page_cache_key(image_base64: str, prompt_text: str, model: str, output_format: str, llm_api_key: str) -> str:
+    """
+    Builds the cache key for one page: the SHA-256 of the rendered image bytes,
+    the SHA-256 of the exact prompt sent, the model name, the output format and the
+    fingerprint of the ResetData key, so results are never served across keys.
+    """
+    image_digest = _sha256_hex(base64.b64decode(image_base64))
+    prompt_digest = _sha256_hex(prompt_text.encode("utf-8"))
+    key_digest = fingerprint_api_key(llm_api_key)
+    return _sha256_hex(f"{image_digest}|{prompt_digest}|{model}|{output_format}|{key_digest}".encode("utf-8"))
+
+
+class PageResultCache:
+    """
+    Two-tier cache of successful PageProcessingResults.
+
+    The memory tier is an LRU bounded by the total size of the serialized results;
+    the disk tier stores one JSON file per key under `disk_dir` and is bounded the
+    same way, evicting the least recently used files first. Either tier is disabled
+    by giving it a size of 0. Only successful results are stored, so transient API
+    or parsing failures are always retried. All methods must be called from the
+    event loop thread; disk reads, writes and the initial directory scan run in
+    worker threads so slow disks do not stall other requests.
+    """
+
+    def __init__(self, memory_max_bytes: int, disk_dir: Optional[Path], disk_max_bytes: int):
+        self.memory_max_bytes = max(0, memory_max_bytes)
+        self.disk_max_bytes = max(0, disk_max_bytes) if disk_dir else 0
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_index: "OrderedDict[str, int]" = OrderedDict() # key -> file size, LRU first
+        self._disk_bytes = 0
+        self._disk_index_loaded: Optional[asyncio.Task] = None # Scan of disk_dir, started on first use
+        self.hits = 0
+        self.misses = 0
+
+    # --- Lookup / store ---
+
+    async def get(self, key: str, page_number: int) -> Optional[PageProcessingResult]:
+        """Returns the cached result re-numbered for `page_number`, or None on a miss."""
+        payload = self._memory.get(key)
+        if payload is not None:
+            self._memory.move_to_end(key)
+        else:
+            payload = await self._read_disk(key)
+            if payload is not None:
+                self._store_memory(key, payload) # Promote to the memory tier
+        if payload is None:
+            self.misses += 1
+            return None
+        try:
+            result = PageProcessingResult.model_validate_json(payload)
+        except ValueError as e:
+            logger.warning(f"Discarding unreadable page cache entry {key[:12]}: {e}")
+            await self._drop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        # The same image may appear at another position in another document
+        return result.model_copy(update={"page_number": page_number, "queue_wait_seconds": None, "cache_hit": True, "attempts": 0})
+
+    async def put(self, key: str, result: PageProcessingResult) -> None:
+        """Stores a successful result in both tiers; other statuses are ignored."""
+        if result.status != PageProcessingStatus.SUCCESS:
+            return
+        payload = result.model_dump_json(exclude={"queue_wait_seconds", "cache_hit"})
+        self._store_memory(key, payload)
+        await self._write_disk(key, payload)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk_index),
+            "disk_bytes": self._disk_bytes,
+        }
+
+    # --- Memory tier ---
+
+    def _store_memory(self, key: str, payload: str) -> None:
+        size = len(payload)
+        if size > self.memory_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = payload
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    # --- Disk tier ---
+
+    def _path_for(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    async def _ensure_disk_index(self) -> bool:
+        """Loads the disk index on first use (shared by concurrent callers). False if the disk tier is off."""
+        if not self.disk_max_bytes:
+            return False
+        if self._disk_index_loaded is None:
+            self._disk_index_loaded = asyncio.ensure_future(self._load_disk_index())
+        await asyncio.shield(self._disk_index_loaded)
+        return self.disk_max_bytes > 0
+
+    async def _load_disk_index(self) -> None:
+        try:
+            entries = await asyncio.to_thread(self._scan_disk_dir)
+        except OSError as e:
+            logger.error(f"Page cache directory '{self.disk_dir}' is not usable ({e}); disk tier disabled.")
+            self.disk_max_bytes = 0
+            return
+        for _, key, size in sorted(entries):
+            self._disk_index[key] = size
+            self._disk_bytes += size
+        logger.info(f"Page cache disk tier at '{self.disk_dir}': {len(self._disk_index)} entries, {self._disk_bytes} bytes.")
+        await self._evict_disk()
+
+    def _scan_disk_dir(self) -> List[Tuple[float, str, int]]:
+        """(mtime, key, size) of every entry on disk. Runs in a worker thread."""
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.disk_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        return entries
+
+    async def _read_disk(self, key: str) -> Optional[str]:
+        if not await self._ensure_disk_index() or key not in self._disk_index:
+            return None
+        try:
+            payload = await asyncio.to_thread(self._read_file, self._path_for(key))
+        except OSError:
+            self._forget_disk(key)
+            return None
+        if key in self._disk_index:
+            self._disk_index.move_to_end(key)
+        return payload
+
+    @staticmethod
+    def _read_file(path: Path) -> str:
+        payload = path.read_text(encoding="utf-8")
+        os.utime(path) # mtime doubles as the LRU timestamp across restarts
+        return payload
+
+    async def _write_disk(self, key: str, payload: str) -> None:
+        if not await self._ensure_disk_index() or key in self._disk_index:
+            return
+        data = payload.encode("utf-8")
+        if len(data) > self.disk_max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write_file, self._path_for(key), data)
+        except OSError as e:
+            logger.warning(f"Failed to write page cache entry {key[:12]}: {e}")
+            return
+        if key in self._disk_index:
+            return # Written concurrently by another page with the same content
+        self._disk_index[key] = len(data)
+        self._disk_bytes += len(data)
+        await self._evict_disk()
+
+    @staticmethod
+    def _write_file(path: Path, data: bytes) -> None:
+        tmp_path = path.with_name(f"{path.stem}.{os.urandom(4).hex()}.tmp")
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    async def _evict_disk(self) -> None:
+        evicted: List[Path] = []
+        while self._disk_bytes > self.disk_max_bytes and self._disk_index:
+            key = next(iter(self._disk_index))
+            evicted.append(self._path_for(key))
+            self._forget_disk(key)
+        if evicted:
+            await asyncio.to_thread(self._unlink_files, evicted)
+
+    @staticmethod
+    def _unlink_files(paths: List[Path]) -> None:
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def _forget_disk(self, key: str) -> None:
+        size = self._disk_index.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    async def _drop(self, key: str) -> None:
+        payload = self._memory.pop(key, None)
+        if payload is not None:
+            self._memory_bytes -= len(payload)
+        if key in self._disk_index:
+            self._forget_disk(key)
+            await asyncio.to_thread(self._unlink_files, [self._path_for(key)])
+
+
+# --- Process-wide instance ---
+
+_cache: Optional[PageResultCache] = None
+
+
+def get_page_cache(config: AppSettings) -> Optional[PageResultCache]:
+    """Returns the shared page cache, or None when both tiers are disabled."""
+    global _cache
+    if config.page_cache_memory_bytes <= 0 and config.page_cache_disk_bytes <= 0:
+        return None
+    if _cache is None:
+        disk_dir = Path(config.page_cache_dir or Path(config.temp_dir_base) / "page_cache")
+        _cache = PageResultCache(config.page_cache_memory_bytes, disk_dir, config.page_cache_disk_bytes)
+    return _cache
@@ -0,0 +1,115 @@
+# page_scheduler.py - Process-wide, fair scheduler for per-page LLM work
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from models import AppSettings
+
+logger = logging.getLogger(__name__)
+
+
+class FairPageScheduler:
+    """
+    Caps the number of pages being processed at once across the whole process.
+
+    Waiting pages are queued per owner (one owner per /scan request) and free
+    slots are handed out round-robin between owners, so a 400-page document
+    cannot starve a 2-page document submitted a moment later.
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self._max_concurrency = max(1, int(max_concurrency))
+        self._in_flight = 0
+        # owner -> FIFO of waiters; dict order is the round-robin order
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the scheduler's current load."""
+        return {
+            "max_concurrency": self._max_concurrency,
+            "in_flight": self._in_flight,
+            "queued": sum(len(q) for q in self._waiters.values()),
+            "queued_owners": len(self._waiters),
+        }
+
+    async def acquire(self, owner: str) -> float:
+        """
+        Waits for a free slot on behalf of `owner`.
+
+        Returns:
+            The number of seconds spent waiting in the queue.
+        """
+        if self._in_flight < self._max_concurrency and not self._waiters:
+            self._in_flight += 1
+            return 0.0
+
+        wait_start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just before cancellation; pass it on.
+                self.release()
+            else:
+                self._discard_waiter(owner, waiter)
+            raise
+        return time.monotonic() - wait_start
+
+    def release(self) -> None:
+        """Frees a slot, handing it directly to the next owner in round-robin order."""
+        while self._waiters:
+            owner, queue = next(iter(self._waiters.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+            if not waiter.done():
+                waiter.set_result(None) # Slot transferred; in-flight count unchanged
+                return
+        self._in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, owner: str) -> AsyncIterator[float]:
+        """Context manager form of acquire()/release(); yields the queue-wait seconds."""
+        waited = await self.acquire(owner)
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    def _discard_waiter(self, owner: str, waiter: asyncio.Future) -> None:
+        queue = self._waiters.get(owner)
+        if not queue:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._waiters[owner]
+
+
+# --- Process-wide instance ---
+
+_scheduler: Optional[FairPageScheduler] = None
+
+
+def get_page_scheduler(config: AppSettings) -> FairPageScheduler:
+    """Returns the shared scheduler, creating it from config.max_workers on first use."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = FairPageScheduler(config.max_workers)
+        logger.info(f"Initialized page scheduler with {_scheduler.max_concurrency} concurrent page slot(s).")
+    return _scheduler
@@ -1,35 +1,99 @@
 # pdf_processor.py - Handles PDF page extraction (screenshots) and metadata extraction
 
+import asyncio
 import logging
+import math
+import os
 import re
 from pathlib import Path
 from typing import List, Tuple, Optional, Dict, Any
 
-from models import AppSettings # For accessing config like command paths
-from external_commands import run_subprocess_async # To run the actual commands
+from models import AppSettings, RenderMode, RenderProfile # For accessing config like command paths
+from external_commands import (
+    run_subprocess_async, RETURN_CODE_TIMEOUT, RETURN_CODE_RESOURCE_LIMIT, ResourceLimitExceededError # To run the actual commands
+)
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_RENDER_ARGS = ["-r", "300"]
+# Page aspect ratio assumed for max_megapixels when pdfinfo reported no page size (ISO A series)
+_FALLBACK_ASPECT_RATIO = math.sqrt(2)
+
+# --- Render Concurrency ---
+
+def get_render_concurrency(config: AppSettings) -> int:
+    """
+    Max pdftoppm processes at once across the process (RENDER_CONCURRENCY, 0 = one per CPU core).
+    Enforced by the pdftoppm limit in external_commands; also sizes the lazy renderer's read-ahead.
+    """
+    return config.render_concurrency if config.render_concurrency > 0 else (os.cpu_count() or 1)
+
+
+# --- Render Size Selection ---
+
+def pdftoppm_scale_args(profile: RenderProfile, pdf_metadata: Dict[str, Any]) -> List[str]:
+    """
+    Returns the pdftoppm resolution arguments for a render profile.
+    (Pure Function)
+
+    'dpi' maps to -r. 'longest_side' maps to -scale-to, which pdftoppm applies to each
+    page's longest side. 'max_megapixels' is turned into a -scale-to value using the
+    page dimensions from parse_pdfinfo_output (pdfinfo reports the first page's size).
+    """
+    if profile.mode == RenderMode.DPI:
+        return ["-r", str(int(round(profile.value)))]
+    if profile.mode == RenderMode.LONGEST_SIDE:
+        return ["-scale-to", str(int(round(profile.value)))]
+
+    target_pixels = profile.value * 1_000_000
+    width_pts = pdf_metadata.get("page_width_pts")
+    height_pts = pdf_metadata.get("page_height_pts")
+    if width_pts and height_pts:
+        aspect_ratio = max(width_pts, height_pts) / min(width_pts, height_pts)
+    else:
+        aspect_ratio = _FALLBACK_ASPECT_RATIO
+    # longest * (longest / aspect) = target  =>  longest = sqrt(target * aspect)
+    longest_side = int(math.sqrt(target_pixels * aspect_ratio))
+    return ["-scale-to", str(max(1, longest_side))]
+
+
+def pdftoppm_format_args(image_format: str, config: AppSettings) -> Tuple[List[str], str]:
+    """
+    Returns (pdftoppm output-format arguments, file extension) for 'png' or 'jpeg'.
+    (Pure Function)
+    """
+    if image_format == "jpeg":
+        return ["-jpeg", "-jpegopt", f"quality={config.page_image_quality}"], "jpg"
+    return ["-png"], "png"
+
+
 # --- PDF to PNG Extraction ---
 
 async def extract_pdf_pages_as_png(
     pdf_path: Path,
     output_dir: Path,
-    config: AppSettings
+    config: AppSettings,
+    scale_args: Optional[List[str]] = None,
+    image_format: str = "png"
 ) -> Tuple[bool, List[Path], str]:
     """
-    Generates PNG screenshots (300 DPI) for each page of a PDF using pdftoppm.
+    Generates PNG (or JPEG) screenshots for each page of a PDF using pdftoppm.
 
     Args:
         pdf_path: Path to the input PDF file.
         output_dir: Directory where the resulting PNG images should be saved.
         config: The application settings containing the path to the pdftoppm command.
+        scale_args: pdftoppm size arguments from pdftoppm_scale_args(); defaults to 300 DPI.
+        image_format: 'png' or 'jpeg' (quality from config.page_image_quality).
 
     Returns:
         A tuple containing:
             - success (bool): True if screenshot generation was successful (or partially successful with warnings).
             - screenshot_paths (List[Path]): List of paths to the created PNG files. Empty if failed catastrophically.
             - error_message (str): An error message if generation failed completely, or warnings if partially successful.
+
+    Raises:
+        ResourceLimitExceededError: If pdftoppm was stopped by its sandbox limits before rendering any page.
     """
     if not pdf_path.exists():
         error_msg = f"Input PDF file not found for screenshot generation: {pdf_path}"
@@ -51,10 +115,11 @@ async def extract_pdf_pages_as_png(
         return False, [], error_msg
 
     # Construct the command
+    format_args, extension = pdftoppm_format_args(image_format, config)
     cmd = [
         config.pdftoppm_command,
-        "-png",      # Output format
-        "-r", "300", # Resolution (DPI)
+        *format_args, # Output format (-png, or -jpeg with -jpegopt quality)
+        *(scale_args or DEFAULT_RENDER_ARGS), # Resolution (-r DPI) or target size (-scale-to)
         "-cropbox",  # Use the CropBox defined in the PDF (often better than MediaBox)
         # Consider adding -gray for grayscale if color isn't needed (smaller files)
         # Consider adding -aa yes -aaVector yes for anti-aliasing (prettier but slower?)
@@ -63,13 +128,16 @@ async def extract_pdf_pages_as_png(
     ]
 
     logger.info(f"Attempting screenshot generation: {' '.join(cmd)}")
-    returncode, stdout, stderr = await run_subprocess_async(cmd, description)
+    # Page count unknown here, so the whole-document run gets a generous overall timeout
+    returncode, stdout, stderr = await run_subprocess_async(
+        cmd, description, timeout=config.render_timeout_per_page * 100
+    )
 
     # Check for output files *after* the command runs
     # Use glob to find generated files, sort them numerically if possible
     generated_files = sorted(
-        list(output_dir.glob(f"{output_prefix.name}-*.png")),
-        key=lambda p: int(re.search(r'-(\d+)\.png$', str(p)).group(1)) if re.search(r'-(\d+)\.png$', str(p)) else 0
+        list(output_dir.glob(f"{output_prefix.name}-*.{extension}")),
+        key=lambda p: _page_number_from_filename(p) or 0
     )
 
     if generated_files:
@@ -83,9 +151,11 @@ async def extract_pdf_pages_as_png(
         else:
             # Success case
             return True, generated_files, ""
+    elif returncode == RETURN_CODE_RESOURCE_LIMIT:
+        raise ResourceLimitExceededError(f"Rendering of '{pdf_path.name}' aborted: {stderr}")
     else:
         # No files generated - definite failure
-        error_msg = f"Screenshot generation failed: No PNG files were found for prefix '{output_prefix}'."
+        error_msg = f"Screenshot generation failed: No {extension.upper()} files were found for prefix '{output_prefix}'."
         if returncode != 0:
             error_msg += f" pdftoppm exited with code {returncode}."
         if stderr:
@@ -96,6 +166,244 @@ async def extract_pdf_pages_as_png(
         return False, [], error_msg.strip()
 
 
+# --- On-demand (windowed) page rendering ---
+
+def _page_number_from_filename(path: Path) -> Optional[int]:
+    """Extracts the page number pdftoppm appends to its output files (e.g. 'doc-007.png' -> 7)."""
+    match = re.search(r'-(\d+)\.(?:png|jpg)$', path.name)
+    return int(match.group(1)) if match else None
+
+
+async def render_pdf_page_range(
+    pdf_path: Path,
+    output_dir: Path,
+    first_page: int,
+    last_page: int,
+    config: AppSettings,
+    scale_args: Optional[List[str]] = None,
+    image_format: str = "png"
+) -> Tuple[bool, Dict[int, Path], str]:
+    """
+    Renders pages first_page..last_page (inclusive, 1-based) of a PDF to PNG (or JPEG) as one
+    pdftoppm -f/-l shard with its own timeout. Pages missing afterwards (crash, timeout, bad
+    page) are retried one page per process up to config.render_shard_retries times.
+
+    Returns:
+        A tuple containing:
+            - success (bool): True if at least one page of the range was rendered.
+            - pages (Dict[int, Path]): Page number -> image path for every page rendered.
+            - error_message (str): Error details on failure, or the pages that failed and why.
+    """
+    if not pdf_path.exists():
+        error_msg = f"Input PDF file not found for page rendering: {pdf_path}"
+        logger.error(error_msg)
+        return False, {}, error_msg
+    try:
+        output_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        error_msg = f"Failed to create page render directory '{output_dir}': {e}"
+        logger.error(error_msg)
+        return False, {}, error_msg
+
+    pages, failed = await render_pdf_page_range_with_retries(
+        pdf_path, output_dir, first_page, last_page, config, scale_args, image_format
+    )
+    if not failed:
+        return True, pages, ""
+    error_msg = "; ".join(f"page {p}: {err}" for p, err in sorted(failed.items()))
+    if not pages:
+        error_msg = f"Rendering pages {first_page}-{last_page} of '{pdf_path.name}' failed: {error_msg}"
+        logger.error(error_msg)
+        return False, {}, error_msg
+    warning_msg = f"Rendered {len(pages)}/{last_page - first_page + 1} page(s) of {first_page}-{last_page} of '{pdf_path.name}'; failed: {error_msg}"
+    logger.warning(warning_msg)
+    return True, pages, warning_msg
+
+
+async def render_pdf_page_range_with_retries(
+    pdf_path: Path,
+    output_dir: Path,
+    first_page: int,
+    last_page: int,
+    config: AppSettings,
+    scale_args: Optional[List[str]] = None,
+    image_format: str = "png"
+) -> Tuple[Dict[int, Path], Dict[int, str]]:
+    """
+    Core of render_pdf_page_range (the output directory must exist).
+
+    Returns:
+        (page number -> image path for pages rendered, page number -> reason for pages that failed).
+    """
+    pages, page_errors = await _render_shard(
+        pdf_path, output_dir, first_page, last_page, config, scale_args, image_format, attempt=0
+    )
+    # Retry what is still missing one page per shard, so a single pathological
+    # page cannot take the rest of its shard down with it again
+    for attempt in range(1, config.render_shard_retries + 1):
+        missing = [p for p in range(first_page, last_page + 1) if p not in pages]
+        if not missing:
+            break
+        logger.warning(f"Retrying {len(missing)} page(s) of '{pdf_path.name}' individually (attempt {attempt}): {missing}")
+        retries = await asyncio.gather(*(
+            _render_shard(pdf_path, output_dir, p, p, config, scale_args, image_format, attempt=attempt)
+            for p in missing
+        ))
+        for retry_pages, retry_errors in retries:
+            pages.update(retry_pages)
+            page_errors.update(retry_errors)
+
+    failed = {p: page_errors.get(p, "not rendered") for p in range(first_page, last_page + 1) if p not in pages}
+    if failed:
+        logger.warning(f"Could not render page(s) {sorted(failed)} of '{pdf_path.name}'.")
+    return pages, failed
+
+
+async def _render_shard(
+    pdf_path: Path,
+    output_dir: Path,
+    first_page: int,
+    last_page: int,
+    config: AppSettings,
+    scale_args: Optional[List[str]],
+    image_format: str,
+    attempt: int
+) -> Tuple[Dict[int, Path], Dict[int, str]]:
+    """
+    Runs one pdftoppm -f/-l process (subject to the process-wide pdftoppm limit) with a
+    timeout proportional to the page count.
+
+    Returns:
+        (page number -> image path for pages rendered, page number -> error for pages that were not).
+    """
+    # A prefix per range and attempt keeps concurrent shards from seeing each other's files
+    retry_suffix = f"r{attempt}" if attempt else ""
+    output_prefix = output_dir / f"{pdf_path.stem}-p{first_page}{retry_suffix}"
+    description = f"pdftoppm render of pages {first_page}-{last_page} of '{pdf_path.name}'"
+    format_args, extension = pdftoppm_format_args(image_format, config)
+    cmd = [
+        config.pdftoppm_command,
+        *format_args,
+        *(scale_args or DEFAULT_RENDER_ARGS),
+        "-cropbox",
+        "-f", str(first_page),
+        "-l", str(last_page),
+        str(pdf_path),
+        str(output_prefix)
+    ]
+    timeout = config.render_timeout_per_page * (last_page - first_page + 1)
+    returncode, stdout, stderr = await run_subprocess_async(cmd, description, timeout=timeout)
+
+    pages: Dict[int, Path] = {}
+    for path in output_dir.glob(f"{output_prefix.name}-*.{extension}"):
+        page_number = _page_number_from_filename(path)
+        if page_number is not None and first_page <= page_number <= last_page:
+            pages[page_number] = path
+
+    if returncode in (RETURN_CODE_TIMEOUT, RETURN_CODE_RESOURCE_LIMIT) and pages:
+        # pdftoppm writes pages in order; the last file of a killed run may be truncated
+        last_written = max(pages)
+        pages.pop(last_written).unlink(missing_ok=True)
+
+    if returncode == RETURN_CODE_TIMEOUT:
+        reason = f"render timed out after {timeout}s"
+    elif returncode == RETURN_CODE_RESOURCE_LIMIT:
+        reason = stderr # e.g. "pdftoppm was killed for exceeding its memory limit (1024 MB)."
+    else:
+        reason = f"pdftoppm exited with code {returncode}" + (f": {stderr}" if stderr else "")
+    page_errors = {p: reason for p in range(first_page, last_page + 1) if p not in pages}
+    return pages, page_errors
+
+
+class LazyPdfPageRenderer:
+    """
+    Renders PDF pages on demand instead of all at once.
+
+    Pages are rendered in windows of `window_size` consecutive pages (one pdftoppm
+    -f/-l shard per window) the first time any page of a window is requested, and the
+    following windows are started in the background, as many as the render concurrency
+    allows, so rendering runs on all cores and overlaps the LLM calls.
+    Callers should release_page() each page once it is encoded so that disk usage
+    stays bounded by the pages actually in flight plus the read-ahead.
+    """
+
+    def __init__(
+        self, pdf_path: Path, output_dir: Path, config: AppSettings, total_pages: int,
+        window_size: int = 1, scale_args: Optional[List[str]] = None, image_format: str = "png"
+    ):
+        self.pdf_path = pdf_path
+        self.output_dir = output_dir
+        self.config = config
+        self.total_pages = total_pages
+        self.window_size = max(1, window_size)
+        self.scale_args = scale_args
+        self.image_format = image_format
+        self.read_ahead_windows = get_render_concurrency(config)
+        self._windows: Dict[int, "asyncio.Task[Tuple[Dict[int, Path], Dict[int, str]]]"] = {}
+
+    async def _render_window(self, first_page: int, last_page: int) -> Tuple[Dict[int, Path], Dict[int, str]]:
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            return {}, {p: f"Failed to create page render directory: {e}" for p in range(first_page, last_page + 1)}
+        return await render_pdf_page_range_with_retries(
+            self.pdf_path, self.output_dir, first_page, last_page, self.config, self.scale_args, self.image_format
+        )
+
+    def _window_task(self, window_index: int) -> "asyncio.Task[Tuple[Dict[int, Path], Dict[int, str]]]":
+        task = self._windows.get(window_index)
+        if task is None:
+            first_page = window_index * self.window_size + 1
+            last_page = min(first_page + self.window_size - 1, self.total_pages)
+            task = asyncio.create_task(
+                self._render_window(first_page, last_page),
+                name=f"Render_{self.pdf_path.stem}_{first_page}-{last_page}"
+            )
+            self._windows[window_index] = task
+        return task
+
+    async def get_page(self, page_number: int) -> Tuple[Optional[Path], str]:
+        """
+        Returns (image_path, "") for a rendered page, or (None, error_message) if it could not be rendered.
+        """
+        if not 1 <= page_number <= self.total_pages:
+            return None, f"Page {page_number} is out of range (document has {self.total_pages} pages)."
+        window_index = (page_number - 1) // self.window_size
+        task = self._window_task(window_index)
+        # Read ahead so the next pages are ready when their slots come up
+        for ahead in range(window_index + 1, window_index + 1 + self.read_ahead_windows):
+            if ahead * self.window_size >= self.total_pages:
+                break
+            self._window_task(ahead)
+        # Shield: one cancelled page must not cancel a render shared with other pages
+        pages, failed = await asyncio.shield(task)
+        path = pages.get(page_number)
+        if path is None or not path.exists():
+            return None, failed.get(page_number) or f"Page {page_number} was not rendered."
+        return path, ""
+
+    def release_page(self, page_number: int) -> None:
+        """Deletes a page's image once it is no longer needed."""
+        window_index = (page_number - 1) // self.window_size
+        task = self._windows.get(window_index)
+        if task is None or not task.done() or task.cancelled() or task.exception():
+            return
+        path = task.result()[0].get(page_number)
+        if path is not None:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Could not delete rendered page {path}: {e}")
+
+    async def aclose(self) -> None:
+        """Cancels any renders still running (e.g. when the request is abandoned)."""
+        pending = [t for t in self._windows.values() if not t.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
 # --- PDF Metadata Extraction ---
 
 async def extract_pdf_metadata(
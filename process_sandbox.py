@@ -0,0 +1,219 @@
+# process_sandbox.py - Resource limits (rlimits, nice, cgroup v2) for external commands
+
+import itertools
+import logging
+import os
+import resource
+import signal
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CGROUP_MOUNT = Path("/sys/fs/cgroup")
+_CGROUP_PREFIX = "everypage-"
+# Leaf this process moves itself into, since cgroup v2 does not allow a cgroup that
+# holds processes to delegate controllers to its children
+_SERVICE_CGROUP = f"{_CGROUP_PREFIX}api"
+# Extra seconds between the RLIMIT_CPU soft limit (SIGXCPU) and hard limit (SIGKILL)
+_CPU_HARD_LIMIT_GRACE = 5
+# stderr markers (lower-cased) of an allocation refused because of RLIMIT_AS
+_ALLOCATION_FAILURE_MARKERS = ("bad_alloc", "cannot allocate memory", "out of memory", "memoryerror", "failed to map segment")
+
+
+class ResourceLimits:
+    """Limits for one tool class. A value of 0 disables that limit."""
+
+    def __init__(self, memory_limit_mb: int = 0, cpu_limit_seconds: int = 0, nice: int = 0):
+        self.memory_limit_mb = max(0, memory_limit_mb)
+        self.cpu_limit_seconds = max(0, cpu_limit_seconds)
+        self.nice = max(0, nice)
+
+    def __bool__(self) -> bool:
+        return bool(self.memory_limit_mb or self.cpu_limit_seconds or self.nice)
+
+    def __repr__(self) -> str:
+        return f"ResourceLimits(memory={self.memory_limit_mb}MB, cpu={self.cpu_limit_seconds}s, nice={self.nice})"
+
+
+class ProcessSandbox:
+    """
+    Applies one tool class's limits to a single command.
+
+    The memory limit is enforced through a per-command cgroup v2 sub-group (memory.max,
+    which counts resident memory and records OOM kills) when one can be created, and
+    otherwise through RLIMIT_AS, which counts virtual address space. CPU time uses
+    RLIMIT_CPU and the priority os.nice; long-lived processes such as LibreOffice
+    listeners get no CPU limit, since it would accumulate over their whole lifetime.
+
+    Use `preexec` as the Popen preexec_fn, call `limit_exceeded` after the process has
+    exited and `cleanup` once it has been reaped.
+    """
+
+    _counter = itertools.count(1)
+
+    def __init__(self, tool: str, limits: ResourceLimits, cgroup_root: Optional[Path], long_lived: bool = False):
+        self.tool = tool
+        self.limits = limits
+        self.cpu_limit_seconds = 0 if long_lived else limits.cpu_limit_seconds
+        self.cgroup: Optional[Path] = None
+        if cgroup_root is not None and limits.memory_limit_mb:
+            self.cgroup = self._create_cgroup(cgroup_root)
+
+    def _create_cgroup(self, cgroup_root: Path) -> Optional[Path]:
+        cgroup = cgroup_root / f"{_CGROUP_PREFIX}{self.tool}-{os.getpid()}-{next(self._counter)}"
+        try:
+            cgroup.mkdir()
+            (cgroup / "memory.max").write_text(str(self.limits.memory_limit_mb * 1024 * 1024))
+        except OSError as e:
+            logger.warning(f"Could not create cgroup '{cgroup}' ({e}); limiting {self.tool} memory with RLIMIT_AS instead.")
+            _remove_cgroup(cgroup)
+            return None
+        try:
+            (cgroup / "memory.swap.max").write_text("0") # Otherwise the limit only moves the excess to swap
+        except OSError:
+            pass
+        return cgroup
+
+    def preexec(self) -> None:
+        """Runs in the child between fork and exec; must not log or take locks."""
+        if self.cgroup is not None:
+            fd = os.open(str(self.cgroup / "cgroup.procs"), os.O_WRONLY)
+            try:
+                os.write(fd, b"0") # "0" moves the writing process
+            finally:
+                os.close(fd)
+        elif self.limits.memory_limit_mb:
+            memory_bytes = self.limits.memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+        if self.cpu_limit_seconds:
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_limit_seconds, self.cpu_limit_seconds + _CPU_HARD_LIMIT_GRACE))
+        if self.limits.nice:
+            os.nice(self.limits.nice)
+
+    def limit_exceeded(self, return_code: int, stderr: str = "", cpu_seconds: float = 0.0) -> Optional[str]:
+        """Returns why the command was stopped by one of its limits, or None if it was not."""
+        if self.cgroup is not None and self._oom_kills() > 0:
+            return f"was killed for exceeding its memory limit ({self.limits.memory_limit_mb} MB)"
+        if self.cpu_limit_seconds and (
+            return_code == -signal.SIGXCPU
+            or (return_code == -signal.SIGKILL and cpu_seconds >= self.cpu_limit_seconds)
+        ):
+            return f"was killed for exceeding its CPU time limit ({self.cpu_limit_seconds}s)"
+        if self.cgroup is None and self.limits.memory_limit_mb and return_code != 0:
+            if any(marker in stderr.lower() for marker in _ALLOCATION_FAILURE_MARKERS):
+                return f"ran out of memory under its address-space limit ({self.limits.memory_limit_mb} MB)"
+        return None
+
+    def _oom_kills(self) -> int:
+        try:
+            for line in (self.cgroup / "memory.events").read_text().splitlines():
+                name, _, value = line.partition(" ")
+                if name == "oom_kill":
+                    return int(value)
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def cleanup(self) -> None:
+        """Kills anything left in the command's cgroup and removes it. Blocking; call off the event loop."""
+        if self.cgroup is not None:
+            _remove_cgroup(self.cgroup, kill=True)
+            self.cgroup = None
+
+
+def _remove_cgroup(cgroup: Path, kill: bool = False) -> None:
+    if kill:
+        try:
+            (cgroup / "cgroup.kill").write_text("1") # Daemonized leftovers (Linux 5.14+)
+        except OSError:
+            pass
+    for _ in range(20):
+        try:
+            cgroup.rmdir()
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.05) # Killed processes can take a moment to leave the cgroup
+    logger.warning(f"Could not remove cgroup '{cgroup}'; it will be removed on next startup.")
+
+
+# --- Process-wide configuration (set once at startup) ---
+
+_tool_resource_limits: Dict[str, ResourceLimits] = {}
+_cgroup_root: Optional[Path] = None
+
+
+def _own_cgroup() -> Optional[Path]:
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return CGROUP_MOUNT / line[3:].strip().lstrip("/")
+    except OSError:
+        pass
+    return None
+
+
+def _pid_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _prepare_cgroup_root() -> Optional[Path]:
+    """
+    Makes this process's cgroup able to hold per-command sub-groups with a memory limit.
+    Returns the cgroup to create them in, or None if cgroup v2 is not writable here.
+    """
+    own = _own_cgroup()
+    if own is not None and own.name == _SERVICE_CGROUP:
+        own = own.parent # Already moved into the service leaf (e.g. after a reload)
+    if own is None or not (own / "cgroup.controllers").exists():
+        logger.info("Subprocess sandbox: cgroup v2 is not available; memory limits use RLIMIT_AS.")
+        return None
+    try:
+        if "memory" not in (own / "cgroup.controllers").read_text().split():
+            logger.info(f"Subprocess sandbox: memory controller not delegated to '{own}'; memory limits use RLIMIT_AS.")
+            return None
+        for stale in own.glob(f"{_CGROUP_PREFIX}*-*-*"):
+            if not _pid_alive(stale.name.rsplit("-", 2)[1]):
+                _remove_cgroup(stale, kill=True) # Left over from a previous run of a dead worker
+        if "memory" not in (own / "cgroup.subtree_control").read_text().split():
+            service = own / _SERVICE_CGROUP
+            service.mkdir(exist_ok=True)
+            (service / "cgroup.procs").write_text(str(os.getpid()))
+            (own / "cgroup.subtree_control").write_text("+memory")
+    except OSError as e:
+        logger.info(f"Subprocess sandbox: cgroup '{own}' is not writable ({e}); memory limits use RLIMIT_AS.")
+        return None
+    logger.info(f"Subprocess sandbox: per-command cgroups under '{own}'.")
+    return own
+
+
+def configure_sandbox(tool_resource_limits: Dict[str, ResourceLimits], use_cgroups: bool = True) -> None:
+    """
+    Sets the resource limits applied to each executable (keyed by command[0], e.g. 'pdftoppm').
+    An empty mapping disables sandboxing.
+    """
+    global _tool_resource_limits, _cgroup_root
+    _tool_resource_limits = {tool: limits for tool, limits in tool_resource_limits.items() if limits}
+    _cgroup_root = None
+    if _tool_resource_limits:
+        if use_cgroups and any(limits.memory_limit_mb for limits in _tool_resource_limits.values()):
+            _cgroup_root = _prepare_cgroup_root()
+        logger.info(f"Subprocess sandbox enabled: {_tool_resource_limits}.")
+
+
+def create_sandbox(tool: str, long_lived: bool = False) -> Optional[ProcessSandbox]:
+    """Returns a sandbox for one run of `tool`, or None when no limits are configured for it."""
+    limits = _tool_resource_limits.get(tool)
+    if limits is None:
+        return None
+    return ProcessSandbox(tool, limits, _cgroup_root, long_lived=long_lived)
@@ -1,42 +1,219 @@
 import logging
 import asyncio
-from typing import Dict, Any, Tuple, Optional
+import importlib.util
+import json
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Optional, AsyncIterator
 
-from openai import OpenAI
+import httpx
+from openai import (
+    AsyncOpenAI, DefaultAsyncHttpxClient, AuthenticationError, PermissionDeniedError, APITimeoutError, APIStatusError
+)
 from models import AppSettings, PageProcessingStatus
+from api_security import fingerprint_api_key, invalidate_cached_api_key, KeyValidationUnavailableError
+from llm_rate_controller import get_rate_controller, parse_retry_after
+from llm_retry import (
+    RetryBudget, classify_llm_error, backoff_delay, ENDPOINT_FAILURE_CAUSES,
+    CAUSE_EMPTY_CONTENT, CAUSE_AUTHENTICATION, CAUSE_CIRCUIT_OPEN
+)
+from llm_circuit_breaker import get_circuit_breaker
 
 logger = logging.getLogger(__name__)
 
+# HTTP/2 needs the optional 'h2' package (installed via httpx[http2])
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-def build_resetdata_messages(image_base64: str, prompt_text: str) -> list:
+# Upstream responses that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUS_CODES = (429, 503)
+
+# Instructions wrapped around the user's prompt when several pages share one call
+PACKED_PAGES_PROMPT_TEMPLATE = (Path(__file__).parent / "prompts" / "packed_pages_prompt.txt").read_text(encoding="utf-8")
+
+
+def build_resetdata_messages(image_base64: str, prompt_text: str, image_mime_type: str = "image/png") -> list:
     return [{
         "role": "user",
         "content": [
-            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
+            {"type": "image_url", "image_url": {"url": f"data:{image_mime_type};base64,{image_base64}"}},
             {"type": "text", "text": prompt_text},
         ],
     }]
 
 
+def build_packed_resetdata_messages(pages: List[Tuple[int, str, str]], prompt_text: str, output_format: str) -> list:
+    """
+    One user message carrying several pages, given as (page_number, image_base64, mime_type):
+    each image is preceded by a 'PAGE <n>' text marker, and the prompt asks for one JSON
+    object keyed by page number (split again by parse_packed_ai_output).
+    """
+    content: List[Dict[str, Any]] = []
+    for page_number, image_base64, image_mime_type in pages:
+        content.append({"type": "text", "text": f"PAGE {page_number}"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:{image_mime_type};base64,{image_base64}"}})
+    value_description = (
+        "that page's answer as JSON" if output_format == "json" else "that page's answer as a JSON string"
+    )
+    content.append({"type": "text", "text": PACKED_PAGES_PROMPT_TEMPLATE.format(
+        page_count=len(pages),
+        page_keys=", ".join(f'"{page_number}"' for page_number, _, _ in pages),
+        value_description=value_description,
+        prompt=prompt_text,
+    )})
+    return [{"role": "user", "content": content}]
+
+
+# --- Pooled async clients ---
+
+class _PooledClient:
+    """An AsyncOpenAI client plus the bookkeeping needed for LRU/idle eviction."""
+
+    def __init__(self, client: AsyncOpenAI):
+        self.client = client
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class ResetDataClientRegistry:
+    """
+    Keeps one AsyncOpenAI client (and therefore one keep-alive connection pool)
+    per (API key hash, base URL), so pages of a document reuse warm connections
+    instead of paying a TLS handshake each.
+
+    Clients that are idle longer than config.llm_client_idle_ttl, or that fall off
+    the end of the LRU once config.llm_client_cache_size is exceeded, are closed.
+    Clients with requests in flight are never evicted.
+    """
+
+    def __init__(self):
+        self._clients: "OrderedDict[Tuple[str, str], _PooledClient]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def _create_client(self, llm_api_key: str, base_url: str, config: AppSettings) -> AsyncOpenAI:
+        use_http2 = config.llm_http2 and _HTTP2_AVAILABLE
+        if config.llm_http2 and not _HTTP2_AVAILABLE:
+            logger.debug("HTTP/2 requested for ResetData but 'h2' is not installed; using HTTP/1.1.")
+        http_client = DefaultAsyncHttpxClient(
+            http2=use_http2,
+            limits=httpx.Limits(
+                max_connections=config.llm_max_connections,
+                max_keepalive_connections=config.llm_max_keepalive_connections,
+                keepalive_expiry=config.llm_keepalive_expiry,
+            ),
+        )
+        # No SDK retries: failures go to the rate controller and the retry engine instead
+        return AsyncOpenAI(api_key=llm_api_key, base_url=base_url, http_client=http_client, timeout=config.llm_request_timeout, max_retries=0)
+
+    @asynccontextmanager
+    async def lease(self, llm_api_key: str, config: AppSettings) -> AsyncIterator[AsyncOpenAI]:
+        """Yields the pooled client for this key/base URL, creating it on first use."""
+        base_url = str(config.resetdata_base_url)
+        cache_key = (fingerprint_api_key(llm_api_key), base_url)
+        entry = self._clients.get(cache_key)
+        if entry is None:
+            entry = _PooledClient(self._create_client(llm_api_key, base_url, config))
+            self._clients[cache_key] = entry
+            logger.info(f"Created pooled ResetData client for key ...{llm_api_key[-4:]} ({len(self._clients)} pooled).")
+        self._clients.move_to_end(cache_key)
+        entry.in_use += 1
+        try:
+            yield entry.client
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            await self._evict(config)
+
+    async def _evict(self, config: AppSettings) -> None:
+        now = time.monotonic()
+        overflow = len(self._clients) - max(1, config.llm_client_cache_size)
+        to_close = []
+        for cache_key, entry in list(self._clients.items()): # LRU first
+            if entry.in_use:
+                continue
+            if overflow > 0 or now - entry.last_used > config.llm_client_idle_ttl:
+                to_close.append(self._clients.pop(cache_key))
+                overflow -= 1
+        for entry in to_close:
+            await self._close_entry(entry)
+        if to_close:
+            logger.info(f"Evicted {len(to_close)} idle ResetData client(s); {len(self._clients)} remain pooled.")
+
+    async def close_all(self) -> None:
+        """Closes every pooled client. Called on application shutdown."""
+        entries = list(self._clients.values())
+        self._clients.clear()
+        for entry in entries:
+            await self._close_entry(entry)
+        logger.info(f"Closed {len(entries)} pooled ResetData client(s).")
+
+    @staticmethod
+    async def _close_entry(entry: _PooledClient) -> None:
+        try:
+            await entry.client.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled ResetData client: {e}")
+
+
+_client_registry = ResetDataClientRegistry()
+
+
+async def close_resetdata_clients() -> None:
+    """Closes all pooled ResetData clients (use from the app shutdown hook)."""
+    await _client_registry.close_all()
+
+
 async def validate_resetdata_api_key(llm_api_key: str, config: AppSettings) -> Tuple[bool, Optional[str]]:
     """
     Performs a lightweight call to validate the provided ResetData API key.
-    Returns (True, None) on success, or (False, error_message) on failure.
+    Returns (True, None) on success, or (False, error_message) if ResetData rejected
+    the key (401/403).
+
+    Raises:
+        KeyValidationUnavailableError: If the key could not be checked (timeout,
+            connection error, 5xx or any other failure); the key may well be valid.
     """
     if not llm_api_key:
         return False, "Missing ResetData API key."
 
-    def _run_sync() -> Tuple[bool, Optional[str]]:
-        try:
-            client = OpenAI(api_key=llm_api_key, base_url=str(config.resetdata_base_url))
+    try:
+        async with _client_registry.lease(llm_api_key, config) as client:
             # Prefer a lightweight models list; if not supported, this may still 200 or 403 quickly
-            _ = client.models.list()
-            return True, None
-        except Exception as e:
-            return False, f"ResetData key validation failed: {e.__class__.__name__}: {e}"
+            await client.models.list()
+        return True, None
+    except (AuthenticationError, PermissionDeniedError) as e:
+        return False, f"ResetData key validation failed: {e.__class__.__name__}: {e}"
+    except Exception as e:
+        raise KeyValidationUnavailableError(
+            f"ResetData key validation could not be completed: {e.__class__.__name__}: {e}"
+        ) from e
+
+async def _request_completion(llm_api_key: str, config: AppSettings, messages: list) -> str:
+    """One chat completion under the key's rate controller. Returns the message content."""
+    controller = get_rate_controller(llm_api_key, config)
+    # Admission under this key's adaptive concurrency limit and RPM/TPM ceilings
+    async with controller.slot() as permit:
+        try:
+            async with _client_registry.lease(llm_api_key, config) as client:
+                completion = await client.chat.completions.create(
+                    model=config.resetdata_model,
+                    messages=messages,
+                    temperature=0.2,
+                    top_p=0.95,
+                    max_tokens=8192,
+                    stream=False,
+                )
+        except APIStatusError as e:
+            if e.status_code in THROTTLE_STATUS_CODES:
+                controller.on_throttled(permit, e.status_code, parse_retry_after(e.response.headers))
+            raise
+        controller.on_success(permit, completion.usage.total_tokens if completion.usage else None)
+    return (completion.choices[0].message.content if completion and completion.choices else "") or ""
 
-    ok, err = await asyncio.to_thread(_run_sync)
-    return ok, err
 
 async def call_resetdata_openai_api(
     image_base64: str,
@@ -45,38 +222,95 @@ async def call_resetdata_openai_api(
     page_number: int,
     llm_api_key: str,
     output_format: str,
-) -> Tuple[Optional[Dict[str, Any]], Optional[PageProcessingStatus], Optional[str]]:
+    image_mime_type: str = "image/png",
+    retry_budget: Optional[RetryBudget] = None,
+) -> Tuple[Optional[Dict[str, Any]], Optional[PageProcessingStatus], Optional[str], int, Optional[str]]:
+    """
+    Calls the model for one page, retrying transient failures (timeouts, connection
+    errors, 5xx, 429/503 and empty content) up to config.llm_max_attempts times with
+    jittered exponential backoff. Retries are also drawn from `retry_budget`, when
+    given, which caps them per document and stops them at the request deadline.
+    While the endpoint's circuit breaker is open, calls fail at once (ERROR_API).
+
+    Returns (response, error_status, error_message, attempts, final_error_cause);
+    final_error_cause is one of the llm_retry.CAUSE_* values when the last attempt
+    failed (including with empty content), otherwise None.
+    """
+    messages = build_resetdata_messages(image_base64, prompt_text, image_mime_type)
+    return await _call_with_retries(messages, config, llm_api_key, f"Page {page_number}", retry_budget)
+
+
+async def call_resetdata_openai_api_packed(
+    pages: List[Tuple[int, str, str]],
+    prompt_text: str,
+    config: AppSettings,
+    llm_api_key: str,
+    output_format: str,
+    retry_budget: Optional[RetryBudget] = None,
+) -> Tuple[Optional[Dict[str, Any]], Optional[PageProcessingStatus], Optional[str], int, Optional[str]]:
+    """
+    Like call_resetdata_openai_api, but sends several pages, given as
+    (page_number, image_base64, mime_type), in one call (see build_packed_resetdata_messages).
+    The answer is split per page with parse_packed_ai_output.
+    """
+    messages = build_packed_resetdata_messages(pages, prompt_text, output_format)
+    label = f"Pages {pages[0][0]}-{pages[-1][0]} (packed)"
+    return await _call_with_retries(messages, config, llm_api_key, label, retry_budget)
+
+
+async def _call_with_retries(
+    messages: list,
+    config: AppSettings,
+    llm_api_key: str,
+    label: str,
+    retry_budget: Optional[RetryBudget] = None,
+) -> Tuple[Optional[Dict[str, Any]], Optional[PageProcessingStatus], Optional[str], int, Optional[str]]:
+    """The retry loop of call_resetdata_openai_api; `label` names the page(s) in log messages."""
     if not llm_api_key:
         error_msg = "Missing required ResetData LLM API key."
         logger.error(error_msg)
-        return None, PageProcessingStatus.ERROR_API, error_msg
+        return None, PageProcessingStatus.ERROR_API, error_msg, 0, CAUSE_AUTHENTICATION
 
-    def _run_sync() -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    breaker = get_circuit_breaker(config)
+    attempt = 0
+    while True:
+        allowed, is_probe = await breaker.allow()
+        if not allowed:
+            return (None, PageProcessingStatus.ERROR_API,
+                    f"ResetData endpoint is unavailable (circuit breaker open); not called. Retry in {breaker.retry_after():.0f}s.",
+                    attempt, CAUSE_CIRCUIT_OPEN)
+        attempt += 1
+        error: Optional[Exception] = None
         try:
-            client = OpenAI(api_key=llm_api_key, base_url=str(config.resetdata_base_url))
-            messages = build_resetdata_messages(image_base64, prompt_text)
-            completion = client.chat.completions.create(
-                model=config.resetdata_model,
-                messages=messages,
-                temperature=0.2,
-                top_p=0.95,
-                max_tokens=8192,
-                stream=False,
-            )
-            content_text = completion.choices[0].message.content if completion and completion.choices else ""
-            normalized = {
-                "candidates": [
-                    {"content": {"parts": [{"text": content_text or ""}]}}
-                ]
-            }
-            return normalized, None
+            content_text = await _request_completion(llm_api_key, config, messages)
+            cause, retryable = (None, False) if content_text else (CAUSE_EMPTY_CONTENT, True)
+        except asyncio.CancelledError:
+            breaker.abandon(is_probe)
+            raise
         except Exception as e:
-            return None, f"ResetData API error: {e.__class__.__name__}: {e}"
+            error = e
+            cause, retryable = classify_llm_error(e)
+        breaker.record(cause in ENDPOINT_FAILURE_CAUSES, is_probe)
+        if cause is None:
+            return {"candidates": [{"content": {"parts": [{"text": content_text}]}}]}, None, None, attempt, None
+        if not retryable or attempt >= config.llm_max_attempts:
+            break
+        delay = backoff_delay(attempt, config.llm_retry_base_delay, config.llm_retry_max_delay)
+        if retry_budget is not None and not retry_budget.try_spend(delay):
+            logger.warning(f"{label}: Not retrying after {cause}; the document's retry budget or deadline is exhausted.")
+            break
+        logger.warning(f"{label}: ResetData call failed ({cause}); retrying in {delay:.1f}s (attempt {attempt + 1} of {config.llm_max_attempts}).")
+        await asyncio.sleep(delay)
 
-    response_json, err = await asyncio.to_thread(_run_sync)
-    if err:
-        return None, PageProcessingStatus.ERROR_API, err
-    return response_json, None, None
+    if error is None:
+        # Empty content on every attempt; the caller reports it as a parsing error
+        return {"candidates": [{"content": {"parts": [{"text": ""}]}}]}, None, None, attempt, cause
+    if isinstance(error, APITimeoutError):
+        return None, PageProcessingStatus.ERROR_TIMEOUT, f"ResetData API call timed out after {config.llm_request_timeout}s: {error}", attempt, cause
+    if isinstance(error, AuthenticationError):
+        # The key was revoked or expired since it was validated; force revalidation
+        invalidate_cached_api_key(llm_api_key)
+    return None, PageProcessingStatus.ERROR_API, f"ResetData API error: {error.__class__.__name__}: {error}", attempt, cause
 
 
 def parse_and_validate_ai_output(
@@ -119,3 +353,43 @@ def parse_and_validate_ai_output(
         return extracted_text, None, None
 
 
+def parse_packed_ai_output(
+    extracted_text: str,
+    page_numbers: List[int],
+    requested_format: str,
+) -> Dict[int, Any]:
+    """
+    Splits the answer to a packed call (a JSON object keyed by page number) into the
+    data of each page, parsed as parse_and_validate_ai_output would for a single page.
+    Keys such as "3", "page 3" or "PAGE_3" are accepted. Pages whose entry is missing,
+    empty or (for JSON output) not valid JSON are left out, so the caller can send
+    them again on their own.
+    """
+    label = f"pages {page_numbers[0]}-{page_numbers[-1]}"
+    envelope, _, envelope_error = parse_and_validate_ai_output(extracted_text, page_numbers[0], "application/json")
+    if envelope_error or not isinstance(envelope, dict):
+        logger.warning(f"Packed answer for {label} is not a JSON object keyed by page; splitting failed.")
+        return {}
+    by_page: Dict[int, Any] = {}
+    for key, value in envelope.items():
+        digits = re.sub(r"\D", "", str(key))
+        if digits:
+            by_page[int(digits)] = value
+
+    split: Dict[int, Any] = {}
+    for page_number in page_numbers:
+        value = by_page.get(page_number)
+        if value is None or value == "":
+            continue
+        if requested_format == "application/json":
+            if isinstance(value, str):
+                value, _, value_error = parse_and_validate_ai_output(value, page_number, requested_format)
+                if value_error:
+                    continue
+        elif not isinstance(value, str):
+            value = json.dumps(value)
+        split[page_number] = value
+    missing = len(page_numbers) - len(split)
+    if missing:
+        logger.warning(f"Packed answer for {label}: {missing} of {len(page_numbers)} page(s) could not be split out.")
+    return split
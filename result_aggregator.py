@@ -2,11 +2,11 @@
 
 import logging
 import time
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from datetime import datetime
 
 # Import necessary models
-from models import PageProcessingResult, AggregatedResult, PageProcessingStatus, AppSettings
+from models import PageProcessingResult, AggregatedResult, PageProcessingStatus, AppSettings, NamedPrompt
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +16,11 @@ def aggregate_processing_results(
     page_results: List[PageProcessingResult],
     pdf_metadata: Dict[str, Any],
     user_prompt: str, # Use the actual user prompt for the summary
-    start_timestamp: float # Unix timestamp when processing started
+    start_timestamp: float, # Unix timestamp when processing started
+    subprocess_stats: Optional[Dict[str, Any]] = None, # Per-tool totals from summarize_subprocess_timings
+    retry_stats: Optional[Dict[str, Any]] = None, # RetryBudget.stats() of the document
+    upload_stats: Optional[Dict[str, Any]] = None, # ReceivedUpload.stats() of the uploaded file
+    prompts: Optional[List[NamedPrompt]] = None # Named prompts the pages were fanned out to, if any
 ) -> AggregatedResult:
     """
     Aggregates individual page processing results into a final structured result.
@@ -29,6 +33,12 @@ def aggregate_processing_results(
         pdf_metadata: A dictionary containing metadata extracted from the PDF (e.g., page count from pdfinfo).
         user_prompt: The prompt template provided by the user for this job.
         start_timestamp: The time.time() value when the overall processing workflow began.
+        subprocess_stats: Optional per-tool runs, timeouts, queue-wait/run/CPU seconds and peak RSS of external commands.
+        retry_stats: Optional retry budget of the document (retries allowed, used and denied).
+        upload_stats: Optional size, SHA-256, receive time and throughput of the uploaded file.
+        prompts: Optional named prompts. Page results are then grouped by prompt_name into
+            prompt_results (pages is left empty), the page counts cover every prompt's
+            results, and per-prompt counts are added under "prompts".
 
     Returns:
         An AggregatedResult object containing the summary and detailed page results.
@@ -44,6 +54,7 @@ def aggregate_processing_results(
     successful_pages = 0
     mock_pages = 0
     pages_with_errors = 0
+    timed_out_pages = 0
 
     for result in page_results:
         processed_pages += 1 # Count every result received
@@ -54,12 +65,25 @@ def aggregate_processing_results(
             mock_pages += 1
         else:
             pages_with_errors += 1
+            if result.status == PageProcessingStatus.ERROR_TIMEOUT:
+                timed_out_pages += 1
+
+    queue_waits = [r.queue_wait_seconds for r in page_results if r.queue_wait_seconds is not None]
+    payload_bytes = [r.image_payload_bytes for r in page_results if r.image_payload_bytes is not None]
+    encode_times = [r.image_encode_seconds for r in page_results if r.image_encode_seconds is not None]
+    cache_hits = sum(1 for r in page_results if r.cache_hit is True)
+    cache_misses = sum(1 for r in page_results if r.cache_hit is False)
+    retried_pages = sum(1 for r in page_results if (r.attempts or 0) > 1)
+    packed_pages = sum(1 for r in page_results if r.pack_size)
+    pack_fallback_pages = sum(1 for r in page_results if r.pack_fallback)
 
     end_timestamp = time.time()
     total_processing_time_seconds = round(end_timestamp - start_timestamp, 2)
     aggregation_time_seconds = round(end_timestamp - aggregation_start_time, 3)
 
     # Store a snippet of the user prompt used in the summary
+    if prompts:
+        user_prompt = "; ".join(f"{named.name}: {named.prompt}" for named in prompts)
     prompt_snippet = user_prompt[:200] + "..." if len(user_prompt) > 200 else user_prompt
 
     processing_summary = {
@@ -69,26 +93,60 @@ def aggregate_processing_results(
         "successful_pages_count": successful_pages,
         "mock_pages_count": mock_pages,
         "pages_with_errors_count": pages_with_errors,
+        "timed_out_pages_count": timed_out_pages, # Page timeout or request deadline reached (included in errors)
         "processing_prompt_used_snippet": prompt_snippet, # Show snippet of actual prompt
         "aggregation_timestamp": datetime.now().isoformat(),
         "total_processing_time_seconds": total_processing_time_seconds,
         "aggregation_time_seconds": aggregation_time_seconds,
+        "max_queue_wait_seconds": round(max(queue_waits), 3) if queue_waits else 0.0, # Page scheduler wait
+        "total_queue_wait_seconds": round(sum(queue_waits), 3),
+        "total_image_payload_bytes": sum(payload_bytes), # Base64 page images uploaded (or looked up in the cache)
+        "total_image_encode_seconds": round(sum(encode_times), 3),
+        "page_cache_hits": cache_hits,     # Pages answered from the page cache without an LLM call
+        "page_cache_misses": cache_misses,
+        "retried_pages_count": retried_pages, # Pages that needed more than one LLM call
+        "packed_pages_count": packed_pages, # Pages answered by a call shared with other pages
+        "pack_fallback_pages_count": pack_fallback_pages, # Pages sent alone after their packed answer could not be split
+        "retry_budget": retry_stats or {},
+        "upload": upload_stats or {}, # Size, SHA-256 and receive throughput of the uploaded file
+        "subprocess_stats": subprocess_stats or {}, # libreoffice/pdftoppm/pdfinfo queue-wait, run and CPU time, peak RSS
         "pdf_metadata": pdf_metadata, # Include the raw parsed metadata
+        "prompts": _summarize_prompts(prompts, page_results) if prompts else {}, # Per named prompt: format and page counts
         # Add more summary fields as needed (e.g., average page processing time)
     }
 
     # Sort page results by page number just in case they arrive out of order
     sorted_page_results = sorted(page_results, key=lambda p: p.page_number)
 
+    prompt_results = None
+    if prompts:
+        prompt_results = {named.name: [r for r in sorted_page_results if r.prompt_name == named.name] for named in prompts}
+        sorted_page_results = []
+
     aggregated_result = AggregatedResult(
         job_id=job_id,
         processing_summary=processing_summary,
-        pages=sorted_page_results
+        pages=sorted_page_results,
+        prompt_results=prompt_results
     )
 
     logger.info(f"Result aggregation complete for job {job_id}. Processed {processed_pages}/{reported_total_pages} pages ({successful_pages} success, {pages_with_errors} errors).")
     return aggregated_result
 
+def _summarize_prompts(prompts: List[NamedPrompt], page_results: List[PageProcessingResult]) -> Dict[str, Dict[str, Any]]:
+    """Output format and successful/failed page counts per named prompt. (Pure Function)"""
+    successful_statuses = (PageProcessingStatus.SUCCESS, PageProcessingStatus.MOCK_SUCCESS)
+    summary = {}
+    for named in prompts:
+        results = [r for r in page_results if r.prompt_name == named.name]
+        successful = sum(1 for r in results if r.status in successful_statuses)
+        summary[named.name] = {
+            "output_format": named.output_format,
+            "successful_pages_count": successful,
+            "pages_with_errors_count": len(results) - successful,
+        }
+    return summary
+
 # Example Usage (optional)
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
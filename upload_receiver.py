@@ -0,0 +1,351 @@
+# upload_receiver.py - Streams multipart uploads straight into the request directory
+
+import asyncio
+import hashlib
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Set, Tuple
+
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+# File data is written (and hashed) off the event loop in batches of this size
+WRITE_BATCH_BYTES = 1024 * 1024
+# Non-file form fields (prompts, options) larger than this are rejected
+MAX_FIELD_BYTES = 1024 * 1024
+# Allowance for multipart boundaries, part headers and form fields when checking Content-Length
+MULTIPART_OVERHEAD_BYTES = MAX_FIELD_BYTES
+
+# Cumulative upload totals since startup (for /health)
+_upload_totals: Dict[str, float] = {"uploads": 0, "bytes": 0, "seconds": 0.0, "rejected_too_large": 0}
+
+
+class UploadError(ValueError):
+    """Raised when a multipart upload is malformed or lacks its file."""
+
+
+class UploadTooLargeError(UploadError):
+    """Raised when an upload exceeds the configured maximum size."""
+
+
+def safe_upload_filename(filename: Optional[str]) -> str:
+    """Replaces anything but letters, digits, '.', '-' and '_' so the name is safe on disk. (Pure Function)"""
+    safe_filename = "".join(c if c.isalnum() or c in ['.', '-', '_'] else '_' for c in (filename or ""))
+    return safe_filename or "uploaded_file"
+
+
+class ReceivedFile:
+    """One uploaded file, as written to disk."""
+
+    def __init__(self, filename: str, content_type: Optional[str], path: Path,
+                 size_bytes: int, sha256: str, receive_seconds: float):
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size_bytes = size_bytes
+        self.sha256 = sha256
+        self.receive_seconds = receive_seconds
+
+    @property
+    def throughput_mb_per_second(self) -> float:
+        return self.size_bytes / (1024 * 1024) / max(self.receive_seconds, 1e-6)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size_bytes": self.size_bytes,
+            "sha256": self.sha256,
+            "receive_seconds": round(self.receive_seconds, 3),
+            "throughput_mb_per_second": round(self.throughput_mb_per_second, 2),
+        }
+
+
+class ReceivedUpload(ReceivedFile):
+    """The form fields and the single file of a multipart request, as written to disk."""
+
+    def __init__(self, fields: Dict[str, str], filename: str, content_type: Optional[str], path: Path,
+                 size_bytes: int, sha256: str, receive_seconds: float):
+        super().__init__(filename, content_type, path, size_bytes, sha256, receive_seconds)
+        self.fields = fields
+
+
+def declared_body_size(request: Request) -> Optional[int]:
+    """The request's Content-Length, or None if it is absent or invalid (e.g. chunked uploads)."""
+    try:
+        return int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+
+
+class _IncomingFile:
+    """A file part being received: its metadata, its queued data and its open handle."""
+
+    def __init__(self, filename: str, content_type: Optional[str], path: Path):
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size_bytes = 0
+        self.digest = hashlib.sha256()
+        self.handle: Optional[BinaryIO] = None
+        self.pending: List[bytes] = [] # File data not yet written
+        self.pending_bytes = 0
+        self.ended = False # The part is complete; only pending data remains to be written
+        self.closed = False # Fully written and closed
+        self.started_at = time.monotonic()
+        self.ended_at: Optional[float] = None
+
+    def take_pending(self) -> bytes:
+        data = b"".join(self.pending)
+        self.pending.clear()
+        self.pending_bytes = 0
+        return data
+
+
+def _write_batch(handle: BinaryIO, digest: "hashlib._Hash", data: bytes) -> None:
+    digest.update(data)
+    handle.write(data)
+
+
+class _StreamingMultipartReceiver:
+    """python-multipart callbacks that keep form fields in memory and queue file data for writing."""
+
+    def __init__(self, file_fields: Tuple[str, ...], max_files: int, upload_dir: Path, max_bytes: int):
+        self.file_fields = file_fields
+        self.max_files = max_files
+        self.upload_dir = upload_dir
+        self.max_bytes = max_bytes
+        self.fields: Dict[str, str] = {}
+        self.files: List[_IncomingFile] = []
+        self.size_bytes = 0 # Across all files
+        self._used_names: Set[str] = set()
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._field_name: Optional[str] = None
+        self._field_data = bytearray()
+        self._file: Optional[_IncomingFile] = None # The file part being received
+
+    def callbacks(self) -> Dict[str, Any]:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def on_part_begin(self) -> None:
+        self._headers = {}
+        self._field_data = bytearray()
+        self._file = None
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _unique_path(self, filename: str) -> Path:
+        name = safe_upload_filename(filename)
+        stem, suffix = Path(name).stem, Path(name).suffix
+        counter = 1
+        while name in self._used_names:
+            counter += 1
+            name = f"{stem}_{counter}{suffix}"
+        self._used_names.add(name)
+        return self.upload_dir / name
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise UploadError('A multipart part has no Content-Disposition "name".')
+        self._field_name = options[b"name"].decode("utf-8", errors="replace")
+        if b"filename" not in options:
+            return
+        if self._field_name not in self.file_fields:
+            raise UploadError(f"Files may only be uploaded in the '{self.file_fields[0]}' field.")
+        if len(self.files) >= self.max_files:
+            if self.max_files == 1:
+                raise UploadError(f"Only one file, in the '{self.file_fields[0]}' field, may be uploaded.")
+            raise UploadTooLargeError(f"At most {self.max_files} files may be uploaded in one request.")
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        content_type = self._headers.get(b"content-type")
+        self._file = _IncomingFile(filename, content_type.decode("latin-1") if content_type else None, self._unique_path(filename))
+        self.files.append(self._file)
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._file is not None:
+            self.size_bytes += end - start
+            if self.max_bytes and self.size_bytes > self.max_bytes:
+                raise UploadTooLargeError(f"Uploaded data exceeds the maximum size of {self.max_bytes} bytes.")
+            self._file.size_bytes += end - start
+            self._file.pending.append(data[start:end])
+            self._file.pending_bytes += end - start
+        else:
+            if len(self._field_data) + end - start > MAX_FIELD_BYTES:
+                raise UploadError(f"Form field '{self._field_name}' exceeds {MAX_FIELD_BYTES} bytes.")
+            self._field_data.extend(data[start:end])
+
+    def on_part_end(self) -> None:
+        if self._file is not None:
+            self._file.ended = True
+            self._file.ended_at = time.monotonic()
+        elif self._field_name is not None:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", errors="replace")
+
+
+async def _flush_files(files: List[_IncomingFile], final: bool = False) -> None:
+    """Writes each file's queued data once a batch is full, or all of it once its part has ended (or `final`)."""
+    for incoming in files:
+        if incoming.closed:
+            continue
+        if incoming.handle is None:
+            incoming.handle = await asyncio.to_thread(open, incoming.path, "wb")
+        ended = incoming.ended or final
+        if incoming.pending_bytes >= WRITE_BATCH_BYTES or (ended and incoming.pending):
+            await asyncio.to_thread(_write_batch, incoming.handle, incoming.digest, incoming.take_pending())
+        if ended:
+            await asyncio.to_thread(incoming.handle.close)
+            incoming.handle = None
+            incoming.closed = True
+
+
+async def _receive_multipart(
+    request: Request,
+    upload_dir: Path,
+    file_fields: Tuple[str, ...],
+    max_files: int,
+    max_bytes: int,
+) -> Tuple[_StreamingMultipartReceiver, float]:
+    """Streams the body through the parser, writing each file part once; returns the receiver and receive time."""
+    declared = declared_body_size(request)
+    if max_bytes and declared is not None and declared > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        _upload_totals["rejected_too_large"] += 1
+        raise UploadTooLargeError(f"Request body of {declared} bytes exceeds the maximum upload size of {max_bytes} bytes.")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data request with a boundary.")
+
+    receiver = _StreamingMultipartReceiver(file_fields, max_files, upload_dir, max_bytes)
+    parser = MultipartParser(params[b"boundary"], receiver.callbacks())
+    written = 0 # Leading files of receiver.files that are fully written
+    start_time = time.monotonic()
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                parser.write(chunk)
+            await _flush_files(receiver.files[written:])
+            while written < len(receiver.files) and receiver.files[written].closed:
+                written += 1
+        parser.finalize()
+        if not receiver.files:
+            raise UploadError(f"No file was uploaded in the '{file_fields[0]}' field.")
+        await _flush_files(receiver.files[written:], final=True)
+    except UploadTooLargeError:
+        _upload_totals["rejected_too_large"] += 1
+        raise
+    except FormParserError as e:
+        raise UploadError(f"Invalid multipart data: {e}") from e
+    finally:
+        for incoming in receiver.files:
+            if incoming.handle is not None:
+                await asyncio.to_thread(incoming.handle.close)
+                incoming.handle = None
+
+    receive_seconds = time.monotonic() - start_time
+    _upload_totals["uploads"] += 1
+    _upload_totals["bytes"] += receiver.size_bytes
+    _upload_totals["seconds"] += receive_seconds
+    return receiver, receive_seconds
+
+
+def _received_file(incoming: _IncomingFile, receive_seconds: float) -> ReceivedFile:
+    return ReceivedFile(
+        filename=incoming.filename or incoming.path.name,
+        content_type=incoming.content_type,
+        path=incoming.path,
+        size_bytes=incoming.size_bytes,
+        sha256=incoming.digest.hexdigest(),
+        receive_seconds=receive_seconds,
+    )
+
+
+async def receive_multipart_upload(
+    request: Request,
+    upload_dir: Path,
+    file_field: str = "file",
+    max_bytes: int = 0,
+) -> ReceivedUpload:
+    """
+    Parses a multipart/form-data request body as it arrives, writing the file in the
+    `file_field` part once, directly into `upload_dir`, and computing its SHA-256 on the
+    way. Other parts are returned as text fields.
+
+    A Content-Length that already exceeds `max_bytes` (0 = no limit) is rejected before
+    anything is read, and the upload is aborted as soon as the file passes the limit.
+
+    Raises:
+        UploadTooLargeError: If the file is larger than `max_bytes`.
+        UploadError: If the body is not valid multipart data or contains no file.
+        starlette.requests.ClientDisconnect: If the client went away mid-upload.
+    """
+    receiver, receive_seconds = await _receive_multipart(request, upload_dir, (file_field,), 1, max_bytes)
+    received = _received_file(receiver.files[0], receive_seconds)
+    upload = ReceivedUpload(fields=receiver.fields, **vars(received))
+    logger.info(
+        f"Received upload '{upload.filename}' ({upload.size_bytes} bytes, sha256 {upload.sha256[:12]}) "
+        f"in {receive_seconds:.2f}s ({upload.throughput_mb_per_second:.1f} MB/s)."
+    )
+    return upload
+
+
+async def receive_multipart_files(
+    request: Request,
+    upload_dir: Path,
+    file_fields: Tuple[str, ...] = ("files", "file"),
+    max_files: int = 0,
+    max_bytes: int = 0,
+) -> Tuple[Dict[str, str], List[ReceivedFile]]:
+    """
+    Like receive_multipart_upload, but accepts any number of file parts (up to
+    `max_files`, 0 = no limit) in any of `file_fields`; `max_bytes` limits their total
+    size. Names that collide on disk get a numeric suffix.
+
+    Returns:
+        (fields, files), with files in upload order.
+
+    Raises:
+        UploadTooLargeError: If the files are larger than `max_bytes` or too many.
+        UploadError: If the body is not valid multipart data or contains no file.
+        starlette.requests.ClientDisconnect: If the client went away mid-upload.
+    """
+    receiver, receive_seconds = await _receive_multipart(request, upload_dir, file_fields, max_files or sys.maxsize, max_bytes)
+    files = [
+        _received_file(incoming, (incoming.ended_at or time.monotonic()) - incoming.started_at)
+        for incoming in receiver.files
+    ]
+    logger.info(
+        f"Received {len(files)} uploaded file(s) ({receiver.size_bytes} bytes) in {receive_seconds:.2f}s "
+        f"({receiver.size_bytes / (1024 * 1024) / max(receive_seconds, 1e-6):.1f} MB/s)."
+    )
+    return receiver.fields, files
+
+
+def get_upload_totals() -> Dict[str, Any]:
+    """Returns cumulative upload count, bytes, receive time and rejections since startup (for /health)."""
+    totals = dict(_upload_totals)
+    totals["seconds"] = round(totals["seconds"], 3)
+    totals["mb_per_second"] = round(totals["bytes"] / (1024 * 1024) / totals["seconds"], 2) if totals["seconds"] else 0.0
+    return totals
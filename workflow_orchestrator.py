@@ -6,21 +6,39 @@ import time
 import shutil
 import json # For meta-context synthesis
 from pathlib import Path
-from typing import List, Optional, Dict, Any, Union
+from typing import List, Optional, Dict, Any, Union, Callable, Tuple
 
 # Import models and functions from other modules
 from models import (
     AppSettings, PageProcessingResult, PageProcessingStatus,
-    AggregatedResult
+    AggregatedResult, JobStatus, RenderProfile, NamedPrompt
+)
+from job_store import BaseJobStore
+from document_converter import (
+    convert_to_pdf_libreoffice, sniff_document_type,
+    DOCUMENT_KIND_PDF, DOCUMENT_KIND_IMAGE
+)
+from pdf_processor import (
+    extract_pdf_pages_as_png, extract_pdf_metadata, parse_pdfinfo_output,
+    LazyPdfPageRenderer, pdftoppm_scale_args
+)
+from image_processor import (
+    encode_image_to_base64, read_image_dimensions, convert_image_to_webp, WEBP_AVAILABLE
 )
-from document_converter import convert_to_pdf_libreoffice
-from pdf_processor import extract_pdf_pages_as_png, extract_pdf_metadata, parse_pdfinfo_output
-from image_processor import encode_image_to_base64
 from resetdata_ai_adapter import (
     call_resetdata_openai_api,
+    call_resetdata_openai_api_packed,
     parse_and_validate_ai_output,
+    parse_packed_ai_output,
 )
+from llm_retry import (
+    RetryBudget, CAUSE_PAGE_TIMEOUT, CAUSE_REQUEST_DEADLINE, CAUSE_CLIENT_ERROR, CAUSE_EMPTY_CONTENT
+)
+from admission_control import AdmissionTicket, PAGE_MEMORY_COPIES
 from result_aggregator import aggregate_processing_results
+from page_scheduler import get_page_scheduler
+from page_cache import get_page_cache, make_page_cache_key
+from external_commands import subprocess_timing_scope, summarize_subprocess_timings, ResourceLimitExceededError
 
 logger = logging.getLogger(__name__)
 
@@ -29,62 +47,73 @@ META_PROMPT_TEMPLATE = (Path(__file__).parent / "prompts" / "meta_prompt.txt").r
 
 MAX_META_PAGES = 3 # Number of initial pages to scan for meta context
 
+# Packed calls that fail this way are retried page by page (e.g. too many images for the model)
+PACK_FALLBACK_CAUSES = (CAUSE_CLIENT_ERROR, CAUSE_EMPTY_CONTENT)
+
+# Requests abandoned mid-processing (client disconnect, closed stream) and the page
+# tasks cancelled with them, since startup
+_cancellation_stats: Dict[str, int] = {"requests_cancelled": 0, "pages_cancelled": 0}
+
+
+def get_cancellation_stats() -> Dict[str, int]:
+    """Returns counts of cancelled requests and pages since startup (for /health)."""
+    return dict(_cancellation_stats)
+
 
 # --- Helper Function for Single Page Processing ---
 
 async def _process_single_page(
     page_num: int,
-    screenshot_path: Path,
+    image_base64: str,
     prompt_to_use: str, # Renamed from user_prompt for clarity
     output_format: str,
     job_dir: Path, # For saving individual results if needed
     config: AppSettings,
-    llm_api_key: str
+    llm_api_key: str,
+    image_mime_type: str = "image/png",
+    retry_budget: Optional[RetryBudget] = None
 ) -> PageProcessingResult:
     """
-    Processes a single page: encode image, call AI (or mock), parse, validate.
-    Designed to be run concurrently for multiple pages.
+    Processes a single already-encoded page: call AI (or mock), parse, validate.
+    Designed to be run concurrently for multiple pages. Transient LLM failures are
+    retried by the adapter, drawing on the document's `retry_budget`.
     """
     page_start_time = time.time()
-    logger.info(f"Starting processing for page {page_num} ({screenshot_path.name}).")
+    logger.info(f"Starting processing for page {page_num}.")
 
-    # 1. Encode image
-    img_base64, img_err = encode_image_to_base64(screenshot_path)
-    if img_err:
-        logger.error(f"Page {page_num}: Failed to encode image: {img_err}")
-        return PageProcessingResult(
-            page_number=page_num,
-            status=PageProcessingStatus.ERROR_IMAGE_ENCODING,
-            error_message=f"Failed to encode image: {img_err}"
-        )
-
-    # 2. Call ResetData API (requires per-job llm_api_key)
-    response_json, error_status, error_msg = await call_resetdata_openai_api(
-        image_base64=img_base64,
+    # 1. Call ResetData API (requires per-job llm_api_key)
+    response_json, error_status, error_msg, attempts, error_cause = await call_resetdata_openai_api(
+        image_base64=image_base64,
+        image_mime_type=image_mime_type,
         prompt_text=prompt_to_use,
         config=config,
         page_number=page_num,
         llm_api_key=llm_api_key,
         output_format=output_format,
+        retry_budget=retry_budget,
     )
     if error_msg:
         return PageProcessingResult(
             page_number=page_num,
             status=error_status or PageProcessingStatus.ERROR_API,
-            error_message=error_msg
+            error_message=error_msg,
+            attempts=attempts,
+            final_error_cause=error_cause
         )
 
-    # 3. We get text content directly from the ResetData call
+    # 2. We get text content directly from the ResetData call
     extracted_text = response_json["candidates"][0]["content"]["parts"][0]["text"] if response_json else None
     if not extracted_text:
         return PageProcessingResult(
             page_number=page_num,
             status=PageProcessingStatus.ERROR_PARSING,
             error_message="Empty content returned from LLM",
-            raw_response=str(response_json)[:1000] if response_json else None
+            raw_response=str(response_json)[:1000] if response_json else None,
+            attempts=attempts,
+            final_error_cause=error_cause
         )
 
-    # 4. Parse/Validate AI Output Content (JSON or Text) based on requested format
+    # 3. Parse/Validate AI Output Content (JSON or Text) based on requested format
     requested_format = "application/json" if output_format == "json" else "text/plain"
     result_data: Optional[Union[Dict[str, Any], str]]
     result_data, validation_status, validation_err = parse_and_validate_ai_output(
@@ -98,241 +127,550 @@ async def _process_single_page(
             status=validation_status or PageProcessingStatus.ERROR_PARSING,
             error_message=validation_err,
             raw_response=extracted_text[:1000],
-            data=result_data # Still include the raw text data if parsing failed
+            data=result_data, # Still include the raw text data if parsing failed
+            attempts=attempts
         )
 
-    # 5. Success Case
+    # 4. Success Case
     page_end_time = time.time()
     logger.info(f"Page {page_num}: Processing successful in {page_end_time - page_start_time:.2f} seconds.")
     return PageProcessingResult(
         page_number=page_num,
         status=PageProcessingStatus.SUCCESS,
-        data=result_data # Can be dict or string
+        data=result_data, # Can be dict or string
+        attempts=attempts
     )
 
 
-# --- Main Workflow Orchestration Function ---
+async def _process_single_page_cached(
+    page_num: int,
+    image_base64: str,
+    config: AppSettings,
+    **page_kwargs: Any
+) -> PageProcessingResult:
+    """
+    Returns the cached result for this page image/prompt/model/format if there is one,
+    otherwise runs _process_single_page and caches a successful result.
+    """
+    page_cache = get_page_cache(config)
+    if page_cache is None:
+        return await _process_single_page(page_num=page_num, image_base64=image_base64, config=config, **page_kwargs)
 
-async def process_document_workflow(
-    job_id: str,
-    config: AppSettings
-) -> None:
+    cache_key = make_page_cache_key(
+        image_base64, page_kwargs["prompt_to_use"], config.resetdata_model, page_kwargs["output_format"],
+        page_kwargs["llm_api_key"]
+    )
+    cached = await page_cache.get(cache_key, page_num)
+    if cached is not None:
+        logger.info(f"Page {page_num}: Served from page cache.")
+        return cached
+
+    result = await _process_single_page(page_num=page_num, image_base64=image_base64, config=config, **page_kwargs)
+    await page_cache.put(cache_key, result)
+    result.cache_hit = False
+    return result
+
+
+def _page_render_format(config: AppSettings) -> Tuple[str, Optional[int]]:
     """
-    Orchestrates the entire document processing workflow asynchronously.
-    Includes optional two-pass meta intelligence processing.
+    Maps config.page_image_format to (pdftoppm output format, WebP quality or None).
+    WebP pages are rendered losslessly as PNG and re-encoded; without Pillow, JPEG is used instead.
     """
-    # Deprecated: kept temporarily to avoid import errors if referenced.
-    logger.error("Deprecated process_document_workflow called. Use process_document_stateless instead.")
-    return
+    if config.page_image_format == "webp":
+        if WEBP_AVAILABLE:
+            return "png", config.page_image_quality
+        logger.warning("PAGE_IMAGE_FORMAT=webp needs the Pillow package; rendering pages as JPEG instead.")
+        return "jpeg", None
+    return config.page_image_format, None
 
-    input_file_path = Path(job.input_file_path)
-    job_dir = Path(job.job_dir)
-    pdf_path: Optional[Path] = None
-    screenshot_paths: List[Path] = []
-    pdf_metadata: Dict[str, Any] = {}
-    page_results: List[PageProcessingResult] = []
-    meta_context: str = ""
 
-    # Define progress steps
-    PROGRESS_VALIDATION = 5.0
-    PROGRESS_CONVERSION = 15.0
-    PROGRESS_METADATA_SCREENSHOTS = 30.0
-    PROGRESS_START_META = 35.0
-    PROGRESS_END_META_START_MAIN = 50.0
-    PROGRESS_END_MAIN = 95.0
-    PROGRESS_AGGREGATING = 98.0
+class _PageImageSource:
+    """
+    Supplies base64-encoded page images to page tasks.
+
+    Pages come either from a fixed list of image files (image uploads, or PDFs whose
+    page count is unknown and were rendered up front) or from a LazyPdfPageRenderer.
+    Rendered images are deleted as soon as they are encoded, and are re-encoded as WebP
+    first when `webp_quality` is set. Pages loaded with keep=True (the meta pass) stay
+    encoded in memory until the main pass loads them again. With `loads_per_page` > 1
+    (one main-pass task per named prompt) a page is rendered and encoded once and kept
+    until all its tasks have loaded it; tasks asking for a page being encoded wait for it.
+    Pixel size, MIME type, payload size and encode time of every loaded page are recorded
+    in `image_info`.
+    """
 
-    try:
-        logger.info(f"Starting workflow for job {job_id} ('{job.document_name}'). MetaInt: {job.use_meta_intelligence}")
-
-        # 1. Validation
-        await asyncio.sleep(0.01)
-        job_store.update_job_status(job_id, JobStatus.VALIDATING, progress=PROGRESS_VALIDATION)
-        if not input_file_path.exists():
-            raise ValueError(f"Input file disappeared before processing: {input_file_path}")
-        logger.info(f"Job {job_id}: Input file validation successful.")
-
-        # --- Determine if input is an image ---
-        image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
-        is_image_input = input_file_path.suffix.lower() in image_extensions
-
-        if is_image_input:
-            logger.info(f"Job {job_id}: Input file detected as image. Skipping conversion and PDF processing.")
-            screenshot_paths = [input_file_path]
-            pdf_metadata = {"pages": 1, "source_type": "image"}
-            # Skip to the progress level where main processing starts
-            job_store.update_job_status(job_id, JobStatus.PROCESSING, progress=PROGRESS_END_META_START_MAIN)
+    def __init__(
+        self,
+        paths: Optional[List[Path]] = None,
+        renderer: Optional[LazyPdfPageRenderer] = None,
+        delete_after_encode: bool = False,
+        webp_quality: Optional[int] = None
+    ):
+        self._paths = paths or []
+        self._renderer = renderer
+        self._delete_after_encode = delete_after_encode
+        self._webp_quality = webp_quality
+        self._kept: Dict[int, Tuple[str, str]] = {}
+        self._loads_left: Dict[int, int] = {} # Main-pass loads still expected for each kept page
+        self._encoding: Dict[int, asyncio.Event] = {} # Pages being rendered/encoded right now
+        self.loads_per_page = 1
+        self.image_info: Dict[int, Dict[str, Any]] = {}
+
+    @property
+    def total_pages(self) -> int:
+        return self._renderer.total_pages if self._renderer else len(self._paths)
+
+    async def load(self, page_num: int, keep: bool = False) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        """
+        Returns (image_base64, mime_type, None), or (None, None, error_message), for a 1-based page number.
+        """
+        while page_num in self._encoding:
+            await self._encoding[page_num].wait()
+        if page_num in self._kept:
+            img_base64, mime_type = self._kept[page_num]
+            if not keep:
+                self._loads_left[page_num] -= 1
+                if self._loads_left[page_num] <= 0:
+                    del self._kept[page_num], self._loads_left[page_num]
+            return img_base64, mime_type, None
+
+        self._encoding[page_num] = asyncio.Event()
+        try:
+            img_base64, mime_type, img_err = await self._encode(page_num)
+        finally:
+            self._encoding.pop(page_num).set()
+        loads_left = self.loads_per_page if keep else self.loads_per_page - 1
+        if img_base64 and loads_left > 0:
+            self._kept[page_num] = (img_base64, mime_type)
+            self._loads_left[page_num] = loads_left
+        return img_base64, mime_type, img_err
+
+    async def _encode(self, page_num: int) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        if self._renderer:
+            screenshot_path, render_err = await self._renderer.get_page(page_num)
+            if screenshot_path is None:
+                return None, None, f"Failed to render page: {render_err}"
         else:
-            # --- Document Processing Path ---
-            # 2. Convert to PDF
-            job_store.update_job_status(job_id, JobStatus.CONVERTING, progress=PROGRESS_CONVERSION)
-            convert_success, pdf_path, convert_error = await convert_to_pdf_libreoffice(input_file_path, job_dir / "converted", config)
-            if not convert_success or not pdf_path:
-                raise RuntimeError(f"Document conversion failed: {convert_error}")
-            logger.info(f"Job {job_id}: Conversion to PDF successful: {pdf_path.name}")
-
-            # 3. Extract Metadata & 4. Generate Screenshots (can run in parallel)
-            job_store.update_job_status(job_id, JobStatus.PROCESSING, progress=PROGRESS_METADATA_SCREENSHOTS) # Progress before these tasks
-
-            meta_task = asyncio.create_task(extract_pdf_metadata(pdf_path, config))
-            screenshot_task = asyncio.create_task(extract_pdf_pages_as_png(pdf_path, job_dir / "screenshots", config))
-
-            # Wait for metadata extraction
-            meta_success, meta_stdout, meta_stderr = await meta_task
-            if meta_success:
-                pdf_metadata = parse_pdfinfo_output(meta_stdout)
-                logger.info(f"Job {job_id}: Metadata extracted. Pages: {pdf_metadata.get('pages', 'N/A')}")
+            screenshot_path = self._paths[page_num - 1]
+
+        encode_start = time.monotonic()
+        image_path = screenshot_path
+        if self._webp_quality is not None:
+            webp_path, webp_err = await asyncio.to_thread(convert_image_to_webp, screenshot_path, self._webp_quality)
+            if webp_path is not None:
+                image_path = webp_path
             else:
-                logger.warning(f"Job {job_id}: Failed to extract PDF metadata. Stderr: {meta_stderr}")
-                job_store.add_job_error(job_id, "METADATA_EXTRACTION_FAILED", meta_stderr or "pdfinfo command failed.", recoverable=True)
-            pdf_metadata["source_type"] = "document"
-
-            # Wait for screenshot generation
-            ss_success, screenshot_paths, ss_error = await screenshot_task
-            if not ss_success or not screenshot_paths:
-                raise RuntimeError(f"Screenshot generation failed: {ss_error}")
-            elif ss_error:
-                 logger.warning(f"Job {job_id}: Warnings during screenshot generation: {ss_error}")
-                 job_store.add_job_error(job_id, "SCREENSHOT_WARNINGS", ss_error, recoverable=True)
-
-            logger.info(f"Job {job_id}: Generated {len(screenshot_paths)} screenshots.")
-            if not screenshot_paths:
-                 raise RuntimeError("Screenshot generation reported success but produced no files.")
-            # Progress updated before Meta Pass check
-
-
-        # 5. Meta Intelligence Pass (Optional)
-        if job.use_meta_intelligence and not is_image_input:
-            logger.info(f"Job {job_id}: Running Meta Intelligence Pass...")
-            job_store.update_job_status(job_id, JobStatus.PROCESSING, progress=PROGRESS_START_META)
-
-            meta_pages_to_scan = min(len(screenshot_paths), MAX_META_PAGES)
-            meta_tasks = []
-            for i in range(meta_pages_to_scan):
-                page_num = i + 1
-                task = asyncio.create_task(
-                    _process_single_page(
-                        page_num=page_num, screenshot_path=screenshot_paths[i],
-                        prompt_to_use=META_PROMPT_TEMPLATE, output_format="json",
-                        job_dir=job_dir / "meta_results", config=config, llm_api_key=job.llm_api_key
-                    ), name=f"Job_{job_id}_MetaPage_{page_num}"
-                )
-                meta_tasks.append(task)
-
-            meta_results_raw = await asyncio.gather(*meta_tasks, return_exceptions=True)
-
-            successful_meta_results = []
-            for i, res in enumerate(meta_results_raw):
-                page_num = i + 1
-                if isinstance(res, Exception): logger.error(f"Job {job_id}: Error during meta scan for page {page_num}: {res}")
-                elif isinstance(res, PageProcessingResult):
-                    if res.status != PageProcessingStatus.SUCCESS: logger.warning(f"Job {job_id}: Meta scan page {page_num} failed: {res.status} - {res.error_message}")
-                    elif res.data and isinstance(res.data, dict): successful_meta_results.append(res.data)
-                else: logger.error(f"Job {job_id}: Unexpected result type during meta scan page {page_num}: {type(res)}")
-
-            if successful_meta_results:
-                 meta_context = "Document Context Summary (from first {} page(s)):\n".format(len(successful_meta_results))
-                 for i, data in enumerate(successful_meta_results): meta_context += f"- Page {i+1}: {json.dumps(data)}\n"
-                 meta_context = meta_context.strip()
-                 logger.info(f"Job {job_id}: Synthesized meta context: {meta_context[:300]}...")
-            else: logger.warning(f"Job {job_id}: Meta Intelligence scan yielded no successful results.")
-
-            job_store.update_job_status(job_id, JobStatus.PROCESSING, progress=PROGRESS_END_META_START_MAIN)
+                logger.warning(f"Page {page_num}: {webp_err}; sending the rendered image instead.")
+        image_size = read_image_dimensions(image_path)
+        img_base64, mime_type, img_err = encode_image_to_base64(image_path)
+        if self._renderer:
+            self._renderer.release_page(page_num)
+            if image_path != screenshot_path:
+                image_path.unlink(missing_ok=True)
+        elif self._delete_after_encode:
+            image_path.unlink(missing_ok=True)
+        if img_base64:
+            self.image_info[page_num] = {
+                "size": image_size,
+                "mime_type": mime_type,
+                "payload_bytes": len(img_base64),
+                "encode_seconds": round(time.monotonic() - encode_start, 3),
+            }
+        return img_base64, mime_type, img_err
+
+    async def aclose(self) -> None:
+        self._kept.clear()
+        self._loads_left.clear()
+        if self._renderer:
+            await self._renderer.aclose()
+
+
+async def _load_and_process_page(
+    page_source: _PageImageSource,
+    page_num: int,
+    config: AppSettings,
+    keep_image: bool,
+    admission_ticket: Optional[AdmissionTicket] = None,
+    **page_kwargs: Any
+) -> PageProcessingResult:
+    img_base64, mime_type, img_err = await page_source.load(page_num, keep=keep_image)
+    if img_err:
+        logger.error(f"Page {page_num}: Failed to encode image: {img_err}")
+        return PageProcessingResult(
+            page_number=page_num,
+            status=PageProcessingStatus.ERROR_IMAGE_ENCODING,
+            error_message=f"Failed to encode image: {img_err}"
+        )
+    # Counted against the admission memory budget while the page is in flight
+    page_bytes = len(img_base64) * PAGE_MEMORY_COPIES
+    if admission_ticket is not None:
+        admission_ticket.reserve_bytes(page_bytes)
+    try:
+        return await _process_single_page_cached(page_num, img_base64, config, image_mime_type=mime_type, **page_kwargs)
+    finally:
+        if admission_ticket is not None:
+            admission_ticket.release_bytes(page_bytes)
+
+
+async def _process_single_page_scheduled(
+    scheduler_owner: str,
+    page_source: _PageImageSource,
+    page_num: int,
+    config: AppSettings,
+    keep_image: bool = False,
+    page_timeout: Optional[float] = None,
+    admission_ticket: Optional[AdmissionTicket] = None,
+    **page_kwargs: Any
+) -> PageProcessingResult:
+    """
+    Loads (renders/encodes) one page and runs _process_single_page on it inside a slot
+    of the process-wide page scheduler, so the number of pages being worked on at once
+    never exceeds config.max_workers.
+
+    Work that takes longer than `page_timeout` seconds once the slot is granted is
+    cancelled and reported as ERROR_TIMEOUT; any other exception becomes an
+    ERROR_UNKNOWN result, so one page never fails the document.
+    """
+    scheduler = get_page_scheduler(config)
+    async with scheduler.slot(scheduler_owner) as queue_wait:
+        if queue_wait > 0:
+            logger.debug(f"Page {page_num} of '{scheduler_owner}' waited {queue_wait:.2f}s for a scheduler slot.")
+        try:
+            result = await asyncio.wait_for(
+                _load_and_process_page(page_source, page_num, config, keep_image, admission_ticket, **page_kwargs),
+                timeout=page_timeout or None
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Page {page_num}: Processing exceeded the {page_timeout:g}s page timeout.")
+            result = PageProcessingResult(
+                page_number=page_num,
+                status=PageProcessingStatus.ERROR_TIMEOUT,
+                error_message=f"Page processing exceeded the {page_timeout:g}s page timeout.",
+                final_error_cause=CAUSE_PAGE_TIMEOUT
+            )
+        except Exception as e:
+            logger.error(f"Page {page_num}: Unexpected error during processing: {e.__class__.__name__}: {e}", exc_info=True)
+            result = PageProcessingResult(
+                page_number=page_num,
+                status=PageProcessingStatus.ERROR_UNKNOWN,
+                error_message=f"Unexpected error processing page: {e.__class__.__name__}: {e}"
+            )
+    _annotate_page_result(result, page_source, queue_wait)
+    return result
+
+
+def _annotate_page_result(result: PageProcessingResult, page_source: _PageImageSource, queue_wait: float) -> None:
+    """Adds the scheduler wait and the page image's size, type and encode time to a result."""
+    result.queue_wait_seconds = round(queue_wait, 3)
+    image_info = page_source.image_info.get(result.page_number)
+    if image_info:
+        if image_info["size"]:
+            result.image_width_px, result.image_height_px = image_info["size"]
+        result.image_mime_type = image_info["mime_type"]
+        result.image_payload_bytes = image_info["payload_bytes"]
+        result.image_encode_seconds = image_info["encode_seconds"]
+
+
+async def _process_page_pack(
+    page_source: _PageImageSource,
+    page_nums: List[int],
+    config: AppSettings,
+    results: Dict[int, PageProcessingResult],
+    admission_ticket: Optional[AdmissionTicket],
+    prompt_to_use: str,
+    output_format: str,
+    **page_kwargs: Any
+) -> None:
+    """
+    Loads the pages of a pack and answers them with one packed LLM call, filling
+    `results` page by page. Cached pages are not sent; pages the packed answer could
+    not be split for (or all of them, if the call failed with one of
+    PACK_FALLBACK_CAUSES) are sent again one at a time.
+    """
+    loaded: List[Tuple[int, str, str]] = []
+    for page_num in page_nums:
+        img_base64, mime_type, img_err = await page_source.load(page_num)
+        if img_err:
+            logger.error(f"Page {page_num}: Failed to encode image: {img_err}")
+            results[page_num] = PageProcessingResult(
+                page_number=page_num,
+                status=PageProcessingStatus.ERROR_IMAGE_ENCODING,
+                error_message=f"Failed to encode image: {img_err}"
+            )
         else:
-             logger.info(f"Job {job_id}: Skipping Meta Intelligence Pass.")
-             # Ensure progress is at least at the start point for main processing if skipping
-             if job.status == JobStatus.PROCESSING and job.progress < PROGRESS_END_META_START_MAIN:
-                 job_store.update_job_status(job_id, JobStatus.PROCESSING, progress=PROGRESS_END_META_START_MAIN)
-
-
-        # 6. Main Processing Pass (All Pages)
-        logger.info(f"Job {job_id}: Starting Main Processing Pass...")
-        total_pages_to_process = len(screenshot_paths)
-        tasks = []
-        final_user_prompt = job.user_prompt
-
-        if meta_context:
-             final_user_prompt = f"DOCUMENT CONTEXT:\n{meta_context}\n\n---\n\nUSER TASK:\n{job.user_prompt}"
-             logger.debug(f"Job {job_id}: Using combined prompt for main pass.")
-
-        for i, screenshot_path in enumerate(screenshot_paths):
-            page_num = i + 1
-            task = asyncio.create_task(
-                _process_single_page(
-                    page_num=page_num, screenshot_path=screenshot_path,
-                    prompt_to_use=final_user_prompt, output_format=job.output_format,
-                    job_dir=job_dir / "page_results", config=config, llm_api_key=job.llm_api_key
-                ), name=f"Job_{job_id}_MainPage_{page_num}"
+            loaded.append((page_num, img_base64, mime_type))
+
+    # Counted against the admission memory budget while the pages are in flight
+    pack_bytes = sum(len(img_base64) for _, img_base64, _ in loaded) * PAGE_MEMORY_COPIES
+    if admission_ticket is not None:
+        admission_ticket.reserve_bytes(pack_bytes)
+    try:
+        # Packed answers are cached apart from single-page ones, since the model saw other pages too
+        page_cache = get_page_cache(config)
+        cache_keys: Dict[int, str] = {}
+        to_send: List[Tuple[int, str, str]] = []
+        for page_num, img_base64, mime_type in loaded:
+            if page_cache is not None:
+                cache_keys[page_num] = make_page_cache_key(
+                    img_base64, prompt_to_use, config.resetdata_model, f"{output_format}:packed",
+                    page_kwargs["llm_api_key"]
+                )
+                cached = await page_cache.get(cache_keys[page_num], page_num)
+                if cached is not None:
+                    logger.info(f"Page {page_num}: Served from page cache.")
+                    results[page_num] = cached
+                    continue
+            to_send.append((page_num, img_base64, mime_type))
+
+        split: Dict[int, Any] = {}
+        if len(to_send) > 1:
+            response_json, error_status, error_msg, attempts, error_cause = await call_resetdata_openai_api_packed(
+                pages=to_send,
+                prompt_text=prompt_to_use,
+                config=config,
+                llm_api_key=page_kwargs["llm_api_key"],
+                output_format=output_format,
+                retry_budget=page_kwargs.get("retry_budget"),
             )
-            tasks.append(task)
+            if error_msg and error_cause not in PACK_FALLBACK_CAUSES:
+                for page_num, _, _ in to_send:
+                    results[page_num] = PageProcessingResult(
+                        page_number=page_num,
+                        status=error_status or PageProcessingStatus.ERROR_API,
+                        error_message=error_msg,
+                        attempts=attempts,
+                        final_error_cause=error_cause,
+                        pack_size=len(to_send)
+                    )
+                return
+            extracted_text = response_json["candidates"][0]["content"]["parts"][0]["text"] if response_json else None
+            if extracted_text:
+                requested_format = "application/json" if output_format == "json" else "text/plain"
+                split = parse_packed_ai_output(extracted_text, [page_num for page_num, _, _ in to_send], requested_format)
+            for page_num, _, _ in to_send:
+                if page_num in split:
+                    result = PageProcessingResult(
+                        page_number=page_num,
+                        status=PageProcessingStatus.SUCCESS,
+                        data=split[page_num],
+                        attempts=attempts,
+                        pack_size=len(to_send)
+                    )
+                    if page_cache is not None:
+                        await page_cache.put(cache_keys[page_num], result)
+                        result.cache_hit = False
+                    results[page_num] = result
+
+        for page_num, img_base64, mime_type in to_send:
+            if page_num in results:
+                continue
+            result = await _process_single_page_cached(
+                page_num, img_base64, config, image_mime_type=mime_type,
+                prompt_to_use=prompt_to_use, output_format=output_format, **page_kwargs
+            )
+            if len(to_send) > 1:
+                result.pack_fallback = True
+            results[page_num] = result
+    finally:
+        if admission_ticket is not None:
+            admission_ticket.release_bytes(pack_bytes)
 
-        completed_tasks = 0
-        progress_range = PROGRESS_END_MAIN - PROGRESS_END_META_START_MAIN
 
-        for future in asyncio.as_completed(tasks):
-            try:
-                result: PageProcessingResult = await future
-                page_results.append(result)
-                completed_tasks += 1
-                current_progress = PROGRESS_END_META_START_MAIN + (completed_tasks / total_pages_to_process) * progress_range
-                job_store.update_job_status(job_id, JobStatus.PROCESSING, progress=current_progress)
-                logger.info(f"Job {job_id}: Completed processing page {result.page_number} (Status: {result.status}). Progress: {current_progress:.1f}%")
-            except Exception as e:
-                 logger.error(f"Job {job_id}: Unexpected error waiting for page processing task: {e}", exc_info=True)
-
-
-        logger.info(f"Job {job_id}: Finished main processing pass for {total_pages_to_process} pages.")
-
-        # 7. Aggregate Results
-        job_store.update_job_status(job_id, JobStatus.AGGREGATING, progress=PROGRESS_AGGREGATING)
-        if not page_results and total_pages_to_process > 0:
-             raise RuntimeError("Aggregation failed: No page processing results were collected.")
-        elif not page_results and total_pages_to_process == 0:
-             logger.warning(f"Job {job_id}: No pages found to process or aggregate.")
-             page_results = []
-
-        final_results: AggregatedResult = aggregate_processing_results(
-            job_id=job_id, document_name=job.document_name,
-            page_results=page_results, pdf_metadata=pdf_metadata,
-            user_prompt=job.user_prompt, # Pass original user prompt for summary
-            start_timestamp=start_timestamp
+async def _process_page_pack_scheduled(
+    scheduler_owner: str,
+    page_source: _PageImageSource,
+    page_nums: List[int],
+    config: AppSettings,
+    page_timeout: Optional[float] = None,
+    admission_ticket: Optional[AdmissionTicket] = None,
+    **page_kwargs: Any
+) -> Dict[int, PageProcessingResult]:
+    """
+    Like _process_single_page_scheduled for several pages answered by one LLM call
+    (see _process_page_pack): the pack takes one scheduler slot, its pages share a
+    timeout of `page_timeout` per page, and a result is returned for every page.
+    Pages sent again on their own after a failed split run one after another in the
+    same slot.
+    """
+    results: Dict[int, PageProcessingResult] = {}
+    scheduler = get_page_scheduler(config)
+    async with scheduler.slot(scheduler_owner) as queue_wait:
+        if queue_wait > 0:
+            logger.debug(f"Pages {page_nums[0]}-{page_nums[-1]} of '{scheduler_owner}' waited {queue_wait:.2f}s for a scheduler slot.")
+        pack_timeout = page_timeout * len(page_nums) if page_timeout else None
+        try:
+            await asyncio.wait_for(
+                _process_page_pack(page_source, page_nums, config, results, admission_ticket, **page_kwargs),
+                timeout=pack_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Pages {page_nums[0]}-{page_nums[-1]}: Processing exceeded the {pack_timeout:g}s pack timeout.")
+            for page_num in page_nums:
+                results.setdefault(page_num, PageProcessingResult(
+                    page_number=page_num,
+                    status=PageProcessingStatus.ERROR_TIMEOUT,
+                    error_message=f"Page processing exceeded the {pack_timeout:g}s timeout of its page pack.",
+                    final_error_cause=CAUSE_PAGE_TIMEOUT
+                ))
+        except Exception as e:
+            logger.error(f"Pages {page_nums[0]}-{page_nums[-1]}: Unexpected error during processing: {e.__class__.__name__}: {e}", exc_info=True)
+            for page_num in page_nums:
+                results.setdefault(page_num, PageProcessingResult(
+                    page_number=page_num,
+                    status=PageProcessingStatus.ERROR_UNKNOWN,
+                    error_message=f"Unexpected error processing page: {e.__class__.__name__}: {e}"
+                ))
+    for result in results.values():
+        _annotate_page_result(result, page_source, queue_wait)
+    return results
+
+
+async def _page_of_pack(pack_task: asyncio.Task, page_num: int) -> PageProcessingResult:
+    """One page's result of a pack task; cancelling it cancels the pack."""
+    return (await pack_task)[page_num]
+
+
+# --- Main Workflow Orchestration Function ---
+
+# Progress checkpoints reported to the job store (percent)
+PROGRESS_VALIDATION = 5.0
+PROGRESS_CONVERSION = 15.0
+PROGRESS_METADATA_SCREENSHOTS = 30.0
+PROGRESS_START_META = 35.0
+PROGRESS_END_META_START_MAIN = 50.0
+PROGRESS_END_MAIN = 95.0
+PROGRESS_AGGREGATING = 98.0
+
+ProgressCallback = Callable[[JobStatus, float], None]
+PageResultCallback = Callable[[PageProcessingResult], None]
+
+
+def _page_task_result(task: asyncio.Task, page_num: int) -> PageProcessingResult:
+    """The result of a finished page task, or an ERROR_UNKNOWN result if it raised."""
+    if task.cancelled():
+        return PageProcessingResult(page_number=page_num, status=PageProcessingStatus.ERROR_UNKNOWN, error_message="Page processing was cancelled.")
+    error = task.exception()
+    if error is not None:
+        logger.error(f"Page {page_num}: Task failed: {error.__class__.__name__}: {error}")
+        return PageProcessingResult(
+            page_number=page_num,
+            status=PageProcessingStatus.ERROR_UNKNOWN,
+            error_message=f"Unexpected error processing page: {error.__class__.__name__}: {error}"
         )
+    return task.result()
+
+
+async def _collect_page_results(
+    page_tasks: Dict[int, asyncio.Task],
+    deadline_at: Optional[float],
+    deadline: Optional[float],
+    on_result: PageResultCallback,
+    admission_ticket: Optional[AdmissionTicket] = None
+) -> None:
+    """
+    Passes each page's result to `on_result` as its task finishes (completion order).
+
+    Pages still unfinished at `deadline_at` (event loop time) are cancelled and passed
+    on as ERROR_TIMEOUT results. If this coroutine is itself cancelled, all remaining
+    page tasks are cancelled with it. Pages count as queued on `admission_ticket`
+    until their result has been passed on.
+    """
+    page_of = {task: page_num for page_num, task in page_tasks.items()}
+    pending = set(page_of)
+    loop = asyncio.get_running_loop()
+    if admission_ticket is not None:
+        admission_ticket.add_pages(len(page_tasks))
+
+    def deliver(result: PageProcessingResult) -> None:
+        if admission_ticket is not None:
+            admission_ticket.page_done()
+        on_result(result)
+
+    try:
+        while pending:
+            timeout = None if deadline_at is None else max(0.0, deadline_at - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break # Deadline reached
+            for task in sorted(done, key=page_of.get):
+                deliver(_page_task_result(task, page_of[task]))
+    except asyncio.CancelledError:
+        _cancellation_stats["pages_cancelled"] += len(pending)
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if pending:
+        logger.warning(f"Request deadline of {deadline:g}s reached; {len(pending)} unfinished page(s) were cancelled.")
+    for page_num in sorted(page_of[task] for task in pending):
+        deliver(PageProcessingResult(
+            page_number=page_num,
+            status=PageProcessingStatus.ERROR_TIMEOUT,
+            error_message=f"Page was not finished within the {deadline:g}s request deadline.",
+            final_error_cause=CAUSE_REQUEST_DEADLINE
+        ))
 
-        # 8. Set Final Results and Status
+
+async def process_document_workflow(
+    job_id: str,
+    config: AppSettings,
+    job_store: BaseJobStore,
+    admission_ticket: Optional[AdmissionTicket] = None,
+    upload_stats: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Runs the document pipeline for a job created in the job store (async job mode).
+    Status and progress are written to the store as the pipeline advances, and the
+    aggregated results (or a WORKFLOW_FAILED error) are stored when it finishes.
+    The job's `admission_ticket`, if any, is closed when the workflow ends.
+    """
+    job = job_store.get_job(job_id)
+    if job is None:
+        logger.error(f"Cannot start workflow: job {job_id} not found in job store.")
+        if admission_ticket is not None:
+            admission_ticket.close()
+        return
+
+    logger.info(f"Starting workflow for job {job_id} ('{job.document_name}'). MetaInt: {job.use_meta_intelligence}")
+    job_store.update_job_status(job_id, JobStatus.VALIDATING, progress=PROGRESS_VALIDATION)
+
+    def report_progress(status: JobStatus, progress: float) -> None:
+        job_store.update_job_status(job_id, status, progress=progress)
+
+    try:
+        final_results = await process_document_stateless(
+            input_file_path=Path(job.input_file_path),
+            user_prompt=job.user_prompt or "",
+            output_format=job.output_format,
+            use_meta_intelligence=job.use_meta_intelligence,
+            config=config,
+            llm_api_key=job.llm_api_key,
+            job_dir=Path(job.job_dir),
+            job_id=job_id,
+            document_name=job.document_name,
+            render_profile=job.render_profile,
+            page_timeout=job.page_timeout,
+            deadline=job.deadline,
+            progress_callback=report_progress,
+            admission_ticket=admission_ticket,
+            upload_stats=upload_stats,
+            prompts=job.prompts,
+        )
         job_store.set_job_results(job_id, final_results)
         logger.info(f"Workflow for job {job_id} completed.")
-
+    except ResourceLimitExceededError as e:
+        logger.error(f"Workflow for job {job_id} stopped by resource limits: {e}")
+        job_store.add_job_error(job_id, "RESOURCE_LIMIT_EXCEEDED", str(e), recoverable=False)
     except (ValueError, RuntimeError, FileNotFoundError) as e:
-        error_msg = f"Workflow for job {job_id} failed: {e}"
-        logger.error(error_msg, exc_info=True)
+        logger.error(f"Workflow for job {job_id} failed: {e}", exc_info=True)
         job_store.add_job_error(job_id, "WORKFLOW_FAILED", str(e), recoverable=False)
     except Exception as e:
-        error_msg = f"Unexpected error during workflow for job {job_id}: {e.__class__.__name__} - {e}"
-        logger.error(error_msg, exc_info=True)
+        logger.error(f"Unexpected error during workflow for job {job_id}: {e.__class__.__name__} - {e}", exc_info=True)
         job_store.add_job_error(job_id, "UNEXPECTED_WORKFLOW_ERROR", str(e), recoverable=False)
 
-    finally:
-        # 9. Cleanup
-        final_job_state = job_store.get_job(job_id)
-        should_cleanup = True
-        if final_job_state and final_job_state.status == JobStatus.ERROR:
-             logger.warning(f"Job {job_id} finished with errors. Skipping cleanup of {job_dir} for debugging.")
-             should_cleanup = False
-
-        if should_cleanup:
-            try:
-                if input_file_path and input_file_path.exists():
-                    input_file_path.unlink()
-                    logger.info(f"Cleaned up input file: {input_file_path}")
-            except OSError as e: logger.error(f"Error cleaning up input file {input_file_path}: {e}")
-            try:
-                if job_dir and job_dir.exists():
-                    shutil.rmtree(job_dir)
-                    logger.info(f"Cleaned up job directory: {job_dir}")
-            except OSError as e: logger.error(f"Error cleaning up job directory {job_dir}: {e}")
-            # Optionally remove job from store after cleanup
-            # job_store.cleanup_job_data(job_id)
-
 
 # --- Stateless end-to-end processing (no job tracking) ---
 
@@ -344,136 +682,287 @@ async def process_document_stateless(
     config: AppSettings,
     llm_api_key: str,
     job_dir: Path,
+    job_id: Optional[str] = None,
+    document_name: Optional[str] = None,
+    render_profile: Optional[str] = None,
+    page_timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+    progress_callback: Optional[ProgressCallback] = None,
+    page_callback: Optional[PageResultCallback] = None,
+    admission_ticket: Optional[AdmissionTicket] = None,
+    upload_stats: Optional[Dict[str, Any]] = None,
+    scheduler_owner: Optional[str] = None,
+    prompts: Optional[List[NamedPrompt]] = None,
 ) -> AggregatedResult:
+    """
+    Runs the full pipeline (convert, render, optional meta pass, per-page LLM calls,
+    aggregation) for one document and returns the aggregated result.
+    The job directory is always removed afterwards.
+
+    `render_profile` (e.g. 'longest_side:1600') overrides config.render_profile for
+    this document; an invalid spec raises ValueError before any work is done.
+
+    `page_timeout` (default config.page_timeout_seconds) bounds each page once it has
+    a scheduler slot. If `deadline` is given, pages still unfinished that many seconds
+    after the call started are cancelled and returned as ERROR_TIMEOUT, so a partial
+    result is always returned. 0 disables either limit. LLM retries of all pages share
+    one RetryBudget, which also stops retrying once the deadline would be missed.
+
+    If `progress_callback` is given it is called with (JobStatus, percent) as the
+    pipeline advances; the async job mode uses this to update the job store.
+    If `page_callback` is given it is called with each main-pass PageProcessingResult
+    as soon as that page finishes (completion order, not page order).
+
+    `admission_ticket` (from the admission controller) is charged with this document's
+    queued pages and in-flight page bytes, and closed when processing ends.
+    `upload_stats` (size, SHA-256 and throughput of the upload) is passed on to the summary.
+    `scheduler_owner` (default: the job directory name) is the page scheduler queue the
+    pages wait in; the documents of a batch share one, so a batch gets one fair share.
+
+    If `prompts` (named prompts, each with its own output format) are given they are run
+    instead of `user_prompt`/`output_format`: every page is converted, rendered and
+    encoded once and fanned out to one LLM call per prompt. Page results then carry
+    their `prompt_name` and are returned grouped in AggregatedResult.prompt_results.
+
+    With config.llm_pages_per_request > 1 the main pass sends that many consecutive
+    pages per LLM call (per prompt) and splits the answer back into page results;
+    pages whose split fails are sent again on their own.
+    """
     start_timestamp = time.time()
+    deadline_at = asyncio.get_running_loop().time() + deadline if deadline else None
+    if page_timeout is None:
+        page_timeout = config.page_timeout_seconds
     input_file_path = Path(input_file_path)
     job_dir = Path(job_dir)
     pdf_path: Optional[Path] = None
-    screenshot_paths: List[Path] = []
+    page_source: Optional[_PageImageSource] = None
+    retry_budget: Optional[RetryBudget] = None
     pdf_metadata: Dict[str, Any] = {}
     page_results: List[PageProcessingResult] = []
     meta_context: str = ""
+    # Pages of this request share scheduler slots fairly with other requests
+    scheduler_owner = scheduler_owner or job_dir.name
+    # (prompt name, prompt, output format) of each LLM call made per page
+    prompt_specs: List[Tuple[Optional[str], str, str]] = (
+        [(named.name, named.prompt, named.output_format) for named in prompts] if prompts
+        else [(None, user_prompt, output_format)]
+    )
 
-    try:
-        # Validation
-        if not input_file_path.exists():
-            raise ValueError(f"Input file not found: {input_file_path}")
-
-        # Determine if input is an image
-        image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
-        is_image_input = input_file_path.suffix.lower() in image_extensions
+    def report(status: JobStatus, progress: float) -> None:
+        if progress_callback is not None:
+            progress_callback(status, progress)
 
-        if is_image_input:
-            screenshot_paths = [input_file_path]
-            pdf_metadata = {"pages": 1, "source_type": "image"}
-        else:
-            # Convert to PDF
-            convert_success, pdf_path, convert_error = await convert_to_pdf_libreoffice(input_file_path, job_dir / "converted", config)
-            if not convert_success or not pdf_path:
-                raise RuntimeError(f"Document conversion failed: {convert_error}")
-
-            # Extract metadata and screenshots
-            meta_task = asyncio.create_task(extract_pdf_metadata(pdf_path, config))
-            screenshot_task = asyncio.create_task(extract_pdf_pages_as_png(pdf_path, job_dir / "screenshots", config))
-
-            meta_success, meta_stdout, meta_stderr = await meta_task
-            if meta_success:
-                pdf_metadata = parse_pdfinfo_output(meta_stdout)
+    # Collects queue-wait/run time of every external command this document runs
+    with subprocess_timing_scope() as subprocess_timings:
+        try:
+            # Validation
+            if not input_file_path.exists():
+                raise ValueError(f"Input file not found: {input_file_path}")
+            profile = RenderProfile.parse(render_profile or config.render_profile)
+
+            # Determine the input type from its content (raises UnsupportedDocumentError)
+            document_kind, detected_mime = sniff_document_type(input_file_path)
+            is_image_input = document_kind == DOCUMENT_KIND_IMAGE
+            logger.info(f"Detected '{input_file_path.name}' as {document_kind} ({detected_mime}).")
+
+            if is_image_input:
+                page_source = _PageImageSource(paths=[input_file_path])
+                pdf_metadata = {"pages": 1, "source_type": "image", "detected_mime_type": detected_mime}
             else:
-                logger.warning(f"Metadata extraction warning: {meta_stderr}")
-            pdf_metadata["source_type"] = "document"
-
-            ss_success, screenshot_paths, ss_error = await screenshot_task
-            if not ss_success or not screenshot_paths:
-                raise RuntimeError(f"Screenshot generation failed: {ss_error}")
-            elif ss_error:
-                logger.warning(f"Screenshot warnings: {ss_error}")
-
-        # Optional meta pass
-        if use_meta_intelligence and not is_image_input:
-            meta_pages_to_scan = min(len(screenshot_paths), MAX_META_PAGES)
-            meta_tasks = []
-            for i in range(meta_pages_to_scan):
-                page_num = i + 1
-                task = asyncio.create_task(
-                    _process_single_page(
-                        page_num=page_num,
-                        screenshot_path=screenshot_paths[i],
-                        prompt_to_use=META_PROMPT_TEMPLATE,
-                        output_format="json",
-                        job_dir=job_dir / "meta_results",
-                        config=config,
+                if document_kind == DOCUMENT_KIND_PDF:
+                    # Already a PDF: no LibreOffice round trip
+                    pdf_path = input_file_path
+                else:
+                    # Convert to PDF
+                    report(JobStatus.CONVERTING, PROGRESS_CONVERSION)
+                    convert_success, pdf_path, convert_error = await convert_to_pdf_libreoffice(input_file_path, job_dir / "converted", config)
+                    if not convert_success or not pdf_path:
+                        raise RuntimeError(f"Document conversion failed: {convert_error}")
+
+                # Metadata first: the page count drives on-demand rendering
+                report(JobStatus.PROCESSING, PROGRESS_METADATA_SCREENSHOTS)
+                meta_success, meta_stdout, meta_stderr = await extract_pdf_metadata(pdf_path, config)
+                if meta_success:
+                    pdf_metadata = parse_pdfinfo_output(meta_stdout)
+                else:
+                    logger.warning(f"Metadata extraction warning: {meta_stderr}")
+                pdf_metadata["source_type"] = "document"
+                pdf_metadata["detected_mime_type"] = detected_mime
+                scale_args = pdftoppm_scale_args(profile, pdf_metadata)
+                render_format, webp_quality = _page_render_format(config)
+                pdf_metadata["render_profile"] = profile.spec
+                pdf_metadata["render_args"] = " ".join(scale_args)
+                pdf_metadata["page_image_format"] = "webp" if webp_quality is not None else render_format
+
+                page_count = pdf_metadata.get("pages")
+                if isinstance(page_count, int) and page_count > 0:
+                    # Pages are rendered in windows as page tasks get scheduler slots
+                    renderer = LazyPdfPageRenderer(
+                        pdf_path, job_dir / "screenshots", config,
+                        total_pages=page_count, window_size=config.render_window_pages,
+                        scale_args=scale_args, image_format=render_format
+                    )
+                    page_source = _PageImageSource(renderer=renderer, webp_quality=webp_quality)
+                else:
+                    # Page count unknown: render the whole document up front
+                    ss_success, screenshot_paths, ss_error = await extract_pdf_pages_as_png(
+                        pdf_path, job_dir / "screenshots", config, scale_args, image_format=render_format
+                    )
+                    if not ss_success or not screenshot_paths:
+                        raise RuntimeError(f"Screenshot generation failed: {ss_error}")
+                    elif ss_error:
+                        logger.warning(f"Screenshot warnings: {ss_error}")
+                    page_source = _PageImageSource(paths=screenshot_paths, delete_after_encode=True, webp_quality=webp_quality)
+
+            # Every page is loaded once per prompt; keep its image until the last one has it
+            page_source.loads_per_page = len(prompt_specs)
+            retry_budget = RetryBudget.for_document(config, page_source.total_pages * len(prompt_specs), deadline_at)
+
+            # Optional meta pass
+            if use_meta_intelligence and not is_image_input:
+                report(JobStatus.PROCESSING, PROGRESS_START_META)
+                meta_pages_to_scan = min(page_source.total_pages, MAX_META_PAGES)
+                meta_tasks: Dict[int, asyncio.Task] = {}
+                for i in range(meta_pages_to_scan):
+                    page_num = i + 1
+                    task = asyncio.create_task(
+                        _process_single_page_scheduled(
+                            scheduler_owner=scheduler_owner,
+                            page_source=page_source,
+                            page_num=page_num,
+                            config=config,
+                            keep_image=True, # Reused by the main pass
+                            page_timeout=page_timeout,
+                            admission_ticket=admission_ticket,
+                            prompt_to_use=META_PROMPT_TEMPLATE,
+                            output_format="json",
+                            job_dir=job_dir / "meta_results",
+                            llm_api_key=llm_api_key,
+                            retry_budget=retry_budget,
+                        )
+                    )
+                    meta_tasks[page_num] = task
+
+                meta_results_raw: List[PageProcessingResult] = []
+                await _collect_page_results(meta_tasks, deadline_at, deadline, meta_results_raw.append, admission_ticket)
+                successful_meta_results = []
+                for res in sorted(meta_results_raw, key=lambda r: r.page_number):
+                    if res.status == PageProcessingStatus.SUCCESS and isinstance(res.data, dict):
+                        successful_meta_results.append(res.data)
+
+                if successful_meta_results:
+                    meta_context = "Document Context Summary (from first {} page(s)):\n".format(len(successful_meta_results))
+                    for i, data in enumerate(successful_meta_results):
+                        meta_context += f"- Page {i+1}: {json.dumps(data)}\n"
+                    meta_context = meta_context.strip()
+
+            # Main pass: one task per page and prompt; each page is rendered and encoded once
+            report(JobStatus.PROCESSING, PROGRESS_END_META_START_MAIN)
+            total_pages_to_process = page_source.total_pages
+            tasks_by_prompt: List[Dict[int, asyncio.Task]] = [{} for _ in prompt_specs]
+            final_prompts: List[str] = []
+            for _, prompt, _ in prompt_specs:
+                if meta_context:
+                    prompt = f"DOCUMENT CONTEXT:\n{meta_context}\n\n---\n\nUSER TASK:\n{prompt}"
+                final_prompts.append(prompt)
+
+            # With LLM_PAGES_PER_REQUEST > 1, consecutive pages share one LLM call per prompt
+            pack_size = max(1, config.llm_pages_per_request)
+            for first_page in range(1, total_pages_to_process + 1, pack_size):
+                pack = list(range(first_page, min(first_page + pack_size, total_pages_to_process + 1)))
+                for prompt_index, (_, _, prompt_output_format) in enumerate(prompt_specs):
+                    page_kwargs = dict(
+                        prompt_to_use=final_prompts[prompt_index],
+                        output_format=prompt_output_format,
+                        job_dir=job_dir / "page_results",
                         llm_api_key=llm_api_key,
+                        retry_budget=retry_budget,
                     )
-                )
-                meta_tasks.append(task)
-
-            meta_results_raw = await asyncio.gather(*meta_tasks, return_exceptions=True)
-            successful_meta_results = []
-            for i, res in enumerate(meta_results_raw):
-                if isinstance(res, PageProcessingResult) and res.status == PageProcessingStatus.SUCCESS and isinstance(res.data, dict):
-                    successful_meta_results.append(res.data)
-
-            if successful_meta_results:
-                meta_context = "Document Context Summary (from first {} page(s)):\n".format(len(successful_meta_results))
-                for i, data in enumerate(successful_meta_results):
-                    meta_context += f"- Page {i+1}: {json.dumps(data)}\n"
-                meta_context = meta_context.strip()
-
-        # Main pass
-        total_pages_to_process = len(screenshot_paths)
-        tasks = []
-        final_user_prompt = user_prompt
-        if meta_context:
-            final_user_prompt = f"DOCUMENT CONTEXT:\n{meta_context}\n\n---\n\nUSER TASK:\n{user_prompt}"
-
-        for i, screenshot_path in enumerate(screenshot_paths):
-            page_num = i + 1
-            task = asyncio.create_task(
-                _process_single_page(
-                    page_num=page_num,
-                    screenshot_path=screenshot_path,
-                    prompt_to_use=final_user_prompt,
-                    output_format=output_format,
-                    job_dir=job_dir / "page_results",
-                    config=config,
-                    llm_api_key=llm_api_key,
-                )
+                    if len(pack) == 1:
+                        tasks_by_prompt[prompt_index][first_page] = asyncio.create_task(
+                            _process_single_page_scheduled(
+                                scheduler_owner=scheduler_owner,
+                                page_source=page_source,
+                                page_num=first_page,
+                                config=config,
+                                page_timeout=page_timeout,
+                                admission_ticket=admission_ticket,
+                                **page_kwargs,
+                            )
+                        )
+                        continue
+                    pack_task = asyncio.create_task(
+                        _process_page_pack_scheduled(
+                            scheduler_owner=scheduler_owner,
+                            page_source=page_source,
+                            page_nums=pack,
+                            config=config,
+                            page_timeout=page_timeout,
+                            admission_ticket=admission_ticket,
+                            **page_kwargs,
+                        )
+                    )
+                    for page_num in pack:
+                        tasks_by_prompt[prompt_index][page_num] = asyncio.create_task(_page_of_pack(pack_task, page_num))
+
+            progress_range = PROGRESS_END_MAIN - PROGRESS_END_META_START_MAIN
+            total_results_expected = total_pages_to_process * len(prompt_specs)
+
+            def on_page_result_for(prompt_name: Optional[str]) -> PageResultCallback:
+                def on_page_result(result: PageProcessingResult) -> None:
+                    result.prompt_name = prompt_name
+                    page_results.append(result)
+                    if page_callback is not None:
+                        page_callback(result)
+                    report(JobStatus.PROCESSING, PROGRESS_END_META_START_MAIN + (len(page_results) / total_results_expected) * progress_range)
+                return on_page_result
+
+            await asyncio.gather(*(
+                _collect_page_results(tasks, deadline_at, deadline, on_page_result_for(prompt_name), admission_ticket)
+                for tasks, (prompt_name, _, _) in zip(tasks_by_prompt, prompt_specs)
+            ))
+
+            # Aggregate
+            report(JobStatus.AGGREGATING, PROGRESS_AGGREGATING)
+            if not page_results and total_pages_to_process > 0:
+                raise RuntimeError("Aggregation failed: No page processing results were collected.")
+
+            final_results: AggregatedResult = aggregate_processing_results(
+                job_id=job_id or str(int(start_timestamp)),
+                document_name=document_name or input_file_path.name,
+                page_results=page_results,
+                pdf_metadata=pdf_metadata,
+                user_prompt=user_prompt,
+                start_timestamp=start_timestamp,
+                subprocess_stats=summarize_subprocess_timings(subprocess_timings),
+                retry_stats=retry_budget.stats(),
+                upload_stats=upload_stats,
+                prompts=prompts,
             )
-            tasks.append(task)
-
-        for future in asyncio.as_completed(tasks):
-            result: PageProcessingResult = await future
-            page_results.append(result)
-
-        # Aggregate
-        if not page_results and total_pages_to_process > 0:
-            raise RuntimeError("Aggregation failed: No page processing results were collected.")
-
-        final_results: AggregatedResult = aggregate_processing_results(
-            job_id=str(int(start_timestamp)),
-            document_name=input_file_path.name,
-            page_results=page_results,
-            pdf_metadata=pdf_metadata,
-            user_prompt=user_prompt,
-            start_timestamp=start_timestamp,
-        )
-        return final_results
-
-    finally:
-        # Cleanup
-        try:
-            if input_file_path and input_file_path.exists():
-                input_file_path.unlink()
-                logger.info(f"Cleaned up input file: {input_file_path}")
-        except OSError as e:
-            logger.error(f"Error cleaning up input file {input_file_path}: {e}")
-        try:
-            if job_dir and job_dir.exists():
-                shutil.rmtree(job_dir)
-                logger.info(f"Cleaned up job directory: {job_dir}")
-        except OSError as e:
-            logger.error(f"Error cleaning up job directory {job_dir}: {e}")
+            return final_results
+
+        except asyncio.CancelledError:
+            _cancellation_stats["requests_cancelled"] += 1
+            logger.warning(f"Processing of '{input_file_path.name}' was cancelled; outstanding pages and commands were stopped.")
+            raise
+        finally:
+            # Cleanup
+            if admission_ticket is not None:
+                admission_ticket.close()
+            if page_source is not None:
+                await page_source.aclose()
+            try:
+                if input_file_path and input_file_path.exists():
+                    input_file_path.unlink()
+                    logger.info(f"Cleaned up input file: {input_file_path}")
+            except OSError as e:
+                logger.error(f"Error cleaning up input file {input_file_path}: {e}")
+            try:
+                if job_dir and job_dir.exists():
+                    shutil.rmtree(job_dir)
+                    logger.info(f"Cleaned up job directory: {job_dir}")
+            except OSError as e:
+                logger.error(f"Error cleaning up job directory {job_dir}: {e}")
 
 # Example Usage (for direct execution if needed)
 if __name__ == "__main__":